@@ -1,6 +1,6 @@
 # analytics.py
 import numpy as np
-from storage import load_thresholds
+from threshold_index import thresholds_index
 
 def kline_to_volatility(kline):
     """Рассчитывает волатильность свечи: (high - low) / open * 100"""
@@ -28,24 +28,30 @@ def quote_volume_from_kline(kline):
 
 def compute_avg_volume(history_klines):
     """Средний quoteVolume за последние 72 свечи (или меньше, если нет)"""
-    if not history_klines:
+    if not len(history_klines):
         return 0.0
+    if hasattr(history_klines, "quote_volume"):  # окно из candle_store — уже числа
+        return float(history_klines.quote_volume.mean())
     volumes = [quote_volume_from_kline(k) for k in history_klines]
     return sum(volumes) / len(volumes) if volumes else 0.0
 
 def compute_thresholds_from_klines(klines):
     """Вычисляет Q25, Q50, Q75 волатильности за 14 дней (4032 свечи)"""
-    vols = [kline_to_volatility(k) for k in klines if kline_to_volatility(k) > 0]
-    if not vols:
+    return compute_thresholds_from_vols([kline_to_volatility(k) for k in klines])
+
+def compute_thresholds_from_vols(vols):
+    """То же по готовому ряду волатильностей (нулевые не учитываются)"""
+    vols = np.asarray(vols, dtype=np.float64)
+    vols = vols[vols > 0]
+    if not len(vols):
         return {"q25": 0.0, "q50": 0.0, "q75": 0.0}
-    q25 = float(np.percentile(vols, 25))
-    q50 = float(np.percentile(vols, 50))
-    q75 = float(np.percentile(vols, 75))
+    q25, q50, q75 = (float(q) for q in np.percentile(vols, [25, 50, 75]))
     return {"q25": q25, "q50": q50, "q75": q75}
 
-def determine_level(vol_pct, symbol):
-    """Определяет уровень 1-4 на основе порогов для символа"""
-    thresholds = load_thresholds().get(symbol, {"q25": 0, "q50": 0, "q75": 0})
+def determine_level(vol_pct, symbol, thresholds=None):
+    """Определяет уровень 1-4 на основе порогов для символа (или переданных thresholds)"""
+    if thresholds is None:
+        thresholds = thresholds_index.get(symbol)
     q25, q50, q75 = thresholds["q25"], thresholds["q50"], thresholds["q75"]
     if vol_pct <= q25:
         return 1
@@ -56,6 +62,17 @@ def determine_level(vol_pct, symbol):
     else:
         return 4
 
+def determine_levels(vol_pcts, symbols, thresholds=None):
+    """Векторный determine_level: уровни 1-4 для массива волатильностей за один вызов.
+
+    thresholds — матрица (n, 3) с Q25/Q50/Q75 по строкам; по умолчанию из индекса порогов.
+    """
+    vols = np.asarray(vol_pcts, dtype=np.float64)
+    if thresholds is None:
+        thresholds = thresholds_index.matrix(symbols)
+    # vol <= q25 -> 1, <= q50 -> 2, <= q75 -> 3, иначе 4
+    return 1 + (vols[:, None] > thresholds).sum(axis=1)
+
 def get_level_emoji(level):
     """Emoji для уровня"""
     if level == 1:
@@ -0,0 +1,137 @@
+# backfill.py
+# Догрузка дыр в истории свечей. Для каждого символа — каких open_time не хватает в окне
+# из HISTORY_SIZE свечей (и в разрыве после простоя); недостающее покрывается минимальным
+# числом страниц klines (до 1000 свечей), все символы — одним проходом под общий бюджет веса.
+# Окно «тёплое», только когда в нём есть все свечи; по холодным сигналы не считаются.
+import asyncio
+
+import numpy as np
+
+from binance_api import get_klines
+from config import HISTORY_SIZE, BACKFILL_WEIGHT_BUDGET
+from metrics import CallbackMetric
+from rate_limiter import klines_weight, PRIORITY_BACKFILL
+from storage import candle_store
+
+STEP = 300_000  # 5 минут, мс
+PAGE = 1000  # свечей в одном запросе klines (максимум Binance)
+
+def pages(times):
+    """Отсортированные open_time -> минимум запросов [(start, limit)]: каждая страница начинается
+    с первой непокрытой свечи и берёт до PAGE свечей (жадно — это оптимум для отрезков одной длины)"""
+    result = []
+    i = 0
+    while i < len(times):
+        start = int(times[i])
+        j = int(np.searchsorted(times, start + PAGE * STEP))
+        result.append((start, (int(times[j - 1]) - start) // STEP + 1))
+        i = j
+    return result
+
+class Backfiller:
+    """Какие окна неполные и какие свечи догрузить; сами свечи раскладывает scheduler.fill_history"""
+
+    def __init__(self, window=HISTORY_SIZE, budget=BACKFILL_WEIGHT_BUDGET):
+        self.window = window
+        self.budget = budget
+        self.warm = set()
+        self.cold = {}  # symbol -> сколько свечей не хватает
+        self._absent = {}  # symbol -> {open_time}: Binance их не отдал (до листинга, простой биржи)
+        self.metrics = {"requests": 0, "weight": 0, "candles": 0}
+
+    def is_warm(self, symbol):
+        return symbol in self.warm
+
+    def missing(self, symbol, end, since=None):
+        """open_time свечей, которых нет в окне символа, заканчивающемся на end.
+
+        since — начало разрыва после простоя: свечи новее последней в истории
+        догружаются и глубже окна (для статистики), но не дальше PAGE свечей назад.
+        """
+        store = candle_store()
+        buf = store.get(symbol) if symbol in store else None
+        last = buf.last_open_time if buf is not None else None
+        if last is not None and last > end:
+            end = last  # текущая свеча уже в истории
+        window_start = end - (self.window - 1) * STEP
+        if buf is not None and last == end and buf.count >= self.window:
+            times = buf.window(self.window).open_time
+            if times[-1] - times[0] == (self.window - 1) * STEP:
+                return times[:0]  # окно полное и без дыр — без поиска
+        start = window_start if since is None else max(min(window_start, since), end - (PAGE - 1) * STEP)
+        expected = np.arange(start, end + STEP, STEP, dtype=np.int64)
+        present = buf.window().open_time if buf is not None else expected[:0]
+        keep = ~np.isin(expected, present)
+        if last is not None:
+            keep &= (expected >= window_start) | (expected > last)  # глубже окна — только разрыв после простоя
+        absent = self._absent.get(symbol)
+        if absent:
+            absent.intersection_update(expected.tolist())
+            keep &= ~np.isin(expected, np.fromiter(absent, dtype=np.int64, count=len(absent)))
+        return expected[keep]
+
+    def plan(self, symbols, end, since=None):
+        """{symbol: недостающие open_time}; заодно отмечает тёплые и холодные окна"""
+        result = {}
+        for symbol in symbols:
+            times = self.missing(symbol, end, since)
+            if len(times):
+                result[symbol] = times
+                self.warm.discard(symbol)
+                self.cold[symbol] = len(times)
+            else:
+                self.warm.add(symbol)
+                self.cold.pop(symbol, None)
+        return result
+
+    async def run(self, symbols, end, since=None):
+        """Догружает недостающие свечи: {symbol: [kline, ...]}.
+
+        Запросы всех символов идут параллельно через общий лимитер с приоритетом догрузки;
+        за проход тратится не больше budget веса — сначала символы без истории и самые дешёвые,
+        остальные остаются холодными до следующего цикла.
+        """
+        planned = self.plan(symbols, end, since)
+        if not planned:
+            return {}
+        store = candle_store()
+        requests = []
+        for symbol, times in planned.items():
+            symbol_pages = pages(times)
+            weight = sum(klines_weight({"limit": limit}) for _, limit in symbol_pages)
+            has_history = symbol in store and len(store.get(symbol)) > 0
+            requests.append((has_history, weight, symbol, symbol_pages))
+        requests.sort(key=lambda r: r[:2])
+        batch, spent = [], 0
+        for _, weight, symbol, symbol_pages in requests:
+            if batch and spent + weight > self.budget:
+                break
+            spent += weight
+            batch.extend((symbol, start, limit) for start, limit in symbol_pages)
+        if len(batch) < sum(len(r[3]) for r in requests):
+            print(f"Догрузка истории: бюджет {self.budget} веса, {len(requests)} символов с дырами — часть в следующем цикле")
+
+        results = await asyncio.gather(*(
+            get_klines(symbol, "5m", limit, start_time=start, end_time=start + limit * STEP - 1,
+                       priority=PRIORITY_BACKFILL)
+            for symbol, start, limit in batch
+        ))
+        self.metrics["requests"] += len(batch)
+        self.metrics["weight"] += spent
+        fetched = {}
+        for (symbol, start, limit), klines in zip(batch, results):
+            if not klines:
+                continue  # ошибка или пустой ответ — попробуем в следующий раз
+            got = {int(k[0]) for k in klines}
+            times = planned[symbol]
+            asked = times[(times >= start) & (times < start + limit * STEP)].tolist()
+            self._absent.setdefault(symbol, set()).update(t for t in asked if t not in got)
+            fetched.setdefault(symbol, []).extend(klines)
+            self.metrics["candles"] += len(klines)
+        for klines in fetched.values():
+            klines.sort(key=lambda k: int(k[0]))
+        return fetched
+
+# Глобальный планировщик догрузки
+backfill = Backfiller()
+CallbackMetric("itrader_history_cold_symbols", "Символов с неполным окном истории", lambda: len(backfill.cold))
@@ -0,0 +1,305 @@
+# backtest.py
+# Офлайн-прогон правил сигналов по архиву 5m свечей: всё векторно по массивам (символы x время).
+#
+#   python backtest.py fetch --days 90 BTCUSDT ETHUSDT SOLUSDT   # докачать архив из Binance
+#   python backtest.py run                                       # прогнать правила по архиву
+#   python backtest.py run --synthetic 300 --days 365            # проверка скорости на случайных данных
+import argparse
+import asyncio
+import json
+import os
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from config import ARCHIVE_DIR, HISTORY_SIZE, STATS_MIN_SAMPLES, THRESHOLDS_REFRESH
+from candle_store import COLUMNS, COL, INTERVAL_MS, parse_kline
+from rolling_stats import SlidingQuantiles
+from rules import MODE_RULES
+
+WINDOW = 4032   # 14 дней — окно квантилей, как в compute_thresholds и StatsEngine
+REFRESH = max(1, THRESHOLDS_REFRESH // 300)  # пересчёт индекса порогов (compute_thresholds), в свечах
+BTC = "BTCUSDT"
+
+# Архив: <ARCHIVE_DIR>/<SYMBOL>.npy, строки (open_time, *COLUMNS) по возрастанию open_time
+def archive_path(symbol, directory=ARCHIVE_DIR):
+    return os.path.join(directory, f"{symbol}.npy")
+
+def load_archive(symbols=None, directory=ARCHIVE_DIR):
+    """{symbol: массив (n, 1 + len(COLUMNS))}"""
+    if symbols is None:
+        symbols = sorted(f[:-4] for f in os.listdir(directory) if f.endswith(".npy")) if os.path.isdir(directory) else []
+    data = {}
+    for symbol in symbols:
+        path = archive_path(symbol, directory)
+        if os.path.exists(path):
+            data[symbol] = np.load(path, mmap_mode="r")
+    return data
+
+def save_archive(symbol, rows, directory=ARCHIVE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = archive_path(symbol, directory)
+    tmp = path + ".tmp.npy"
+    np.save(tmp, rows)
+    os.replace(tmp, path)
+
+def klines_to_rows(klines):
+    rows = np.zeros((len(klines), 1 + len(COLUMNS)))
+    for i, kline in enumerate(klines):
+        rows[i, 0], rows[i, 1:] = parse_kline(kline)
+    return rows
+
+async def fetch_archive(symbols, days, directory=ARCHIVE_DIR):
+    """Докачивает архив: только свечи после последней сохранённой, только закрытые"""
+    from binance_api import get_klines_since, close
+
+    now_ms = int(time.time() * 1000)
+    start = now_ms - days * 86_400_000
+
+    async def one(symbol):
+        path = archive_path(symbol, directory)
+        old = np.load(path) if os.path.exists(path) else np.zeros((0, 1 + len(COLUMNS)))
+        since = int(old[-1, 0]) + INTERVAL_MS if len(old) else start
+        klines = [k for k in await get_klines_since(symbol, since) if int(k[6]) < now_ms]
+        if klines:
+            rows = np.vstack([old, klines_to_rows(klines)])
+            save_archive(symbol, rows[rows[:, 0] >= start], directory)
+        print(f"{symbol}: +{len(klines)} свечей")
+
+    await asyncio.gather(*(one(s) for s in symbols))
+    await close()
+
+def synthetic_archive(n_symbols, days, seed=1):
+    """Случайные свечи (лог-нормальная волатильность и объём) для замеров скорости"""
+    rng = np.random.default_rng(seed)
+    t = days * 288
+    open_time = np.arange(t, dtype=np.float64) * INTERVAL_MS + 1_600_000_000_000
+    data = {}
+    for i in range(n_symbols):
+        symbol = BTC if i == 0 else f"SYN{i:04d}USDT"
+        open_p = 100 * np.exp(np.cumsum(rng.normal(0, 0.002, t)))
+        spread = rng.lognormal(-6, 0.6, t)
+        high = open_p * (1 + spread * rng.uniform(0.3, 0.7, t))
+        low = high / (1 + spread)
+        rows = np.zeros((t, 1 + len(COLUMNS)))
+        rows[:, 0] = open_time
+        rows[:, 1 + COL["open"]] = open_p
+        rows[:, 1 + COL["high"]] = high
+        rows[:, 1 + COL["low"]] = low
+        rows[:, 1 + COL["close"]] = rng.uniform(low, high)
+        rows[:, 1 + COL["quote_volume"]] = rng.lognormal(12, 1.0, t)
+        data[symbol] = rows
+    return data
+
+def align(data):
+    """Архивы разных символов -> общая сетка времени: массивы (S, T), пропуски — NaN"""
+    symbols = sorted(data)
+    first = min(int(rows[0, 0]) for rows in data.values() if len(rows))
+    last = max(int(rows[-1, 0]) for rows in data.values() if len(rows))
+    times = np.arange(first, last + 1, INTERVAL_MS, dtype=np.int64)
+    shape = (len(symbols), len(times))
+    columns = {name: np.full(shape, np.nan) for name in ("open", "high", "low", "quote_volume", "taker_buy_quote")}
+    for i, symbol in enumerate(symbols):
+        rows = np.asarray(data[symbol])
+        idx = ((rows[:, 0].astype(np.int64) - first) // INTERVAL_MS)
+        for name, values in columns.items():
+            values[i, idx] = rows[:, 1 + COL[name]]
+    return symbols, times, columns
+
+def rolling_thresholds(vols, window=WINDOW, refresh=REFRESH, min_samples=1):
+    """Q25/Q50/Q75 индекса порогов для каждой свечи: (3, S, T), NaN — порогов ещё нет.
+
+    Пороги для свечи t — по окну закрытых свечей [r - window, r), где r — последний
+    пересчёт не позже t (как ежедневный compute_thresholds). Нулевые и пропущенные
+    свечи в квантили не идут. Интерполяция — как np.percentile (linear).
+    """
+    s, t = vols.shape
+    result = np.full((3, s, t), np.nan)
+    points = np.arange(refresh, t + 1, refresh)  # моменты пересчёта (индекс первой свечи после окна)
+    if not len(points):
+        return result
+    quantiles = np.array([0.25, 0.50, 0.75])
+    # Каждую свечу сопоставляем с последним пересчётом до неё
+    owner = np.searchsorted(points, np.arange(t), side="right") - 1
+    has = owner >= 0
+    for i in range(s):
+        clean = np.where(vols[i] > 0, vols[i], np.inf)  # inf уходят в конец сортировки
+        padded = np.concatenate([np.full(window, np.inf), clean])
+        windows = sliding_window_view(padded, window)[points]  # окно, заканчивающееся перед r
+        ordered = np.sort(windows, axis=1)
+        n = np.isfinite(ordered).sum(axis=1)
+        pos = quantiles[None, :] * np.maximum(n - 1, 0)[:, None]
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, np.maximum(n - 1, 0)[:, None])
+        frac = pos - lo
+        q = np.take_along_axis(ordered, lo, 1) * (1 - frac) + np.take_along_axis(ordered, hi, 1) * frac
+        q[n < min_samples] = np.nan
+        result[:, i, has] = q[owner[has]].T
+    return result
+
+def sliding_thresholds(vols, window=WINDOW, min_samples=STATS_MIN_SAMPLES):
+    """Скользящие Q25/Q50/Q75 на каждой свече, как StatsEngine в боте: (3, S, T), NaN — свечей меньше min_samples.
+
+    Окно — последние window свечей включая текущую (статистика обновляется до классификации),
+    нулевые и пропущенные не идут. Считается тем же SlidingQuantiles, по свече за шаг.
+    """
+    s, t = vols.shape
+    result = np.full((3, s, t), np.nan)
+    for i in range(s):
+        quantiles = SlidingQuantiles(window)
+        rows = ([], [], [], [])  # индекс свечи, q25, q50, q75
+        for j, vol in enumerate(vols[i].tolist()):
+            if vol > 0:  # NaN тоже не проходит
+                quantiles.push(vol)
+            if len(quantiles) >= min_samples:
+                rows[0].append(j)
+                rows[1].append(quantiles.quantile(0.25))
+                rows[2].append(quantiles.quantile(0.50))
+                rows[3].append(quantiles.quantile(0.75))
+        result[:, i, rows[0]] = rows[1:]
+    return result
+
+def classify_thresholds(vols, refresh=REFRESH, min_samples=STATS_MIN_SAMPLES):
+    """Пороги уровней как scheduler.level_thresholds: скользящие квантили, пока их мало — индекс
+    порогов, а где и его нет — нули (как thresholds_index для неизвестного символа)"""
+    sliding = sliding_thresholds(vols, min_samples=min_samples)
+    index = np.nan_to_num(rolling_thresholds(vols, refresh=refresh))
+    return np.where(np.isnan(sliding), index, sliding)
+
+def rolling_mean(values, window=HISTORY_SIZE):
+    """Среднее за последние window свечей, включая текущую (как средний объём в StatsEngine)"""
+    clean = np.nan_to_num(values)
+    counts = np.cumsum(~np.isnan(values), axis=1)
+    sums = np.cumsum(clean, axis=1)
+    sums[:, window:] = sums[:, window:] - sums[:, :-window]
+    counts[:, window:] = counts[:, window:] - counts[:, :-window]
+    return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+def levels_from(vols, thresholds):
+    """determine_levels для всей матрицы (нулевые пороги — уровень 4, как в боте); 0 — свечи нет"""
+    q25, q50, q75 = thresholds
+    levels = 1 + (vols > q25).astype(np.int8) + (vols > q50) + (vols > q75)
+    return np.where(np.isnan(vols), 0, levels)
+
+def apply_cooldown(fired, times, cooldown_ms):
+    """Повтор по символу не раньше cooldown_ms после прошлого сигнала (как RuleBook.evaluate)"""
+    if not cooldown_ms:
+        return fired
+    result = np.zeros_like(fired)
+    for i, row in enumerate(fired):
+        last = None
+        for j in np.flatnonzero(row):
+            if last is None or times[j] - times[last] >= cooldown_ms:
+                result[i, j] = True
+                last = j
+    return result
+
+def rule_mask(rule, levels, btc_level, volume, avg_volume, buy_ratio):
+    """Маска срабатываний скомпилированного правила (rules.Rule) по матрице символ x свеча"""
+    return (
+        ((levels >= rule.min_level) | (btc_level >= rule.btc_or)[None, :])
+        & (btc_level <= rule.btc_max)[None, :]
+        & (volume > rule.surge * avg_volume)
+        & (buy_ratio >= rule.buy_min) & (buy_ratio <= rule.buy_max)
+    )
+
+def summarize(fired, evaluated, levels, symbols):
+    per_level = {}
+    for level in (1, 2, 3, 4):
+        at_level = evaluated & (levels == level)
+        per_level[level] = {
+            "candles": int(at_level.sum()),
+            "alerts": int((fired & at_level).sum()),
+            "rate": float((fired & at_level).sum() / max(at_level.sum(), 1)),
+        }
+    alerts = fired.sum(axis=1)
+    per_symbol = {
+        s: {"alerts": int(a), "candles": int(e), "rate": float(a / e) if e else 0.0}
+        for s, a, e in zip(symbols, alerts, evaluated.sum(axis=1))
+    }
+    return {
+        "alerts": int(fired.sum()),
+        "alert_rate": float(fired.sum() / max(evaluated.sum(), 1)),
+        "per_level": per_level,
+        "per_symbol": per_symbol,
+    }
+
+def replay(data, refresh=REFRESH, min_samples=STATS_MIN_SAMPLES, rules=None):
+    """Правила режимов бота (rules.MODE_RULES) по всему архиву: уровни — от тех же порогов, что в classify,
+    признаки — как scheduler.evaluate_symbol, повтор — с cooldown правила"""
+    rules = MODE_RULES if rules is None else rules
+    start = time.perf_counter()
+    symbols, times, c = align(data)
+    open_p = c["open"]
+    vols = np.divide((c["high"] - c["low"]) * 100.0, open_p, out=np.full(open_p.shape, np.nan), where=open_p > 0)
+    levels = levels_from(vols, classify_thresholds(vols, refresh=refresh, min_samples=min_samples))
+    volume = np.nan_to_num(c["quote_volume"])
+    avg_volume = rolling_mean(c["quote_volume"])
+    buy_ratio = np.divide(np.nan_to_num(c["taker_buy_quote"]), volume, out=np.full(volume.shape, 0.5), where=volume > 0)
+
+    if BTC in symbols:
+        btc_level = levels[symbols.index(BTC)]
+        btc_level = np.where(btc_level > 0, btc_level, 1)  # нет свечи BTC — уровень нулевой волатильности
+    else:
+        btc_level = np.ones(len(times), dtype=levels.dtype)
+    evaluated = levels > 0
+    modes = {}
+    for mode, rule in rules.items():
+        fired = evaluated & rule_mask(rule, levels, btc_level, volume, avg_volume, buy_ratio)
+        fired = apply_cooldown(fired, times, rule.cooldown_ms)
+        modes[mode] = {"rule": rule.text, **summarize(fired, evaluated, levels, symbols)}
+    elapsed = time.perf_counter() - start
+
+    return {
+        "symbols": len(symbols),
+        "candles": int(len(times)),
+        "from": int(times[0]) if len(times) else None,
+        "to": int(times[-1]) if len(times) else None,
+        "modes": modes,
+        "elapsed_sec": elapsed,
+    }
+
+def print_report(report, top=20):
+    print(f"Символов: {report['symbols']}, свечей: {report['candles']}, "
+          f"за {report['elapsed_sec']:.2f} сек")
+    for mode, result in report["modes"].items():
+        print(f"{mode} ({result['rule']}): сигналов {result['alerts']} "
+              f"({result['alert_rate'] * 100:.2f}% оценённых свечей)")
+        for level, row in result["per_level"].items():
+            print(f"  уровень {level}: {row['alerts']} сигналов из {row['candles']} свечей ({row['rate'] * 100:.2f}%)")
+        ranked = sorted(result["per_symbol"].items(), key=lambda x: -x[1]["alerts"])[:top]
+        print(f"  больше всего сигналов (топ-{len(ranked)}):")
+        for symbol, row in ranked:
+            print(f"    {symbol}: {row['alerts']} ({row['rate'] * 100:.2f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогон правил сигналов по историческим 5m свечам")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fetch = sub.add_parser("fetch", help="докачать архив свечей из Binance")
+    fetch.add_argument("symbols", nargs="+")
+    fetch.add_argument("--days", type=int, default=90)
+    run = sub.add_parser("run", help="прогнать правила")
+    run.add_argument("symbols", nargs="*", help="символы из архива (по умолчанию все)")
+    run.add_argument("--synthetic", type=int, help="вместо архива — N случайных символов")
+    run.add_argument("--days", type=int, default=365, help="дней для --synthetic")
+    run.add_argument("--refresh", type=int, default=REFRESH, help="пересчёт индекса порогов раз в N свечей")
+    run.add_argument("--min-samples", type=int, default=STATS_MIN_SAMPLES)
+    run.add_argument("--out", help="сохранить отчёт в JSON")
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        asyncio.run(fetch_archive(args.symbols, args.days))
+        return
+
+    data = synthetic_archive(args.synthetic, args.days) if args.synthetic else load_archive(args.symbols or None)
+    if not data:
+        print(f"Архив пуст: сначала python backtest.py fetch SYMBOL ... (папка {ARCHIVE_DIR})")
+        return
+    report = replay(data, refresh=args.refresh, min_samples=args.min_samples)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# bench.py
+# Нагрузочный прогон цикла: синтетические пользователи, фейковые Binance (REST/WS) и Telegram.
+# Меряет этапы цикла, доставку, память; результаты сохраняются для сравнения между версиями.
+#
+#   python bench.py --users 1000 10000 --symbols 300 --cycles 3
+#   python bench.py --users 10000 --mode ws --compare bench_results/прошлый.json
+#   python bench.py --replay data/symbol_cache.json --users 5000
+#   python bench.py --users 100000 --shards 4                  # рассылка в 4 процессах-воркерах
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+STAGES = ("fetch", "backfill", "history", "classify", "format", "delivery")
+INTERVAL_MS = 300_000
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон цикла планировщика")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000], help="размеры популяций")
+    parser.add_argument("--symbols", type=int, default=300, help="символов на рынке")
+    parser.add_argument("--subs", type=int, default=3, help="подписок на пользователя (макс. 5)")
+    parser.add_argument("--distribution", choices=["zipf", "uniform"], default="zipf",
+                        help="как пользователи выбирают монеты: zipf — мейджоры популярнее")
+    parser.add_argument("--top-share", type=float, default=0.3, help="доля пользователей с топом")
+    parser.add_argument("--modmarket-share", type=float, default=0.5, help="доля пользователей в modmarket")
+    parser.add_argument("--rule-share", type=float, default=0.0, help="доля пользователей со своим правилом /rule")
+    parser.add_argument("--cycles", type=int, default=3, help="циклов на популяцию (первый — прогрев)")
+    parser.add_argument("--mode", choices=["rest", "ws"], default="rest", help="источник свечей")
+    parser.add_argument("--replay", help="записанные свечи {symbol: [kline, ...]} (формат symbol_cache.json)")
+    parser.add_argument("--tg-rate", type=float, default=1000.0, help="лимит фейкового Telegram, сообщений/сек")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="задержка одной отправки, сек")
+    parser.add_argument("--shards", type=int, default=0, help="воркеров рассылки (shard.py), 0 — в одном процессе")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда сохранить результат (по умолчанию bench_results/<время>.json)")
+    parser.add_argument("--compare", help="прошлый результат для сравнения")
+    return parser.parse_args(argv)
+
+def make_symbols(count):
+    majors = ["BTCUSDT", "ETHUSDT", "SOLUSDT", "BNBUSDT", "XRPUSDT", "DOGEUSDT", "TRXUSDT", "ADAUSDT"]
+    symbols = majors[:count]
+    symbols += [f"SYN{i:04d}USDT" for i in range(count - len(symbols))]
+    return symbols
+
+# Правила для --rule-share: разные уровни, всплески, фильтры BTC и паузы
+BENCH_RULES = [
+    "level>=2 surge>1.5", "level>=4 btc=off", "level>=3 buy>=0.55 cooldown=30m",
+    "level>=1 surge>2 btc<=2", "level>=2 buy<=0.45 cooldown=15m",
+]
+
+def make_users(count, symbols, subs=3, distribution="zipf", top_share=0.3, modmarket_share=0.5, seed=1,
+               rule_share=0.0):
+    """Популяция в формате users.json"""
+    rnd = random.Random(seed)
+    if distribution == "zipf":
+        weights = [1.0 / (rank + 1) for rank in range(len(symbols))]
+    else:
+        weights = [1.0] * len(symbols)
+    users = {}
+    for i in range(count):
+        picked = []
+        while len(picked) < min(subs, 5, len(symbols)):
+            symbol = rnd.choices(symbols, weights)[0]
+            if symbol not in picked:
+                picked.append(symbol)
+        users[str(100_000 + i)] = {
+            "mode": "modmarket" if rnd.random() < modmarket_share else "modbag",
+            "symbols": picked,
+            "top_volatile": rnd.random() < top_share,
+        }
+        if rnd.random() < rule_share:
+            users[str(100_000 + i)]["rule"] = rnd.choice(BENCH_RULES)
+    return users
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: КБ
+
+async def wait_stream_idle(pipeline, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    await asyncio.sleep(0.05)
+    while pipeline.pending or pipeline._lock.locked() or pipeline._tasks:
+        if time.monotonic() > deadline:
+            raise TimeoutError("поток не обработал свечу")
+        await asyncio.sleep(0.01)
+
+async def run_population(args, users_count, fake, open_times):
+    # Импорты здесь: config читает DATA_DIR и прочее из окружения, которое выставляет main()
+    import storage
+    import notifier
+    import scheduler
+    from subscriptions import index
+    from fake_telegram import FakeBot
+    from analytics import compute_thresholds_from_klines
+
+    users = make_users(users_count, fake.symbols, args.subs, args.distribution,
+                       args.top_share, args.modmarket_share, args.seed, args.rule_share)
+    storage.save_users(users)  # индекс подписок обновляется через слушателей хранилища
+    storage.flush_users()
+    # Память сигналов прошлой популяции (те же chat_id и свечи) не должна глушить рассылку — индекс с нуля
+    index.rebuild(users)
+    # Пороги заранее, чтобы фоновый пересчёт не мешал замерам
+    storage.save_thresholds({
+        s: compute_thresholds_from_klines(fake.klines(s, "5m", 100, end_time=open_times[0])) for s in fake.symbols
+    })
+
+    bot = FakeBot(latency=args.tg_latency)
+    notifier.delivery = notifier.DeliveryQueue(bot=bot, global_rate=args.tg_rate, chat_rate=1000.0)
+
+    leader = None
+    if args.shards:
+        import shard
+        leader = shard.Leader(os.path.join(os.environ["DATA_DIR"], f"shard-{users_count}.sock"))
+        await leader.start()
+        await leader.spawn(args.shards, "--fake-telegram", "--wait-delivery")
+        await leader.wait_workers(args.shards)
+        scheduler.publisher = leader
+
+    server = stream = pipeline = None
+    if args.mode == "ws":
+        from fake_binance import FakeKlineServer
+        from ws_stream import KlineStream
+        server = await FakeKlineServer(fake).start()
+        pipeline = scheduler.StreamPipeline()
+        stream = KlineStream(pipeline.on_candle, url=server.url)
+
+    cycles = []
+    shard_sent = {}  # воркер -> отправлено сообщений к прошлому циклу
+    for n, open_time in enumerate(open_times):
+        fake.now_ms = open_time + INTERVAL_MS + 3000  # как планировщик: 3 сек после закрытия
+        requests_before = len(fake.requests)
+        sent_before = len(bot.sent)
+        notifier.delivery.first_enqueued = None
+        start = time.perf_counter()
+        if args.mode == "rest":
+            await scheduler.main_cycle(open_time)
+        else:
+            symbols = await pipeline.symbols()
+            await stream.set_symbols(symbols)
+            while not {f"{s.lower()}@kline_5m" for s in symbols} <= server.subscribed():
+                await asyncio.sleep(0.01)
+            start = time.perf_counter()
+            await asyncio.gather(*(server.push(s, open_time, closed=True) for s in symbols))
+            pushed = time.perf_counter() - start
+            await wait_stream_idle(pipeline)
+            scheduler.cycle_timings["fetch"] = pushed  # рассылка свечей сервером
+        cycle_time = time.perf_counter() - start
+        timings = dict(scheduler.cycle_timings)
+
+        shards = None
+        if leader is not None:
+            # Рассылка в воркерах: от начала fan_out шарда (его первой постановки) до опустошения
+            # его очереди, по самому медленному шарду
+            report = await leader.wait_report(leader._seq, timeout=600)
+            shards = report["shards"]
+            timings["delivery"] = max((r["delivered"] for r in shards.values()), default=0.0)
+            sent = sum(r["sent"] - shard_sent.get(name, 0) for name, r in shards.items())
+            shard_sent = {name: r["sent"] for name, r in shards.items()}
+        else:
+            # Рассылка: от первой постановки в очередь за цикл до её опустошения
+            await notifier.delivery.join(timeout=600)
+            first = notifier.delivery.first_enqueued
+            timings["delivery"] = time.monotonic() - first if first is not None else 0.0
+            sent = len(bot.sent) - sent_before
+        cycles.append({
+            "open_time": open_time,
+            "cycle": round(cycle_time, 4),
+            "stages": {k: round(v, 4) for k, v in timings.items()},
+            "messages": sent,
+            "msgs_per_sec": round(sent / timings["delivery"], 1) if timings["delivery"] > 0 else 0.0,
+            "binance_requests": len(fake.requests) - requests_before,
+            "shards": shards,
+        })
+        print(f"  users={users_count} цикл {n + 1}: {cycle_time:.3f} сек, сообщений {sent}, "
+              + ", ".join(f"{k} {v:.3f}" for k, v in timings.items()))
+
+    await notifier.delivery.stop(timeout=1)
+    if leader is not None:
+        await leader.stop()
+        scheduler.publisher = None
+    if stream is not None:
+        await stream.close()
+        await server.stop()
+
+    measured = cycles[1:] or cycles  # первый цикл — прогрев (загрузка тренда, кеши)
+    summary = {
+        stage: round(sum(c["stages"].get(stage, 0.0) for c in measured) / len(measured), 4)
+        for stage in STAGES
+    }
+    summary["cycle"] = round(sum(c["cycle"] for c in measured) / len(measured), 4)
+    delivery = sum(c["stages"].get("delivery", 0.0) for c in measured)
+    summary["msgs_per_sec"] = round(sum(c["messages"] for c in measured) / delivery, 1) if delivery > 0 else 0.0
+    return {"users": users_count, "summary": summary, "rss_mb": round(rss_mb(), 1), "cycles": cycles}
+
+def compare(result, baseline):
+    """Печатает изменение средних времён этапов относительно прошлого прогона"""
+    old = {run["users"]: run["summary"] for run in baseline.get("runs", [])}
+    for run in result["runs"]:
+        prev = old.get(run["users"])
+        if not prev:
+            continue
+        print(f"users={run['users']}:")
+        for key, value in run["summary"].items():
+            before = prev.get(key)
+            if not before:
+                continue
+            change = (value - before) / before * 100
+            print(f"  {key:>12}: {before:.4f} -> {value:.4f} ({change:+.1f}%)")
+
+async def bench(args):
+    import binance_api
+    from fake_binance import FakeBinance
+
+    symbols = make_symbols(args.symbols)
+    fake = FakeBinance(symbols, seed=args.seed)
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            recorded = json.load(f)
+        fake.load_recorded(recorded)
+        times = sorted({int(k[0]) for klines in recorded.values() for k in klines})
+        open_times = times[-args.cycles:]
+    else:
+        last = fake.now_ms - fake.now_ms % INTERVAL_MS - INTERVAL_MS
+        open_times = [last + i * INTERVAL_MS for i in range(args.cycles)]
+    fake.install()
+
+    result = {
+        "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": vars(args),
+        "python": sys.version.split()[0],
+        "runs": [],
+    }
+    for users_count in args.users:
+        result["runs"].append(await run_population(args, users_count, fake, open_times))
+        # Следующая популяция — на свежих свечах, чтобы не сработала защита от повторов
+        open_times = [t + len(open_times) * INTERVAL_MS for t in open_times]
+    await binance_api.close()
+    return result
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Всё хранилище — во временной папке, бот и рабочие данные не трогаем
+    os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="bench_")
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+    os.environ.setdefault("STREAM_SETTLE", "0.2")
+    os.environ["THRESHOLDS_REFRESH"] = str(10 ** 10)  # без фонового пересчёта порогов
+    os.environ["USERS_FLUSH_DELAY"] = "3600"
+    out = args.out or os.path.join("bench_results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+
+    result = asyncio.run(bench(args))
+
+    print("\nИтог (среднее без прогрева):")
+    for run in result["runs"]:
+        s = run["summary"]
+        print(f"users={run['users']:>6}: цикл {s['cycle']:.3f} сек | "
+              + " | ".join(f"{stage} {s[stage]:.3f}" for stage in STAGES)
+              + f" | {s['msgs_per_sec']:.0f} сообщ/сек | RSS {run['rss_mb']:.0f} МБ")
+
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Результат сохранён: {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
+
+if __name__ == "__main__":
+    main()
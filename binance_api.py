@@ -1,32 +1,134 @@
 # binance_api.py
-import requests
+import asyncio
 import time
-from config import BINANCE_REST
+import httpx
+from config import BINANCE_REST, BINANCE_MAX_CONNECTIONS, BINANCE_CONCURRENCY, CACHE_TICKER_TTL, CACHE_FORMING_TTL
+from rate_limiter import limiter, request_weight, PRIORITY_SIGNAL, PRIORITY_TOP, PRIORITY_BACKFILL
+from metrics import BINANCE_SECONDS, BINANCE_REQUESTS
+from cache import cache
 
 KLINES_ENDPOINT = BINANCE_REST + "/fapi/v1/klines"
 TICKER_24H_ENDPOINT = BINANCE_REST + "/fapi/v1/ticker/24hr"
+TIME_ENDPOINT = BINANCE_REST + "/fapi/v1/time"
+EXCHANGE_INFO_ENDPOINT = BINANCE_REST + "/fapi/v1/exchangeInfo"
 
-def get_klines(symbol: str, interval: str = "5m", limit: int = 1, end_time: int = None):
+MAX_RETRIES = 3  # повторы после 429
+INTERVAL_MS = {"1m": 60_000, "5m": 300_000, "15m": 900_000, "1h": 3_600_000, "4h": 14_400_000, "1d": 86_400_000}
+CACHE_MAX_LIMIT = 250  # большие выборки (история, пороги) не кешируем — они уникальны и тяжёлые
+
+# Метрики по эндпоинтам: метки разрешаем один раз
+_latency = {}
+_statuses = {}
+
+def _endpoint(url):
+    return url.rsplit("/fapi/v1/", 1)[-1]
+
+def _observe(url, status_code, seconds):
+    latency = _latency.get(url)
+    if latency is None:
+        latency = _latency[url] = BINANCE_SECONDS.labels(_endpoint(url))
+    latency.observe(seconds)
+    counter = _statuses.get((url, status_code))
+    if counter is None:
+        counter = _statuses[(url, status_code)] = BINANCE_REQUESTS.labels(_endpoint(url), status_code)
+    counter.inc()
+
+# Один клиент на весь процесс: keep-alive пул соединений вместо нового коннекта на каждый запрос
+_client = None
+_transport = None
+_semaphore = None
+
+def set_transport(transport):
+    """Подменяет транспорт httpx (например, httpx.MockTransport для офлайн-тестов)"""
+    global _transport, _client
+    _transport = transport
+    _client = None
+
+def _get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        limits = httpx.Limits(
+            max_connections=BINANCE_MAX_CONNECTIONS,
+            max_keepalive_connections=BINANCE_MAX_CONNECTIONS,
+            keepalive_expiry=60.0
+        )
+        _client = httpx.AsyncClient(timeout=10.0, limits=limits, transport=_transport)
+    return _client
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(BINANCE_CONCURRENCY)
+    return _semaphore
+
+async def close():
+    """Закрывает пул соединений (вызывать при остановке бота)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def _get_json(url, params=None, priority=PRIORITY_SIGNAL):
+    weight = request_weight(url, params)
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire(weight, priority)
+        async with _get_semaphore():
+            start = time.perf_counter()
+            response = await _get_client().get(url, params=params)
+            _observe(url, response.status_code, time.perf_counter() - start)
+        limiter.observe(response.status_code, response.headers)
+        # 429 — ждём Retry-After (лимитер уже на паузе) и повторяем; 418 — бан, не долбим
+        if response.status_code == 429 and attempt < MAX_RETRIES:
+            continue
+        response.raise_for_status()
+        return response.json()
+
+async def get_klines(symbol: str, interval: str = "5m", limit: int = 1, end_time: int = None,
+                     priority: int = PRIORITY_SIGNAL, start_time: int = None):
     """Получает свечи с Binance"""
     params = {"symbol": symbol.upper(), "interval": interval, "limit": limit}
     if end_time:
         params["endTime"] = end_time
+    if start_time:
+        params["startTime"] = start_time
     try:
-        response = requests.get(KLINES_ENDPOINT, params=params, timeout=10)
-        response.raise_for_status()
-        return response.json()
+        if start_time or limit > CACHE_MAX_LIMIT or interval not in INTERVAL_MS:
+            return await _get_json(KLINES_ENDPOINT, params, priority)
+        # Одинаковые запросы (цикл, /trend, снимок рынка) делят один ответ: закрытые свечи — надолго,
+        # с текущей — на CACHE_FORMING_TTL
+        key = ("klines", params["symbol"], interval, limit, end_time)
+        return await cache.get_or_load(key, lambda: _get_json(KLINES_ENDPOINT, params, priority),
+                                       ttl=_klines_ttl(interval, end_time))
     except Exception as e:
         print(f"Ошибка при получении klines для {symbol}: {e}")
         return []
 
-def get_recent_klines(symbol: str, interval: str = "5m", count: int = 4032):
+def _klines_ttl(interval, end_time=None):
+    """Сколько секунд ответ актуален: закрытые свечи не меняются, с текущей (формирующейся) — несколько секунд"""
+    step = INTERVAL_MS[interval]
+    now_ms = time.time() * 1000
+    if end_time and end_time < now_ms - now_ms % step:
+        return step / 1000
+    return CACHE_FORMING_TTL
+
+async def get_klines_many(symbols, interval: str = "5m", limit: int = 1, priority: int = PRIORITY_SIGNAL,
+                          end_time: int = None, start_time: int = None):
+    """Параллельно получает свечи для нескольких символов: {symbol: klines}"""
+    symbols = list(symbols)
+    results = await asyncio.gather(*(
+        get_klines(s, interval, limit, end_time, priority=priority, start_time=start_time) for s in symbols
+    ))
+    return dict(zip(symbols, results))
+
+async def get_recent_klines(symbol: str, interval: str = "5m", count: int = 4032,
+                            priority: int = PRIORITY_BACKFILL):
     """Получает последние N свечей (для истории или порогов)"""
     klines = []
     end_time = None
     remaining = count
     while remaining > 0:
         batch_limit = min(1000, remaining)
-        batch = get_klines(symbol, interval, batch_limit, end_time)
+        batch = await get_klines(symbol, interval, batch_limit, end_time, priority=priority)
         if not batch:
             break
         klines = batch + klines  # Добавляем в конец (API даёт старые сначала)
@@ -34,18 +136,59 @@ def get_recent_klines(symbol: str, interval: str = "5m", count: int = 4032):
             earliest_time = int(batch[0][0])
             end_time = earliest_time - 1
         remaining -= len(batch)
-        time.sleep(0.2)  # Задержка, чтобы не превысить лимиты API
     return klines[-count:] if len(klines) > count else klines
 
-def get_top_symbols(count: int = 100):
+async def get_klines_since(symbol: str, start_time: int, interval: str = "5m",
+                           priority: int = PRIORITY_BACKFILL):
+    """Все свечи начиная с start_time до текущей (страницами по 1000 вперёд)"""
+    klines = []
+    while True:
+        batch = await get_klines(symbol, interval, 1000, start_time=start_time, priority=priority)
+        if not batch:
+            break
+        klines.extend(batch)
+        if len(batch) < 1000:
+            break
+        start_time = int(batch[-1][0]) + 1
+    return klines
+
+async def get_server_time():
+    """Время сервера Binance (мс) или None"""
+    try:
+        data = await _get_json(TIME_ENDPOINT, priority=PRIORITY_SIGNAL)
+        return int(data["serverTime"])
+    except Exception as e:
+        print(f"Ошибка при получении времени Binance: {e}")
+        return None
+
+async def get_ticker_24h(priority: int = PRIORITY_TOP):
+    """24h-статистика всех фьючерсов одним запросом (вес 40)"""
+    try:
+        return await cache.get_or_load(
+            ("ticker_24h",), lambda: _get_json(TICKER_24H_ENDPOINT, priority=priority), ttl=CACHE_TICKER_TTL
+        )
+    except Exception as e:
+        print(f"Ошибка при получении ticker/24hr: {e}")
+        return []
+
+async def get_exchange_info(priority: int = PRIORITY_BACKFILL):
+    """Список контрактов со статусами и фильтрами (вес 1) или None"""
+    try:
+        return await _get_json(EXCHANGE_INFO_ENDPOINT, priority=priority)
+    except Exception as e:
+        print(f"Ошибка при получении exchangeInfo: {e}")
+        return None
+
+def top_by_quote_volume(tickers, count: int = 100):
+    """Топ-N USDT-символов по 24h quoteVolume из ответа ticker/24hr (count=None — все)"""
+    usdt_futures = [item for item in tickers if item["symbol"].endswith("USDT")]
+    sorted_symbols = sorted(usdt_futures, key=lambda x: float(x["quoteVolume"]), reverse=True)
+    return [item["symbol"] for item in sorted_symbols[:count]]
+
+async def get_top_symbols(count: int = 100, priority: int = PRIORITY_TOP):
     """Получает топ-N символов по 24h quoteVolume (только USDT-фьючерсы)"""
     try:
-        response = requests.get(TICKER_24H_ENDPOINT, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        usdt_futures = [item for item in data if item["symbol"].endswith("USDT")]
-        sorted_symbols = sorted(usdt_futures, key=lambda x: float(x["quoteVolume"]), reverse=True)
-        return [item["symbol"] for item in sorted_symbols[:count]]
+        return top_by_quote_volume(await get_ticker_24h(priority), count)
     except Exception as e:
         print(f"Ошибка при получении топ-символов: {e}")
         return []
@@ -5,9 +5,19 @@ import os
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 
-from config import TELEGRAM_TOKEN, ADMIN_ID, LOG_DIR
-from storage import get_user_data, update_user_data
-from scheduler import run_scheduler
+from config import TELEGRAM_TOKEN, ADMIN_ID, LOG_DIR, LOG_JSON, METRICS_PORT, SHARD_WORKERS, SNAPSHOT_INTERVAL
+from storage import get_user_data, update_user_data, flush_users, flush_candles
+from scheduler import run_scheduler, seed_quantiles, get_trend_status, warm_up
+from backfill import backfill
+import compute_thresholds
+import binance_api
+from notifier import delivery
+import metrics
+import shard
+from symbols import registry, normalize_base
+from rules import compile_rule, mode_rule
+import snapshot
+from cache import cache
 
 # Настройка логирования
 logging.basicConfig(
@@ -15,6 +25,9 @@ logging.basicConfig(
     level=logging.INFO,
     handlers=[logging.FileHandler(os.path.join(LOG_DIR, 'bot.log'))]
 )
+if LOG_JSON:
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(metrics.JsonFormatter())
 logger = logging.getLogger(__name__)
 
 async def start(update, context):
@@ -41,11 +54,34 @@ async def mode_callback(update, context):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.reply_text("Какой токен начнём отслеживать? (Нажми кнопку или используй /add<symbol>)", reply_markup=reply_markup)
 
+def unknown_symbol_text(text, suggestions):
+    """Ответ на несуществующий символ: с подсказками из справочника, если они есть"""
+    hint = f" Может, {', '.join(suggestions)}?" if suggestions else ""
+    return f"{normalize_base(text)}USDT нет среди фьючерсов Binance.{hint}"
+
+# Идущие догрузки истории: symbol -> задача (ссылка держит задачу до конца, повторный /add не дублирует)
+_warming = {}
+
+def _warmed(symbol, task):
+    _warming.pop(symbol, None)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Ошибка догрузки истории {symbol}: {task.exception()}")
+
+def warm_history(symbol):
+    """Новая монета: история догружается сразу, к ближайшему циклу окно уже полное"""
+    if backfill.is_warm(symbol) or symbol in _warming:
+        return
+    task = _warming[symbol] = asyncio.get_running_loop().create_task(warm_up([symbol]))
+    task.add_done_callback(lambda t: _warmed(symbol, t))
+
 async def add_symbol_callback(update, context):
     query = update.callback_query
     chat_id = query.message.chat_id
     symbol_lower = query.data.split('_')[1]
-    symbol = f"{symbol_lower.upper()}USDT"
+    symbol, suggestions = registry.resolve(symbol_lower)
+    if symbol is None:
+        await query.answer(unknown_symbol_text(symbol_lower, suggestions), show_alert=True)
+        return
     user_data = get_user_data(chat_id)
     symbols = user_data["symbols"]
     if symbol not in symbols:
@@ -56,6 +92,7 @@ async def add_symbol_callback(update, context):
         else:
             await query.answer(f"Добавлен {symbol}")
         update_user_data(chat_id, {"symbols": symbols})
+        warm_history(symbol)
     else:
         await query.answer(f"{symbol} уже добавлен")
     keyboard = [
@@ -65,6 +102,36 @@ async def add_symbol_callback(update, context):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.reply_text("Хотите получать топ-3 волатильных монет (15:00-21:00 МСК)?", reply_markup=reply_markup)
 
+def user_rule(user_data):
+    """Действующее правило пользователя: его /rule поверх правила режима"""
+    base = mode_rule(user_data.get("mode"))
+    try:
+        return compile_rule(user_data.get("rule"), base=base)
+    except ValueError:
+        return base
+
+async def set_rule(update, context):
+    chat_id = update.effective_chat.id
+    text = " ".join(context.args)
+    user_data = get_user_data(chat_id)
+    if not text:
+        await update.message.reply_text(
+            f"Правило: {user_rule(user_data).text}\n"
+            "Пример: /rule level>=2 surge>1.5 buy>=0.6 btc=off cooldown=30m\n/rule reset - правило режима"
+        )
+        return
+    if text.lower() == "reset":
+        update_user_data(chat_id, {"rule": ""})
+        await update.message.reply_text(f"Правило режима: {mode_rule(user_data.get('mode')).text}")
+        return
+    try:
+        rule = compile_rule(text, base=mode_rule(user_data.get("mode")))
+    except ValueError as e:
+        await update.message.reply_text(f"Ошибка в правиле: {e}")
+        return
+    update_user_data(chat_id, {"rule": text})
+    await update.message.reply_text(f"Правило установлено: {rule.text}")
+
 async def top_toggle(update, context):
     chat_id = update.effective_chat.id
     try:
@@ -84,7 +151,10 @@ async def top_toggle(update, context):
 async def add_symbol(update, context):
     chat_id = update.effective_chat.id
     symbol_lower = update.message.text.split('/add')[1].lower()
-    symbol = f"{symbol_lower.upper()}USDT"
+    symbol, suggestions = registry.resolve(symbol_lower)
+    if symbol is None:
+        await update.message.reply_text(unknown_symbol_text(symbol_lower, suggestions))
+        return
     user_data = get_user_data(chat_id)
     symbols = user_data["symbols"]
     if symbol not in symbols:
@@ -95,13 +165,14 @@ async def add_symbol(update, context):
         else:
             await update.message.reply_text(f"Добавлен {symbol}")
         update_user_data(chat_id, {"symbols": symbols})
+        warm_history(symbol)
     else:
         await update.message.reply_text(f"{symbol} уже в списке")
 
 async def remove_symbol(update, context):
     chat_id = update.effective_chat.id
     try:
-        symbol = context.args[0].upper() + "USDT"
+        symbol = normalize_base(context.args[0]) + "USDT"
     except IndexError:
         await update.message.reply_text("Укажи символ: /remove SOL")
         return
@@ -120,7 +191,8 @@ async def list_symbols(update, context):
     symbols = user_data["symbols"]
     mode = user_data["mode"]
     top = "включён" if user_data["top_volatile"] else "выключен"
-    text = f"Режим: {mode}\nТоп-3: {top}\nПодписки: {', '.join(symbols) if symbols else 'Нет'}"
+    rule = user_rule(user_data).text
+    text = f"Режим: {mode}\nТоп-3: {top}\nПравило: {rule}\nПодписки: {', '.join(symbols) if symbols else 'Нет'}"
     await update.message.reply_text(text)
 
 async def set_mode(update, context):
@@ -143,6 +215,14 @@ async def top_toggle(update, context):
     update_user_data(chat_id, {"top_volatile": value})
     await update.message.reply_text(f"Топ-3 {'включён' if value else 'выключен'}")
 
+async def trend_cmd(update, context):
+    text = context.args[0] if context.args else "BTC"
+    symbol, suggestions = registry.resolve(text)
+    if symbol is None:
+        await update.message.reply_text(unknown_symbol_text(text, suggestions))
+        return
+    await update.message.reply_text(f"Тренд {symbol}: {await get_trend_status(symbol)}")
+
 async def help_cmd(update, context):
     text = """
 Команды:
@@ -153,8 +233,10 @@ async def help_cmd(update, context):
 /modmarket - Режим 'Нагибаю рынок'
 /modbag - Режим 'Нагибаю портфель'
 /top on/off - Вкл/выкл топ-3
+/rule [условия] - Своё правило сигнала (пример: /rule level>=2 surge>1.5 cooldown=30m), /rule reset - как в режиме
+/trend [SYMBOL] - Тренд 4h/1h/15m (цена против SMA200), по умолчанию BTC
 /help - Это сообщение
-/recalc - Пересчитать пороги (только админ)
+/recalc [all] - Пересчитать пороги (только админ; all — все USDT-фьючерсы)
 """
     await update.message.reply_text(text)
 
@@ -163,14 +245,33 @@ async def recalc(update, context):
     if chat_id != ADMIN_ID:
         await update.message.reply_text("Доступно только админу")
         return
-    # Здесь вызовем логику пересчёта (пока заглушка, добавим позже)
-    await update.message.reply_text("Пороги пересчитаны (заглушка)")
+    all_symbols = bool(context.args) and context.args[0].lower() == "all"
+    await update.message.reply_text("Пересчёт порогов запущен...")
+    result = await compute_thresholds.run(all_symbols=all_symbols, on_symbol=seed_quantiles)
+    await update.message.reply_text(
+        f"Пороги пересчитаны: {result['updated']} из {result['symbols']}, ошибок {result['failed']}"
+    )
+
+async def on_shutdown(application):
+    try:
+        alerts = await snapshot.collect_alerts()  # шарды: последние сигналы у воркеров — забираем до остановки
+    except Exception as e:
+        print(f"Ошибка сбора сигналов шардов: {e}")
+        alerts = None
+    await shard.leader.stop()
+    await delivery.stop()
+    await cache.stop()
+    await binance_api.close()
+    flush_users()
+    flush_candles()
+    snapshot.save(alerts=alerts)
 
 def main():
     application = Application.builder().token(TELEGRAM_TOKEN) \
         .concurrent_updates(True) \
         .connection_pool_size(100) \
         .pool_timeout(90.0) \
+        .post_shutdown(on_shutdown) \
         .build()
 
     # Хендлеры команд
@@ -179,6 +280,8 @@ def main():
     application.add_handler(CommandHandler("modmarket", set_mode))
     application.add_handler(CommandHandler("modbag", set_mode))
     application.add_handler(CommandHandler("top", top_toggle))
+    application.add_handler(CommandHandler("rule", set_rule))
+    application.add_handler(CommandHandler("trend", trend_cmd))
     application.add_handler(CommandHandler("remove", remove_symbol))
     application.add_handler(CommandHandler("help", help_cmd))
     application.add_handler(CommandHandler("recalc", recalc))
@@ -190,8 +293,19 @@ def main():
     # Кастом /add<symbol>
     application.add_handler(MessageHandler(filters.Regex(r'^/add\w+$'), add_symbol))
 
-    # Запуск scheduler в фоне
-    asyncio.get_event_loop().create_task(run_scheduler())
+    # Тёплый старт: статистика, тренд и последняя свеча из снапшота — первый цикл догружает только разницу
+    snapshot.load()
+    asyncio.get_event_loop().create_task(registry.run_periodic())
+    if SNAPSHOT_INTERVAL:
+        asyncio.get_event_loop().create_task(snapshot.run_periodic())
+
+    # Запуск scheduler в фоне (с SHARD_WORKERS — лидер, рассылают процессы-воркеры)
+    if SHARD_WORKERS:
+        asyncio.get_event_loop().create_task(shard.run_leader(SHARD_WORKERS))
+    else:
+        asyncio.get_event_loop().create_task(run_scheduler())
+    if METRICS_PORT:
+        asyncio.get_event_loop().create_task(metrics.serve())
 
     application.run_polling()
 
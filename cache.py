@@ -1,29 +1,153 @@
 # cache.py
+# Кеш с TTL и LRU-вытеснением, фоновой чисткой и single-flight загрузкой (один запрос на ключ)
+import asyncio
 import time
+from collections import OrderedDict
 from threading import Lock
 
-class SimpleCache:
-    def __init__(self):
-        self._store = {}
+from config import CACHE_MAX_SIZE, CACHE_SWEEP_INTERVAL
+from metrics import CACHE_REQUESTS, CACHE_EVICTIONS, CallbackMetric
+
+class TTLCache:
+    """Не больше maxsize записей; при переполнении уходит самая давно использованная.
+
+    get_or_load(key, coro_fn, ttl): если ключа нет, coro_fn() выполняется один раз,
+    а все одновременные запросы того же ключа ждут этот же результат.
+    Ошибки загрузки не кешируются и достаются всем ожидающим.
+    """
+
+    def __init__(self, maxsize=CACHE_MAX_SIZE, default_ttl=300, name="default"):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.name = name
+        self._store = OrderedDict()  # key -> (expiry, value)
         self._lock = Lock()
+        self._inflight = {}  # key -> asyncio.Future
+        self._sweeper = None
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "shared": 0, "evicted": 0, "expired": 0}
+        self._hits = CACHE_REQUESTS.labels(name, "hit")
+        self._misses = CACHE_REQUESTS.labels(name, "miss")
+        self._evicted = CACHE_EVICTIONS.labels(name, "lru")
+        self._expired = CACHE_EVICTIONS.labels(name, "ttl")
 
-    def set(self, key, value, ttl=300):  # ttl в секундах, default 5 мин
-        with self._lock:
-            self._store[key] = {"value": value, "expiry": time.time() + ttl}
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return self.get(key, _count=False) is not None
 
-    def get(self, key):
+    def get(self, key, _count=True):
+        now = time.monotonic()
         with self._lock:
             item = self._store.get(key)
-            if not item:
-                return None
-            if item["expiry"] < time.time():
+            if item is not None and item[0] < now:
                 del self._store[key]
+                self.stats["expired"] += 1
+                self._expired.inc()
+                item = None
+            if item is None:
+                if _count:
+                    self.stats["misses"] += 1
+                    self._misses.inc()
                 return None
-            return item["value"]
+            self._store.move_to_end(key)
+            if _count:
+                self.stats["hits"] += 1
+                self._hits.inc()
+            return item[1]
+
+    def set(self, key, value, ttl=None):  # ttl в секундах
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            self._store[key] = (time.monotonic() + ttl, value)
+            self._store.move_to_end(key)
+            while len(self._store) > self.maxsize:
+                self._store.popitem(last=False)
+                self.stats["evicted"] += 1
+                self._evicted.inc()
+
+    def delete(self, key):
+        with self._lock:
+            self._store.pop(key, None)
 
     def clear(self):
         with self._lock:
             self._store.clear()
 
-# Глобальный кеш
-cache = SimpleCache()
\ No newline at end of file
+    async def get_or_load(self, key, coro_fn, ttl=None):
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            self._ensure_sweeper()
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            self.stats["shared"] += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Отменили загружавшего (например, таймаут его клиента), а не нас — загрузку берёт следующий
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await coro_fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+                future.exception()  # чтобы не было «exception was never retrieved», если ждущих нет
+            raise
+        else:
+            self.stats["loads"] += 1
+            if value is not None:
+                self.set(key, value, ttl)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def sweep(self):
+        """Удаляет просроченные записи (не дожидаясь, пока их кто-то запросит)"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expiry, _) in self._store.items() if expiry < now]
+            for key in expired:
+                del self._store[key]
+        if expired:
+            self.stats["expired"] += len(expired)
+            self._expired.inc(len(expired))
+        return len(expired)
+
+    def _ensure_sweeper(self):
+        loop = asyncio.get_running_loop()
+        if self._sweeper is None or self._sweeper.done() or self._sweeper.get_loop() is not loop:
+            self._sweeper = loop.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+            self.sweep()
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats["size"] = len(self._store)
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
+
+# Глобальный кеш: свечи, ticker/24hr, тренд
+cache = TTLCache()
+CallbackMetric("itrader_cache_size", "Записей в кеше", lambda: len(cache))
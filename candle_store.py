@@ -0,0 +1,212 @@
+# candle_store.py
+# Компактная история свечей: кольцевые буферы NumPy по колонкам вместо списков строк
+import json
+import os
+import time
+import numpy as np
+
+# Колонки float64 и их индексы в kline из REST /fapi/v1/klines
+COLUMNS = ("open", "high", "low", "close", "volume", "quote_volume", "trades", "taker_buy", "taker_buy_quote")
+KLINE_INDEX = (1, 2, 3, 4, 5, 7, 8, 9, 10)
+COL = {name: i for i, name in enumerate(COLUMNS)}
+
+INTERVAL_MS = 300_000  # 5 минут, для восстановления close_time
+
+def parse_kline(kline):
+    """kline из REST/WS -> (open_time, массив значений колонок)"""
+    row = np.zeros(len(COLUMNS))
+    for i, idx in enumerate(KLINE_INDEX):
+        try:
+            row[i] = float(kline[idx])
+        except (IndexError, ValueError, TypeError):
+            row[i] = 0.0
+    if len(kline) <= 7:  # нет quoteVolume — как в quote_volume_from_kline
+        row[COL["quote_volume"]] = row[COL["volume"]] * row[COL["close"]]
+    return int(kline[0]), row
+
+class CandleWindow:
+    """Окно из последних свечей: колонки — представления (view) без копирования"""
+    __slots__ = ("open_time",) + COLUMNS
+
+    def __init__(self, open_time, values):
+        self.open_time = open_time
+        for name, i in COL.items():
+            setattr(self, name, values[i])
+
+    def __len__(self):
+        return len(self.open_time)
+
+    def to_klines(self):
+        """Обратно в формат REST (для JSON и старого кода)"""
+        klines = []
+        for j, t in enumerate(self.open_time):
+            t = int(t)
+            klines.append([
+                t, str(self.open[j]), str(self.high[j]), str(self.low[j]), str(self.close[j]),
+                str(self.volume[j]), t + INTERVAL_MS - 1, str(self.quote_volume[j]),
+                int(self.trades[j]), str(self.taker_buy[j]), str(self.taker_buy_quote[j]), "0"
+            ])
+        return klines
+
+class CandleBuffer:
+    """Кольцевой буфер фиксированной ёмкости.
+
+    Данные лежат дважды (позиции i и i + capacity), поэтому любое окно
+    до capacity свечей — непрерывный срез: append O(1), окно без копирования.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._time = np.zeros(2 * capacity, dtype=np.int64)
+        self._values = np.zeros((len(COLUMNS), 2 * capacity), dtype=np.float64)
+        self._head = 0  # куда пишем следующую свечу
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def last_open_time(self):
+        if not self.count:
+            return None
+        return int(self._time[(self._head - 1) % self.capacity])
+
+    def _write(self, pos, open_time, row):
+        self._time[pos] = self._time[pos + self.capacity] = open_time
+        self._values[:, pos] = row
+        self._values[:, pos + self.capacity] = row
+
+    def append(self, kline):
+        """Добавляет свечу; та же open_time — обновляет последнюю, более старые игнорируются"""
+        open_time, row = parse_kline(kline)
+        self.append_row(open_time, row)
+
+    def append_row(self, open_time, row):
+        last = self.last_open_time
+        if last is not None and open_time == last:
+            self._write((self._head - 1) % self.capacity, open_time, row)
+        elif last is None or open_time > last:
+            self._write(self._head, open_time, row)
+            self._head = (self._head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def load(self, times, values):
+        """Заполняет буфер заново готовыми колонками (values — (колонка, свеча)) без поштучного append"""
+        n = min(len(times), self.capacity)
+        times, values = times[len(times) - n:], values[:, len(times) - n:]
+        for start in (0, self.capacity):
+            self._time[start:start + n] = times
+            self._values[:, start:start + n] = values
+        self._head = n % self.capacity
+        self.count = n
+
+    def merge(self, klines):
+        """Вставляет свечи в любое место окна (догрузка дыр): та же open_time — заменяется новой,
+        в буфере остаются последние capacity свечей по времени"""
+        if not klines:
+            return
+        parsed = [parse_kline(k) for k in klines]
+        w = self.window()
+        times = np.concatenate([np.array([t for t, _ in parsed], dtype=np.int64), w.open_time])
+        values = np.concatenate([np.array([row for _, row in parsed]).T, [getattr(w, n) for n in COLUMNS]], axis=1)
+        times, first = np.unique(times, return_index=True)  # первое вхождение — из новых свечей
+        self.load(times, values[:, first])
+
+    def window(self, n=None):
+        """Последние n свечей (по умолчанию все) как CandleWindow из view"""
+        n = self.count if n is None else min(n, self.count)
+        start = (self._head - n) % self.capacity
+        return CandleWindow(self._time[start:start + n], self._values[:, start:start + n])
+
+    def to_klines(self):
+        return self.window().to_klines()
+
+class CandleStore:
+    """Буферы по символам + сохранение в один .npy (можно открыть через mmap)"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffers = {}
+
+    def __contains__(self, symbol):
+        return symbol in self._buffers
+
+    def symbols(self):
+        return list(self._buffers)
+
+    def get(self, symbol):
+        buf = self._buffers.get(symbol)
+        if buf is None:
+            buf = self._buffers[symbol] = CandleBuffer(self.capacity)
+        return buf
+
+    def append_many(self, candles):
+        """candles: {symbol: kline} или {symbol: [kline, ...]}"""
+        for symbol, klines in candles.items():
+            if klines and not isinstance(klines[0], list):
+                klines = [klines]
+            buf = self.get(symbol)
+            for kline in klines:
+                buf.append(kline)
+
+    @classmethod
+    def from_klines(cls, cache, capacity):
+        store = cls(capacity)
+        store.append_many({s: k for s, k in cache.items() if k})
+        return store
+
+    def to_klines(self):
+        return {symbol: buf.to_klines() for symbol, buf in self._buffers.items()}
+
+    def replace(self, symbol, buffer):
+        self._buffers[symbol] = buffer
+
+    def export_state(self):
+        """(meta, {"data": массив (символ, колонка, свеча)}): open_time в колонке 0"""
+        symbols = self.symbols()
+        data = np.zeros((len(symbols), len(COLUMNS) + 1, self.capacity), dtype=np.float64)
+        counts = []
+        for i, symbol in enumerate(symbols):
+            w = self._buffers[symbol].window()
+            n = len(w)
+            data[i, 0, :n] = w.open_time  # open_time < 2^53, в float64 точно
+            for j, name in enumerate(COLUMNS):
+                data[i, j + 1, :n] = getattr(w, name)
+            counts.append(n)
+        return {"symbols": symbols, "counts": counts, "capacity": self.capacity}, {"data": data}
+
+    @classmethod
+    def from_state(cls, meta, arrays, capacity):
+        data = arrays["data"]
+        store = cls(capacity)
+        for i, (symbol, n) in enumerate(zip(meta["symbols"], meta["counts"])):
+            block = data[i, :, max(0, n - capacity):n]
+            store.get(symbol).load(block[0].astype(np.int64), block[1:])
+        return store
+
+    def save(self, path):
+        """Пишет массив (символ, колонка, свеча) в .npy и список символов рядом в .json"""
+        self.write(path, *self.export_state())
+
+    @staticmethod
+    def write(path, meta, arrays):
+        """Данные — в новый .npy рядом, затем один os.replace переключает на него .json:
+        пара файлов меняется атомарно (после сбоя — либо старая, либо новая), старые данные удаляются.
+        Можно вызывать в потоке: meta и arrays — готовая копия из export_state"""
+        directory, name = os.path.split(path)
+        data_file = f"{name}.{time.time_ns()}.npy"
+        np.save(os.path.join(directory, data_file), arrays["data"])
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump({**meta, "file": data_file}, f)
+        os.replace(path + ".json.tmp", path + ".json")
+        for old in os.listdir(directory or "."):
+            if old != data_file and (old == name or old.startswith(name + ".") and old.endswith(".npy")):
+                os.remove(os.path.join(directory, old))
+
+    @classmethod
+    def load(cls, path, capacity):
+        """Читает .npy через mmap (без чтения всего файла) и раскладывает по буферам"""
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        data_path = os.path.join(os.path.dirname(path), meta["file"]) if "file" in meta else path
+        return cls.from_state(meta, {"data": np.load(data_path, mmap_mode="r")}, capacity)
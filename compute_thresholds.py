@@ -1,27 +1,144 @@
 # compute_thresholds.py
-import json
-from config import THRESHOLDS_FILE
-from binance_api import get_recent_klines
-from analytics import compute_thresholds_from_klines
+import argparse
+import asyncio
+import os
+import time
+import numpy as np
+
+from config import THRESHOLDS_STATE_DIR, THRESHOLDS_CONCURRENCY
+from storage import save_threshold, load_users
+from binance_api import get_recent_klines, get_klines_since, get_top_symbols, close
+from analytics import compute_thresholds_from_vols
+from symbols import registry
 
 # Базовые символы для старта (можно расширить)
 BASE_SYMBOLS = ["BTCUSDT", "ETHUSDT", "SOLUSDT", "TRXUSDT"]
 
-def main():
-    thresholds = {}
-    for symbol in BASE_SYMBOLS:
-        print(f"Загрузка 14-дневной истории для {symbol}...")
-        klines = get_recent_klines(symbol, count=4032)  # 14 дней * 24 * 12 = 4032
-        if klines:
-            thresh = compute_thresholds_from_klines(klines)
-            thresholds[symbol] = thresh
-            print(f"Пороги для {symbol}: {thresh}")
-        else:
+WINDOW = 4032  # 14 дней * 24 * 12
+INTERVAL_MS = 300_000
+
+# Чекпоинт по символу: ряд (open_time, волатильность) закрытых свечей за последние 14 дней.
+# Прерванный прогон продолжается с того же места, повторный — докачивает только новые свечи
+def _state_path(symbol):
+    return os.path.join(THRESHOLDS_STATE_DIR, f"{symbol}.npy")
+
+def load_state(symbol):
+    path = _state_path(symbol)
+    if not os.path.exists(path):
+        return None
+    try:
+        return np.load(path)
+    except Exception as e:
+        print(f"Повреждён чекпоинт {path}: {e}")
+        return None
+
+def save_state(symbol, state):
+    path = _state_path(symbol)
+    tmp = path + ".tmp.npy"
+    np.save(tmp, state)
+    os.replace(tmp, path)
+
+def klines_to_state(klines):
+    """Свечи -> массив (n, 2): open_time, волатильность (high - low) / open * 100"""
+    arr = np.array([[float(k[0]), float(k[1]), float(k[2]), float(k[3])] for k in klines], dtype=np.float64)
+    open_p = arr[:, 1]
+    safe_open = np.where(open_p > 0, open_p, 1.0)
+    vol = np.where(open_p > 0, (arr[:, 2] - arr[:, 3]) / safe_open * 100.0, 0.0)
+    return np.column_stack([arr[:, 0], vol])
+
+async def update_symbol(symbol, now_ms):
+    """Обновляет чекпоинт символа; возвращает ряд или None, если данных нет"""
+    state = load_state(symbol)
+    if state is not None and len(state):
+        last = int(state[-1, 0])
+        if now_ms - last < 2 * INTERVAL_MS:
+            return state  # уже актуален (например, прогон прервали после этого символа)
+        klines = await get_klines_since(symbol, last + INTERVAL_MS)
+    else:
+        last = -1
+        state = None
+        klines = await get_recent_klines(symbol, count=WINDOW + 1)
+
+    klines = [k for k in klines if int(k[6]) < now_ms]  # только закрытые свечи
+    if klines:
+        new = klines_to_state(klines)
+        new = new[new[:, 0] > last]
+        state = new if state is None else np.vstack([state, new])
+    if state is None or not len(state):
+        return None
+    state = state[-WINDOW:]
+    save_state(symbol, state)
+    return state
+
+# Один пересчёт за раз: /recalc и фоновый пересчёт планировщика не пишут пороги одновременно
+_run_lock = asyncio.Lock()
+
+def subscribed_symbols():
+    """Базовые символы + все, на которые подписаны пользователи"""
+    symbols = set(BASE_SYMBOLS)
+    for data in load_users().values():
+        symbols.update(data.get("symbols", []))
+    return symbols
+
+async def run(symbols=None, all_symbols=False, concurrency=THRESHOLDS_CONCURRENCY, on_symbol=None):
+    """Пересчитывает пороги параллельно (в рамках лимита веса Binance).
+
+    symbols — список символов (по умолчанию подписки пользователей), all_symbols — все
+    USDT-фьючерсы. Порог каждого символа сохраняется сразу (upsert одной записи).
+    on_symbol(symbol, state) — колбэк с готовым рядом волатильности.
+    Если пересчёт уже идёт, ждёт его окончания.
+    """
+    async with _run_lock:
+        return await _run(symbols, all_symbols, concurrency, on_symbol)
+
+async def _run(symbols, all_symbols, concurrency, on_symbol):
+    if all_symbols:
+        symbols = await get_top_symbols(count=100_000)  # все USDT-фьючерсы из ticker/24hr
+    elif symbols is None:
+        symbols = subscribed_symbols()
+    symbols = sorted(set(registry.filter_trading(symbols)))  # снятые с торгов не качаем
+    os.makedirs(THRESHOLDS_STATE_DIR, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    now_ms = int(time.time() * 1000)
+    result = {"symbols": len(symbols), "updated": 0, "failed": 0}
+
+    async def one(symbol):
+        # Ошибка одного символа не прерывает остальные: он просто попадает в failed
+        async with semaphore:
+            try:
+                state = await update_symbol(symbol, now_ms)
+            except Exception as e:
+                print(f"Ошибка пересчёта порогов для {symbol}: {e}")
+                state = None
+        if state is None:
             print(f"Не удалось загрузить данные для {symbol}")
-    
-    with open(THRESHOLDS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(thresholds, f, ensure_ascii=False, indent=4)
-    print(f"Пороги сохранены в {THRESHOLDS_FILE}")
+            result["failed"] += 1
+            return
+        try:
+            await save_threshold(symbol, compute_thresholds_from_vols(state[:, 1]))  # готовый символ сразу в хранилище
+            if on_symbol:
+                on_symbol(symbol, state)
+        except Exception as e:
+            print(f"Ошибка сохранения порогов для {symbol}: {e}")
+            result["failed"] += 1
+            return
+        result["updated"] += 1
+
+    await asyncio.gather(*(one(s) for s in symbols))
+    return result
+
+async def main():
+    parser = argparse.ArgumentParser(description="Пересчёт порогов волатильности Q25/Q50/Q75 за 14 дней")
+    parser.add_argument("symbols", nargs="*", help="символы (по умолчанию — подписки пользователей)")
+    parser.add_argument("--all", action="store_true", help="все USDT-фьючерсы")
+    args = parser.parse_args()
+
+    start = time.time()
+    result = await run(args.symbols or None, all_symbols=args.all)
+    print(f"Пороги сохранены: {result['updated']} из {result['symbols']}, "
+          f"ошибок {result['failed']}, за {time.time() - start:.1f} сек")
+    await close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
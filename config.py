@@ -8,9 +8,25 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 if not TELEGRAM_TOKEN:
     raise ValueError("Не найден TELEGRAM_TOKEN в .env")
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "20"))  # соединений для рассылки
+TELEGRAM_WORKERS = int(os.getenv("TELEGRAM_WORKERS", "16"))  # воркеров очереди рассылки
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "28"))  # сообщений/сек на бота (лимит ~30)
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # сообщений/сек в один чат
 
 # Binance API
 BINANCE_REST = os.getenv("BINANCE_REST", "https://fapi.binance.com")
+BINANCE_MAX_CONNECTIONS = int(os.getenv("BINANCE_MAX_CONNECTIONS", "20"))  # размер keep-alive пула
+BINANCE_CONCURRENCY = int(os.getenv("BINANCE_CONCURRENCY", "10"))  # одновременных запросов максимум
+BINANCE_WEIGHT_LIMIT = int(os.getenv("BINANCE_WEIGHT_LIMIT", "2000"))  # вес в минуту (у Binance 2400, держим запас)
+BINANCE_WS = os.getenv("BINANCE_WS", "wss://fstream.binance.com")
+
+# Источник свечей: rest — опрос раз в 5 минут, ws — поток свечей через WebSocket
+INGESTION_MODE = os.getenv("INGESTION_MODE", "rest").lower()
+STREAMS_PER_CONNECTION = int(os.getenv("STREAMS_PER_CONNECTION", "200"))
+STREAM_SETTLE = float(os.getenv("STREAM_SETTLE", "2"))  # сек ожидания остальных символов после закрытия свечи
+STREAM_INTRA_CANDLE = os.getenv("STREAM_INTRA_CANDLE", "false").lower() == "true"  # сигналы до закрытия свечи
+STREAM_INTRA_INTERVAL = float(os.getenv("STREAM_INTRA_INTERVAL", "30"))  # не чаще раза в N сек
+STREAM_RESUBSCRIBE_INTERVAL = float(os.getenv("STREAM_RESUBSCRIBE_INTERVAL", "30"))  # сверка подписок с users.json
 
 # Папки
 DATA_DIR = os.getenv("DATA_DIR", "data")
@@ -24,4 +40,69 @@ os.makedirs(LOG_DIR, exist_ok=True)
 # Пути к файлам с данными
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 THRESHOLDS_FILE = os.path.join(DATA_DIR, "thresholds.json")
-SYMBOL_CACHE_FILE = os.path.join(DATA_DIR, "symbol_cache.json")
\ No newline at end of file
+SYMBOL_CACHE_FILE = os.path.join(DATA_DIR, "symbol_cache.json")
+SYMBOL_CACHE_NPY = os.path.join(DATA_DIR, "symbol_cache.npy")
+
+# Пользователи пишутся на диск отложенно, не чаще раза в N сек
+USERS_FLUSH_DELAY = float(os.getenv("USERS_FLUSH_DELAY", "2"))
+
+# История свечей (JSON-хранилище) пишется на диск отложенно, в потоке, не чаще раза в N сек
+CANDLES_FLUSH_DELAY = float(os.getenv("CANDLES_FLUSH_DELAY", "30"))
+
+# Хранилище: json — файлы в DATA_DIR, sqlite — одна база (WAL), JSON переносится при первом старте
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_FILE = os.path.join(DATA_DIR, "bot.db")
+HISTORY_SIZE = 72  # свечей в окне среднего объёма
+STATS_MIN_SAMPLES = int(os.getenv("STATS_MIN_SAMPLES", "288"))  # свечей до перехода на скользящие квантили (сутки)
+
+# Пересчёт порогов: чекпоинты по символам, параллельность, как часто обновлять из планировщика
+THRESHOLDS_STATE_DIR = os.path.join(DATA_DIR, "thresholds_state")
+THRESHOLDS_CONCURRENCY = int(os.getenv("THRESHOLDS_CONCURRENCY", "8"))
+THRESHOLDS_REFRESH = int(os.getenv("THRESHOLDS_REFRESH", "86400"))  # сек, раз в сутки
+
+# Планировщик: через сколько секунд после закрытия свечи запускать цикл, как часто сверять часы с Binance
+SCHEDULER_OFFSET = float(os.getenv("SCHEDULER_OFFSET", "3"))
+CLOCK_SYNC_INTERVAL = float(os.getenv("CLOCK_SYNC_INTERVAL", "3600"))
+
+# Топ волатильных: сколько монет, из какой части рынка (0 — все USDT-фьючерсы, иначе топ-N по 24h объёму), фильтры
+TOP_N = int(os.getenv("TOP_N", "3"))
+TOP_UNIVERSE = int(os.getenv("TOP_UNIVERSE", "0"))
+TOP_MIN_QUOTE_VOLUME = float(os.getenv("TOP_MIN_QUOTE_VOLUME", "0"))  # мин. 24h оборот, USDT
+TOP_MIN_SURGE = float(os.getenv("TOP_MIN_SURGE", "0"))  # мин. объём свечи к среднему 5m за сутки
+
+# Метрики: порт для /metrics (0 — выключено) и JSON-логи
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LOG_JSON = os.getenv("LOG_JSON", "false").lower() == "true"
+
+# Кеш: максимум записей, как часто чистить просроченные (сек), TTL ticker/24hr
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "2048"))
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", "60"))
+CACHE_TICKER_TTL = float(os.getenv("CACHE_TICKER_TTL", "60"))
+# Свечи с ещё не закрытой (текущей) свечой: объём и цена меняются, кешируем на несколько секунд
+CACHE_FORMING_TTL = float(os.getenv("CACHE_FORMING_TTL", "5"))
+
+# Бэктест: архив 5m свечей (<SYMBOL>.npy) для backtest.py
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(DATA_DIR, "archive"))
+
+# Шарды: сколько процессов-воркеров рассылки запускает бот (0 — всё в одном процессе), сокет лидера
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_SOCKET = os.getenv("SHARD_SOCKET", os.path.join(DATA_DIR, "shard.sock"))
+SHARD_REPORT_TIMEOUT = float(os.getenv("SHARD_REPORT_TIMEOUT", "60"))  # сек ожидания отчёта шарда о цикле
+
+# Снапшот состояния для тёплого перезапуска: файл, как часто писать (сек, 0 — только при остановке),
+# старше какого возраста не восстанавливать
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", os.path.join(DATA_DIR, "state.snap"))
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", str(6 * 3600)))
+
+# Справочник контрактов (exchangeInfo): локальная копия и как часто обновлять (сек)
+SYMBOLS_FILE = os.path.join(DATA_DIR, "exchange_info.json")
+SYMBOLS_REFRESH = float(os.getenv("SYMBOLS_REFRESH", "3600"))
+
+# Правила сигналов режимов по умолчанию (пользователь меняет своё командой /rule), см. rules.py
+RULE_MODBAG = os.getenv("RULE_MODBAG", "level>=3 btc>=3 surge>1")
+RULE_MODMARKET = os.getenv("RULE_MODMARKET", "level>=3 btc>=3 surge>1")
+
+# Догрузка дыр в истории свечей: вес Binance на один проход (остальное — в следующем цикле)
+BACKFILL_WEIGHT_BUDGET = int(os.getenv("BACKFILL_WEIGHT_BUDGET", "600"))
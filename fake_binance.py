@@ -0,0 +1,181 @@
+# fake_binance.py
+# Локальный мок Binance REST и WebSocket для офлайн-проверок (без сети)
+import asyncio
+import json
+import random
+import httpx
+import websockets
+
+import binance_api
+from rate_limiter import request_weight
+
+INTERVAL_MS = {"1m": 60_000, "5m": 300_000, "15m": 900_000, "1h": 3_600_000, "4h": 14_400_000}
+
+class FakeBinance:
+    """Генерирует детерминированные свечи и отвечает на запросы как fapi.binance.com"""
+
+    def __init__(self, symbols, now_ms=1_700_000_000_000, seed=42):
+        self.symbols = list(symbols)
+        self.now_ms = now_ms
+        self.seed = seed
+        self.requests = []  # журнал (path, params) для проверок
+        self.used_weight = 0  # вес за «минуту» (сбрасывается вручную)
+        self.fail_with = []  # коды ответов для следующих запросов (например, [429])
+        self.recorded = {}  # (symbol, interval, open_time) -> записанная свеча
+        self.status = {}  # symbol -> статус контракта в exchangeInfo (по умолчанию TRADING)
+
+    def load_recorded(self, klines_by_symbol, interval="5m"):
+        """Подкладывает записанные свечи {symbol: [kline, ...]} (формат symbol_cache.json) вместо генерации"""
+        for symbol, klines in klines_by_symbol.items():
+            if symbol not in self.symbols:
+                self.symbols.append(symbol)
+            for kline in klines:
+                self.recorded[(symbol, interval, int(kline[0]))] = kline
+
+    def make_kline(self, symbol, interval, open_time):
+        recorded = self.recorded.get((symbol, interval, open_time))
+        if recorded is not None:
+            return recorded
+        rnd = random.Random(f"{self.seed}:{symbol}:{interval}:{open_time}")
+        base = 10 + (sum(map(ord, symbol)) % 500)
+        open_p = base * (1 + rnd.uniform(-0.01, 0.01))
+        high = open_p * (1 + rnd.uniform(0, 0.02))
+        low = open_p * (1 - rnd.uniform(0, 0.02))
+        close = rnd.uniform(low, high)
+        volume = rnd.uniform(100, 10_000)
+        quote_volume = volume * close
+        taker_buy = volume * rnd.uniform(0.2, 0.8)
+        step = INTERVAL_MS[interval]
+        return [
+            open_time, f"{open_p:.4f}", f"{high:.4f}", f"{low:.4f}", f"{close:.4f}",
+            f"{volume:.3f}", open_time + step - 1, f"{quote_volume:.2f}", rnd.randint(10, 1000),
+            f"{taker_buy:.3f}", f"{taker_buy * close:.2f}", "0"
+        ]
+
+    def klines(self, symbol, interval="5m", limit=500, end_time=None, start_time=None):
+        step = INTERVAL_MS[interval]
+        last_open = (self.now_ms // step) * step
+        if end_time is not None:
+            last_open = min(last_open, (end_time // step) * step)
+        first_open = last_open - (limit - 1) * step
+        if start_time is not None:
+            first_open = max(first_open, -(-start_time // step) * step)
+            last_open = min(last_open, first_open + (limit - 1) * step)
+        return [self.make_kline(symbol, interval, t) for t in range(first_open, last_open + 1, step)]
+
+    def ticker_24h(self):
+        return [
+            {"symbol": s, "quoteVolume": f"{(i + 1) * 1_000_000:.2f}"}
+            for i, s in enumerate(reversed(self.symbols))
+        ]
+
+    def exchange_info(self):
+        return {"symbols": [
+            {
+                "symbol": s, "baseAsset": s[:-4], "quoteAsset": "USDT", "contractType": "PERPETUAL",
+                "status": self.status.get(s, "TRADING"), "pricePrecision": 4, "quantityPrecision": 3,
+                "filters": [
+                    {"filterType": "PRICE_FILTER", "tickSize": "0.0001"},
+                    {"filterType": "LOT_SIZE", "stepSize": "0.001"},
+                    {"filterType": "MIN_NOTIONAL", "notional": "5"},
+                ],
+            }
+            for s in self.symbols
+        ]}
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        params = dict(request.url.params)
+        self.requests.append((request.url.path, params))
+        path = request.url.path
+        if self.fail_with:
+            status = self.fail_with.pop(0)
+            return httpx.Response(status, headers={"Retry-After": "1"}, json={"code": -1003, "msg": "Too many requests"})
+        self.used_weight += request_weight(path, params)
+        headers = {"X-MBX-USED-WEIGHT-1M": str(self.used_weight)}
+        if path == "/fapi/v1/klines":
+            symbol = params.get("symbol", "")
+            if symbol not in self.symbols:
+                return httpx.Response(400, json={"code": -1121, "msg": "Invalid symbol."})
+            data = self.klines(
+                symbol, params.get("interval", "5m"), int(params.get("limit", 500)),
+                end_time=int(params["endTime"]) if "endTime" in params else None,
+                start_time=int(params["startTime"]) if "startTime" in params else None
+            )
+            return httpx.Response(200, headers=headers, content=json.dumps(data))
+        if path == "/fapi/v1/time":
+            return httpx.Response(200, headers=headers, json={"serverTime": self.now_ms})
+        if path == "/fapi/v1/exchangeInfo":
+            return httpx.Response(200, headers=headers, content=json.dumps(self.exchange_info()))
+        if path == "/fapi/v1/ticker/24hr":
+            return httpx.Response(200, headers=headers, content=json.dumps(self.ticker_24h()))
+        return httpx.Response(404, json={"code": -1, "msg": "Not found"})
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    def install(self):
+        """Подключает мок к binance_api вместо реальной сети"""
+        binance_api.set_transport(self.transport())
+        return self
+
+class FakeKlineServer:
+    """Локальный WebSocket-сервер, имитирующий combined streams fstream.binance.com"""
+
+    def __init__(self, fake: FakeBinance, host="127.0.0.1", port=0):
+        self.fake = fake
+        self.host = host
+        self.port = port
+        self.subscriptions = {}  # connection -> set(stream)
+        self.messages = []  # все полученные SUBSCRIBE/UNSUBSCRIBE
+        self._server = None
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await websockets.serve(self._handler, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handler(self, connection):
+        self.subscriptions[connection] = set()
+        try:
+            async for raw in connection:
+                msg = json.loads(raw)
+                self.messages.append(msg)
+                streams = self.subscriptions[connection]
+                if msg.get("method") == "SUBSCRIBE":
+                    streams.update(msg["params"])
+                elif msg.get("method") == "UNSUBSCRIBE":
+                    streams.difference_update(msg["params"])
+                await connection.send(json.dumps({"result": None, "id": msg.get("id")}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.subscriptions.pop(connection, None)
+
+    def subscribed(self):
+        return set().union(*self.subscriptions.values()) if self.subscriptions else set()
+
+    async def push(self, symbol, open_time, closed=True, interval="5m"):
+        """Рассылает свечу подписанным соединениям в формате kline-события"""
+        kline = self.fake.make_kline(symbol, interval, open_time)
+        name = f"{symbol.lower()}@kline_{interval}"
+        event = {"stream": name, "data": {"e": "kline", "E": kline[6], "s": symbol, "k": {
+            "t": kline[0], "T": kline[6], "s": symbol, "i": interval,
+            "o": kline[1], "c": kline[4], "h": kline[2], "l": kline[3], "v": kline[5],
+            "n": kline[8], "x": closed, "q": kline[7], "V": kline[9], "Q": kline[10], "B": "0"
+        }}}
+        payload = json.dumps(event)
+        await asyncio.gather(*(
+            conn.send(payload) for conn, streams in list(self.subscriptions.items()) if name in streams
+        ), return_exceptions=True)
+
+    async def drop_connections(self):
+        """Рвёт все соединения (проверка переподключения)"""
+        await asyncio.gather(*(conn.close() for conn in list(self.subscriptions)), return_exceptions=True)
@@ -0,0 +1,29 @@
+# fake_telegram.py
+# Фейковый Telegram Bot для офлайн-проверок рассылки (без сети)
+import asyncio
+import time
+from telegram.error import RetryAfter, Forbidden
+
+class FakeBot:
+    """Записывает отправленные сообщения; умеет имитировать 429 и заблокированных пользователей"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency  # имитация задержки сети, сек
+        self.sent = []  # (chat_id, text, monotonic)
+        self.retry_after = []  # очередь секунд для следующих RetryAfter
+        self.blocked = set()  # chat_id, заблокировавшие бота
+
+    async def send_message(self, chat_id, text, parse_mode=None, disable_notification=False, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_after:
+            raise RetryAfter(self.retry_after.pop(0))
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.sent.append((chat_id, text, time.monotonic()))
+
+    def by_chat(self):
+        result = {}
+        for chat_id, text, _ in self.sent:
+            result.setdefault(chat_id, []).append(text)
+        return result
@@ -0,0 +1,100 @@
+# market.py
+# Снимок рынка на текущую 5-минутную свечу: свечи символов + 24h-статистика всего рынка.
+# Живёт до границы свечи, все потребители цикла берут данные отсюда, а не из REST
+import asyncio
+import time
+
+from binance_api import get_klines_many, get_ticker_24h, top_by_quote_volume
+from rate_limiter import PRIORITY_SIGNAL, PRIORITY_TOP
+
+INTERVAL_MS = 300_000
+
+class MarketSnapshot:
+    """Свечи {symbol: kline} и тикеры {symbol: ticker} для одной свечи.
+
+    ticker/24hr по всему рынку — один запрос на свечу. Свечи приходят из
+    WebSocket (update_kline), а в REST-режиме докачиваются только те, которых
+    ещё нет в снимке: повторные запросы в пределах свечи идут из памяти.
+    """
+
+    def __init__(self, interval_ms=INTERVAL_MS):
+        self.interval_ms = interval_ms
+        self.open_time = None  # open_time свечи, к которой относится снимок
+        self.klines = {}
+        self.tickers = {}
+        self._tickers_open_time = None
+        self._lock = asyncio.Lock()
+        self.requests = 0  # сколько REST-запросов сделал снимок (для отладки)
+
+    @staticmethod
+    def _now_ms():
+        return int(time.time() * 1000)
+
+    def candle_open(self, now_ms=None):
+        now_ms = self._now_ms() if now_ms is None else now_ms
+        return now_ms - now_ms % self.interval_ms
+
+    @property
+    def expires_at(self):
+        """Момент (мс), когда снимок устаревает — граница следующей свечи"""
+        return (self.open_time or 0) + self.interval_ms
+
+    def _roll(self, now_ms=None):
+        open_time = self.candle_open(now_ms)
+        if open_time != self.open_time:
+            self.open_time = open_time
+            self.klines = {}
+
+    def update_kline(self, symbol, kline):
+        """Свеча из потока; устаревшие (предыдущая свеча) в снимок не попадают"""
+        if self.open_time is None or int(kline[0]) > self.open_time:
+            self._roll(int(kline[0]))
+        if int(kline[0]) == self.open_time:
+            self.klines[symbol] = kline
+
+    async def refresh_tickers(self, priority=PRIORITY_TOP):
+        """ticker/24hr по всему рынку, не чаще раза в свечу"""
+        open_time = self.candle_open()
+        async with self._lock:
+            if self._tickers_open_time == open_time and self.tickers:
+                return self.tickers
+            data = await get_ticker_24h(priority)
+            self.requests += 1
+            if data:
+                self.tickers = {item["symbol"]: item for item in data}
+                self._tickers_open_time = open_time
+        return self.tickers
+
+    async def top_symbols(self, count=30):
+        """Топ-count USDT-символов по 24h объёму; count=None — все"""
+        tickers = await self.refresh_tickers()
+        return top_by_quote_volume(tickers.values(), count)
+
+    def quote_volume_24h(self, symbol):
+        ticker = self.tickers.get(symbol)
+        return float(ticker["quoteVolume"]) if ticker else 0.0
+
+    def quote_volumes(self):
+        """{symbol: quoteVolume за 24h} по всему рынку"""
+        return {s: float(t["quoteVolume"]) for s, t in self.tickers.items()}
+
+    async def get_klines(self, symbols, priority=PRIORITY_SIGNAL, open_time=None):
+        """Свечи символов: что есть в снимке — из памяти, остальное одним пакетом из REST.
+
+        open_time — конкретная (например, только что закрытая) свеча, по умолчанию текущая.
+        """
+        self._roll(open_time)
+        end_time = open_time + self.interval_ms - 1 if open_time is not None else None
+        result = {s: self.klines[s] for s in symbols if s in self.klines}
+        missing = [s for s in symbols if s not in result]
+        if missing:
+            fetched = await get_klines_many(missing, limit=1, priority=priority, end_time=end_time)
+            self.requests += len(missing)
+            for symbol, klines in fetched.items():
+                if klines:
+                    result[symbol] = klines[-1]
+                    self.update_kline(symbol, klines[-1])
+        return result
+
+# Глобальный снимок рынка
+market = MarketSnapshot()
@@ -0,0 +1,207 @@
+# metrics.py
+# Метрики в формате Prometheus (/metrics) и структурные JSON-логи.
+# Метки разрешаются заранее (labels() -> дочерняя метрика), на горячем пути — только сложение
+import asyncio
+import json
+import logging
+import time
+from bisect import bisect_left
+
+from config import METRICS_HOST, METRICS_PORT, LOG_JSON
+
+# Секунды: от микросекунд (классификация) до минут (доставка, медленный цикл)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        registry.register(self)
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values):
+        """Дочерняя метрика для набора меток — получать один раз и хранить"""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {child.value}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {child.sum}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+class CallbackMetric(_Metric):
+    """Значение берётся функцией в момент запроса /metrics (глубина очереди и т.п.)"""
+
+    def __init__(self, name, help_text, fn, kind="gauge"):
+        self.kind = kind
+        self.fn = fn
+        super().__init__(name, help_text)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Ошибка метрики {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# Метрики бота
+CYCLE_SECONDS = Histogram("itrader_cycle_seconds", "Длительность цикла обработки свечи")
+STAGE_SECONDS = Histogram("itrader_cycle_stage_seconds", "Длительность этапов цикла", ["stage"])
+BINANCE_SECONDS = Histogram("itrader_binance_request_seconds", "Задержка запросов к Binance", ["endpoint"])
+BINANCE_REQUESTS = Counter("itrader_binance_requests_total", "Запросы к Binance по коду ответа", ["endpoint", "status"])
+BINANCE_WEIGHT = Gauge("itrader_binance_weight_used", "Вес за минуту по X-MBX-USED-WEIGHT-1M")
+CACHE_REQUESTS = Counter("itrader_cache_requests_total", "Обращения к кешу", ["cache", "result"])
+CACHE_EVICTIONS = Counter("itrader_cache_evictions_total", "Вытеснено из кеша (lru) и просрочено (ttl)", ["cache", "reason"])
+STORAGE_SECONDS = Histogram("itrader_storage_seconds", "Чтение/запись хранилища", ["op"])
+SHARD_SECONDS = Histogram("itrader_shard_cycle_seconds", "Рассылка цикла в шарде (воркере)", ["shard"])
+ALERTS = Counter("itrader_alerts_total", "Отправленные сигналы по уровню волатильности", ["level"])
+
+# Структурные логи: одна JSON-строка на событие (LOG_JSON=true)
+event_log = logging.getLogger("itrader.events")
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        return json.dumps(data, ensure_ascii=False)
+
+def log_event(event, **fields):
+    """Событие с полями в JSON-лог; без LOG_JSON ничего не делает"""
+    if LOG_JSON:
+        event_log.info(event, extra={"fields": fields})
+
+# HTTP /metrics на asyncio, без отдельного веб-фреймворка
+async def _handle(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass  # заголовки не нужны
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = registry.render().encode()
+            status = "200 OK"
+        else:
+            body = b"Not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        print(f"Ошибка /metrics: {e}")
+    finally:
+        writer.close()
+
+async def serve(host=METRICS_HOST, port=METRICS_PORT):
+    """Запускает /metrics; возвращает asyncio.Server (порт 0 в конфиге — выключено)"""
+    server = await asyncio.start_server(_handle, host, port)
+    print(f"Метрики: http://{host}:{server.sockets[0].getsockname()[1]}/metrics")
+    return server
+
+START_TIME = time.time()
+CallbackMetric("itrader_uptime_seconds", "Время работы процесса", lambda: round(time.time() - START_TIME, 1))
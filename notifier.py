@@ -1,21 +1,226 @@
 # notifier.py
+import asyncio
+import time
+from collections import deque
 from telegram import Bot
 from telegram.constants import ParseMode
-from config import TELEGRAM_TOKEN
+from telegram.error import RetryAfter, Forbidden, BadRequest
+from telegram.request import HTTPXRequest
+from config import TELEGRAM_TOKEN, TELEGRAM_POOL_SIZE, TELEGRAM_WORKERS, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE
 from analytics import get_level_emoji
+from rate_limiter import TokenBucket
+from metrics import CallbackMetric
 
-bot = Bot(token=TELEGRAM_TOKEN)
+bot = Bot(token=TELEGRAM_TOKEN, request=HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+
+MAX_MESSAGE_LEN = 4096  # лимит Telegram на одно сообщение
+MAX_ATTEMPTS = 3  # попыток на сетевые ошибки
+
+def _merge(texts):
+    """Склеивает сигналы одного чата в сообщения не длиннее лимита Telegram"""
+    messages, current = [], ""
+    for text in texts:
+        candidate = f"{current}\n\n{text}" if current else text
+        if len(candidate) > MAX_MESSAGE_LEN and current:
+            messages.append(current)
+            current = text
+        else:
+            current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+class DeliveryQueue:
+    """Очередь исходящих сообщений с пулом воркеров.
+
+    Общий лимит ~30 сообщений/сек и 1 сообщение/сек на чат. Всё, что накопилось
+    для чата, пока он ждал своей очереди, уходит одним сообщением. На 429
+    ждём retry_after и повторяем, на сетевые ошибки — до MAX_ATTEMPTS попыток.
+    """
+
+    def __init__(self, bot=bot, workers=TELEGRAM_WORKERS,
+                 global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE):
+        self.bot = bot
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_interval = 1.0 / chat_rate
+        self._pending = {}  # chat_id -> deque[(text, enqueued_at, disable_notification)]
+        self._next_allowed = {}  # chat_id -> monotonic, когда чату можно следующее сообщение
+        self._sending = set()  # chat_id, которым сообщение уходит прямо сейчас
+        self._ready = None  # asyncio.Queue chat_id
+        self._tasks = []
+        self._in_flight = 0
+        self.first_enqueued = None  # monotonic первой постановки с момента сброса в None (окно рассылки в bench.py)
+        self.metrics = {
+            "enqueued": 0, "sent": 0, "failed": 0, "retries": 0, "coalesced": 0,
+            "latency_sum": 0.0, "latency_max": 0.0,
+        }
+
+    @property
+    def depth(self):
+        """Сообщений в очереди (ещё не отправлено)"""
+        return sum(len(q) for q in self._pending.values())
+
+    def snapshot(self):
+        m = dict(self.metrics)
+        m["queue_depth"] = self.depth
+        m["latency_avg"] = m["latency_sum"] / m["sent"] if m["sent"] else 0.0
+        return m
+
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        for chat_id in self._pending:  # то, что накопили до старта
+            self._ready.put_nowait(chat_id)
+
+    def enqueue(self, chat_id, text, disable_notification=False):
+        self.enqueue_many([chat_id], text, disable_notification)
+
+    def enqueue_many(self, chat_ids, text, disable_notification=False):
+        """Ставит один текст в очередь всем chat_ids, не дожидаясь отправки"""
+        self._ensure_started()
+        now = time.monotonic()
+        if self.first_enqueued is None and chat_ids:
+            self.first_enqueued = now
+        for chat_id in chat_ids:
+            queue = self._pending.get(chat_id)
+            if queue is None:
+                queue = self._pending[chat_id] = deque()
+                self._ready.put_nowait(chat_id)
+            queue.append((text, now, disable_notification))
+            self.metrics["enqueued"] += 1
+
+    def _requeue_later(self, chat_id, delay):
+        if chat_id in self._sending:
+            delay = max(delay, self.chat_interval)  # чат занят — раньше конца отправки не вернётся
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            self._in_flight += 1
+            try:
+                await self._deliver(chat_id)
+            except Exception as e:
+                print(f"Ошибка доставки {chat_id}: {e}")
+            finally:
+                self._in_flight -= 1
+                self._ready.task_done()
+
+    async def _deliver(self, chat_id):
+        if chat_id in self._sending:
+            self._requeue_later(chat_id, self.chat_interval)  # второй воркер в тот же чат не идёт
+            return
+        wait = self._next_allowed.get(chat_id, 0.0) - time.monotonic()
+        if wait > 0:
+            self._requeue_later(chat_id, wait)  # не держим воркер, пока чат «остывает»
+            return
+        if not self._pending.get(chat_id):
+            return  # уже отправлено другим заходом
+        # Слот чата занят до первого await: пришедшее во время отправки ждёт своей очереди
+        self._sending.add(chat_id)
+        self._next_allowed[chat_id] = time.monotonic() + self.chat_interval
+        try:
+            await self._send(chat_id)
+        finally:
+            self._sending.discard(chat_id)
+            self._next_allowed[chat_id] = time.monotonic() + self.chat_interval
+
+        # Хвост длинной пачки и то, что пришло во время отправки, — следующим заходом
+        if chat_id in self._pending:
+            self._requeue_later(chat_id, self.chat_interval)
+
+    async def _send(self, chat_id):
+        """Всё накопленное для чата — одним сообщением (длинное — первая часть, хвост обратно в очередь)"""
+        await self.global_bucket.acquire()
+
+        items = list(self._pending.pop(chat_id, ()))
+        if not items:
+            return
+        messages = _merge([text for text, _, _ in items])
+        self.metrics["coalesced"] += len(items) - len(messages)
+        silent = all(item[2] for item in items)
+        oldest = min(item[1] for item in items)
+
+        text = messages[0]
+        rest = [(m, oldest, silent) for m in messages[1:]]
+        attempt = 0
+        while True:
+            try:
+                await self.bot.send_message(
+                    chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+                    disable_notification=silent
+                )
+                break
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self.metrics["retries"] += 1
+                self.global_bucket.pause(retry_after)  # флуд-контроль действует на весь бот
+                await asyncio.sleep(retry_after)
+            except (Forbidden, BadRequest) as e:
+                # Бот заблокирован или чат не существует — повтор не поможет
+                print(f"Сообщение {chat_id} не доставлено: {e}")
+                self.metrics["failed"] += 1
+                text = None
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt >= MAX_ATTEMPTS:
+                    print(f"Ошибка отправки сообщения {chat_id}: {e}")
+                    self.metrics["failed"] += 1
+                    text = None
+                    break
+                self.metrics["retries"] += 1
+                await asyncio.sleep(2 ** attempt)
+
+        if text is not None:
+            latency = time.monotonic() - oldest
+            self.metrics["sent"] += 1
+            self.metrics["latency_sum"] += latency
+            self.metrics["latency_max"] = max(self.metrics["latency_max"], latency)
+        if rest:
+            queue = self._pending.setdefault(chat_id, deque())
+            queue.extendleft(reversed(rest))
+
+    async def join(self, timeout=None):
+        """Ждёт, пока очередь опустеет (для тестов и остановки)"""
+        async def drained():
+            while self._pending or self._in_flight:
+                await asyncio.sleep(0.05)
+        await asyncio.wait_for(drained(), timeout)
+
+    async def stop(self, timeout=10.0):
+        if not self._tasks:
+            return
+        try:
+            await self.join(timeout)
+        except asyncio.TimeoutError:
+            print(f"Не отправлено при остановке: {self.depth} сообщений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+# Глобальная очередь рассылки
+delivery = DeliveryQueue()
+
+# Состояние очереди в /metrics (берётся в момент запроса)
+CallbackMetric("itrader_telegram_queue_depth", "Сообщений в очереди рассылки", lambda: delivery.depth)
+CallbackMetric("itrader_telegram_sent_total", "Отправлено сообщений", lambda: delivery.metrics["sent"], "counter")
+CallbackMetric("itrader_telegram_failed_total", "Не доставлено сообщений", lambda: delivery.metrics["failed"], "counter")
+CallbackMetric("itrader_telegram_retries_total", "Повторы отправки (429, сеть)", lambda: delivery.metrics["retries"], "counter")
+CallbackMetric("itrader_telegram_latency_avg_seconds", "Средняя задержка от постановки до отправки",
+               lambda: delivery.snapshot()["latency_avg"])
 
 async def send_message(chat_id: int, text: str, disable_notification=False):
-    try:
-        await bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode=ParseMode.HTML,
-            disable_notification=disable_notification
-        )
-    except Exception as e:
-        print(f"Ошибка отправки сообщения {chat_id}: {e}")
+    """Старый интерфейс: ставит сообщение в общую очередь (лимиты и повторы — её)"""
+    delivery.enqueue(chat_id, text, disable_notification)
+
+def send_many(chat_ids, text, disable_notification=False):
+    """Ставит один и тот же текст в очередь всем chat_ids (отправка в фоне)"""
+    delivery.enqueue_many(chat_ids, text, disable_notification)
 
 def format_volume_info(volume_5m, taker_buy_volume, avg_volume):
     volume_str = f"{int(volume_5m):,}".replace(",", " ")
@@ -34,8 +239,67 @@ def format_signal(symbol, vol_pct, level, volume_5m, taker_buy_volume, avg_volum
 
     return text
 
-def format_top_3(top_vols):
-    text = "<b>Топ-3 волатильных монет сейчас:</b>\n"
-    for sym, vol in top_vols:
-        text += f"• {sym}: {vol:.2f}%\n"
-    return text
\ No newline at end of file
+def format_signal_market(symbol, vol_pct, level, volume_5m, taker_buy_volume, avg_volume, btc_vol_pct, btc_level):
+    """modmarket: сначала состояние рынка (BTC), потом монета"""
+    pair_emoji = get_level_emoji(level)
+    btc_emoji = get_level_emoji(btc_level)
+
+    text = f"BTC volatility 5 min: {btc_vol_pct:.2f}% {btc_emoji}\n"
+    text += f"<b>{symbol}</b>: {vol_pct:.2f}% {pair_emoji}\n"
+    text += format_volume_info(volume_5m, taker_buy_volume, avg_volume)
+
+    return text
+
+def format_top(top_vols):
+    """top_vols: [(symbol, vol_pct, level, surge), ...] из ranking"""
+    text = f"<b>Топ-{len(top_vols)} волатильных монет сейчас:</b>\n"
+    for sym, vol, level, surge in top_vols:
+        text += f"• {sym}: {vol:.2f}%"
+        if level:
+            text += f" {get_level_emoji(level)}"
+        if surge == surge:  # не NaN
+            text += f" x{surge:.1f}"
+        text += "\n"
+    return text
+
+def format_top_message(trend_text, top_vols):
+    return f"<b>Тренд BTC:</b> {trend_text}\n\n" + format_top(top_vols)
+
+# Шаблоны по режимам пользователя: вид сообщения -> функция форматирования
+TEMPLATES = {
+    "modbag": {"signal": format_signal, "top": format_top_message},
+    "modmarket": {"signal": format_signal_market, "top": format_top_message},
+}
+
+class RenderCache:
+    """Готовые тексты на один цикл: (вид, symbol, open_time, mode) -> текст.
+
+    Каждое сообщение форматируется один раз, все получатели с тем же режимом
+    получают ту же строку. Сбрасывается в начале каждого цикла.
+    """
+
+    def __init__(self):
+        self._texts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._texts)
+
+    def clear(self):
+        self._texts.clear()
+
+    def render(self, kind, symbol, open_time, mode, params):
+        """params — аргументы шаблона, используются только при первом рендере"""
+        key = (kind, symbol, open_time, mode)
+        text = self._texts.get(key)
+        if text is None:
+            templates = TEMPLATES.get(mode, TEMPLATES["modbag"])
+            text = self._texts[key] = templates[kind](**params)
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+# Глобальный кеш отрисовки
+render_cache = RenderCache()
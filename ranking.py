@@ -0,0 +1,95 @@
+# ranking.py
+# Кросс-секционный рейтинг: последние свечи всего рынка в массивах NumPy, топ-N за один проход
+import numpy as np
+
+from analytics import determine_levels
+from threshold_index import thresholds_index
+
+CANDLES_PER_DAY = 288  # 5m свечей в сутках — для среднего объёма из ticker/24hr
+
+class CrossSection:
+    """Последняя свеча каждого символа: строки массивов, а не словари"""
+
+    def __init__(self, capacity=512):
+        self.symbols = []
+        self._row = {}
+        # open_time, open, high, low, quote_volume
+        self._data = np.zeros((capacity, 5), dtype=np.float64)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def _grow(self, n):
+        if n > len(self._data):
+            data = np.zeros((max(n, 2 * len(self._data)), 5), dtype=np.float64)
+            data[:len(self._data)] = self._data
+            self._data = data
+
+    def update(self, candles):
+        """candles: {symbol: kline} — обычно current_data цикла"""
+        new = [s for s in candles if s not in self._row]
+        if new:
+            self._grow(len(self.symbols) + len(new))
+            for symbol in new:
+                self._row[symbol] = len(self.symbols)
+                self.symbols.append(symbol)
+        if not candles:
+            return
+        rows = np.fromiter((self._row[s] for s in candles), dtype=np.int64, count=len(candles))
+        values = np.array(
+            [(k[0], k[1], k[2], k[3], k[7] if len(k) > 7 else 0) for k in candles.values()],
+            dtype=np.float64
+        )
+        self._data[rows] = values
+
+    def rank(self, n=3, universe=None, volume_24h=None, min_quote_volume=0.0, min_surge=0.0, min_level=0,
+             thresholds=None):
+        """Топ-n по волатильности текущей свечи: [(symbol, vol_pct, level, surge), ...].
+
+        universe — какие символы рассматривать (по умолчанию все); volume_24h —
+        {symbol: quoteVolume за 24h}: по нему считается всплеск объёма
+        (объём свечи / средний 5m объём за сутки) и фильтр ликвидности.
+        thresholds(symbols) -> матрица (n, 3) порогов уровней (по умолчанию — индекс порогов),
+        чтобы уровни топа совпадали с уровнями сигналов. Уровень 0 — порогов для символа нет.
+        """
+        count = len(self.symbols)
+        if not count or n <= 0:
+            return []
+        data = self._data[:count]
+        open_time, open_p, high, low, quote_volume = data.T
+        symbols = np.array(self.symbols)
+
+        mask = open_time == open_time.max()  # только символы с текущей свечой
+        if universe is not None:
+            wanted = set(universe)
+            mask &= np.fromiter((s in wanted for s in self.symbols), dtype=bool, count=count)
+
+        vols = np.divide((high - low) * 100.0, open_p, out=np.zeros(count), where=open_p > 0)
+        surge = np.full(count, np.nan)
+        if volume_24h is not None:
+            day = np.fromiter((volume_24h.get(s, 0.0) for s in self.symbols), dtype=np.float64, count=count)
+            np.divide(quote_volume, day / CANDLES_PER_DAY, out=surge, where=day > 0)
+            if min_quote_volume > 0:
+                mask &= day >= min_quote_volume
+        if min_surge > 0:
+            mask &= np.nan_to_num(surge) >= min_surge
+
+        matrix = (thresholds or thresholds_index.matrix)(self.symbols)
+        levels = np.where(matrix.any(axis=1), determine_levels(vols, self.symbols, matrix), 0)
+        if min_level > 0:
+            mask &= levels >= min_level
+
+        idx = np.flatnonzero(mask)
+        if not len(idx):
+            return []
+        if len(idx) > n:
+            idx = idx[np.argpartition(-vols[idx], n - 1)[:n]]
+        idx = idx[np.argsort(-vols[idx], kind="stable")]
+
+        return [
+            (s, float(v), int(l), float(g))
+            for s, v, l, g in zip(symbols[idx].tolist(), vols[idx], levels[idx], surge[idx])
+        ]
+
+# Глобальный срез рынка
+cross_section = CrossSection()
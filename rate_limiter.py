@@ -0,0 +1,165 @@
+# rate_limiter.py
+# Учёт веса запросов Binance (token bucket) + очередь по приоритетам
+import asyncio
+import heapq
+import itertools
+import time
+
+from config import BINANCE_WEIGHT_LIMIT
+from metrics import BINANCE_WEIGHT
+
+# Приоритеты: меньше — раньше
+PRIORITY_SIGNAL = 0    # монеты подписчиков (сигналы)
+PRIORITY_TOP = 1       # скан топ-30 и тренд
+PRIORITY_BACKFILL = 2  # догрузка истории и пересчёт порогов
+
+WEIGHT_WINDOW = 60.0  # лимит Binance считается за минуту
+DEFAULT_BAN = 60.0    # если Binance не прислал Retry-After
+
+def klines_weight(params):
+    """Вес /fapi/v1/klines зависит от limit"""
+    limit = int((params or {}).get("limit", 500))
+    if limit < 100:
+        return 1
+    elif limit < 500:
+        return 2
+    elif limit <= 1000:
+        return 5
+    return 10
+
+def ticker_24h_weight(params):
+    """/fapi/v1/ticker/24hr: 1 с symbol, 40 без (весь рынок)"""
+    return 1 if (params or {}).get("symbol") else 40
+
+ENDPOINT_WEIGHTS = {
+    "/fapi/v1/klines": klines_weight,
+    "/fapi/v1/ticker/24hr": ticker_24h_weight,
+}
+
+def request_weight(path, params=None):
+    """Вес запроса по пути эндпоинта (неизвестные эндпоинты считаем за 1)"""
+    for endpoint, weight_fn in ENDPOINT_WEIGHTS.items():
+        if path.endswith(endpoint):
+            return weight_fn(params)
+    return 1
+
+class WeightLimiter:
+    def __init__(self, capacity=BINANCE_WEIGHT_LIMIT, window=WEIGHT_WINDOW):
+        self.capacity = capacity
+        self.rate = capacity / window  # пополнение веса в секунду
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._banned_until = 0.0
+        self._waiters = []  # heap: (priority, seq, weight, future)
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def pending(self):
+        return len(self._waiters)
+
+    async def acquire(self, weight=1, priority=PRIORITY_SIGNAL):
+        """Ждёт, пока в бакете хватит веса; запросы с меньшим priority идут первыми"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), min(weight, self.capacity), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._banned_until:
+                await asyncio.sleep(self._banned_until - now)
+                continue
+            priority, seq, weight, future = self._waiters[0]
+            if future.done():  # ожидающий отменён
+                heapq.heappop(self._waiters)
+                continue
+            self._refill()
+            if self._tokens >= weight:
+                heapq.heappop(self._waiters)
+                self._tokens -= weight
+                future.set_result(None)
+                continue
+            await asyncio.sleep((weight - self._tokens) / self.rate)
+
+    def sync_used_weight(self, used):
+        """Подгоняет бакет под X-MBX-USED-WEIGHT-1M (сервер знает точнее)"""
+        self._refill()
+        self._tokens = min(self._tokens, float(self.capacity - used))
+
+    def ban(self, seconds):
+        """Останавливает все запросы на seconds (429/418)"""
+        self._banned_until = max(self._banned_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+    def observe(self, status_code, headers):
+        """Разбирает ответ: вес из заголовков, бэкофф на 429/418"""
+        used = headers.get("X-MBX-USED-WEIGHT-1M") or headers.get("X-MBX-USED-WEIGHT")
+        if used is not None:
+            try:
+                self.sync_used_weight(int(used))
+                BINANCE_WEIGHT.set(int(used))
+            except ValueError:
+                pass
+        if status_code in (418, 429):
+            try:
+                retry_after = float(headers.get("Retry-After", DEFAULT_BAN))
+            except ValueError:
+                retry_after = DEFAULT_BAN
+            self.ban(retry_after)
+            kind = "IP забанен" if status_code == 418 else "превышен лимит"
+            print(f"Binance {status_code}: {kind}, пауза {retry_after:.0f} сек")
+
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, запас не больше capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, n=1):
+        """Сколько секунд ждать, пока наберётся n токенов"""
+        self._refill()
+        wait = max(0.0, self._paused_until - time.monotonic())
+        if self._tokens < n:
+            wait = max(wait, (n - self._tokens) / self.rate)
+        return wait
+
+    def take(self, n=1):
+        if self.delay(n) > 0:
+            return False
+        self._tokens -= n
+        return True
+
+    async def acquire(self, n=1):
+        while not self.take(n):
+            await asyncio.sleep(self.delay(n))
+
+    def set_rate(self, rate):
+        """Новая скорость (например, доля общего лимита бота у шарда); запас — не меньше одного токена"""
+        self._refill()
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+# Глобальный лимитер
+limiter = WeightLimiter()
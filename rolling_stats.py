@@ -0,0 +1,244 @@
+# rolling_stats.py
+# Инкрементальная статистика по свечам: скользящее среднее/SMA и квантили волатильности
+from bisect import bisect_left, insort
+from collections import deque
+import numpy as np
+
+from analytics import kline_to_volatility, quote_volume_from_kline
+
+def _offsets(lengths):
+    """Границы окон, уложенных подряд в один массив: окно i — values[off[i]:off[i + 1]]"""
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+def _concat(seqs):
+    return np.concatenate([np.asarray(s, dtype=np.float64) for s in seqs]) if seqs else np.zeros(0)
+
+class RollingMean:
+    """Скользящее среднее за window значений, O(1) на обновление (подходит и для SMA)"""
+
+    def __init__(self, window):
+        self.window = window
+        self._values = deque()
+        self._sum = 0.0
+        self._updates = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def push(self, value):
+        self._values.append(value)
+        self._sum += value
+        if len(self._values) > self.window:
+            self._sum -= self._values.popleft()
+        self._updates += 1
+        if self._updates >= self.window:  # периодически пересчитываем сумму, чтобы не копилась ошибка float
+            self._sum = sum(self._values)
+            self._updates = 0
+
+    def replace_last(self, value):
+        """Обновляет последнее значение (свеча ещё формируется)"""
+        if not self._values:
+            self.push(value)
+            return
+        self._sum += value - self._values[-1]
+        self._values[-1] = value
+
+    @property
+    def mean(self):
+        return self._sum / len(self._values) if self._values else 0.0
+
+    def load(self, values):
+        """Окно целиком (из снапшота)"""
+        self._values = deque(values[-self.window:])
+        self._sum = sum(self._values)
+        self._updates = 0
+
+    @property
+    def full(self):
+        return len(self._values) >= self.window
+
+class SlidingQuantiles:
+    """Точные квантили по скользящему окну: отсортированный список + очередь вставки.
+
+    Поиск позиции O(log n), сдвиг памяти O(n) — для окна 4032 это микросекунды.
+    Интерполяция такая же, как у np.percentile (linear).
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._order = deque()
+        self._sorted = []
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def _remove(self, value):
+        i = bisect_left(self._sorted, value)
+        del self._sorted[i]
+
+    def push(self, value):
+        self._order.append(value)
+        insort(self._sorted, value)
+        if len(self._order) > self.window:
+            self._remove(self._order.popleft())
+
+    def replace_last(self, value):
+        if not self._order:
+            self.push(value)
+            return
+        self._remove(self._order[-1])
+        self._order[-1] = value
+        insort(self._sorted, value)
+
+    def pop_last(self):
+        if self._order:
+            self._remove(self._order.pop())
+
+    def quantile(self, q):
+        """q в [0, 1]"""
+        n = len(self._sorted)
+        if not n:
+            return 0.0
+        pos = q * (n - 1)
+        lo = int(pos)
+        hi = min(lo + 1, n - 1)
+        frac = pos - lo
+        return self._sorted[lo] + (self._sorted[hi] - self._sorted[lo]) * frac
+
+class SymbolStats:
+    """Статистика одного символа: средний объём за 72 свечи и Q25/Q50/Q75 волатильности за 14 дней"""
+
+    def __init__(self, volume_window=72, quantile_window=4032):
+        self.avg_volume = RollingMean(volume_window)
+        self.volatility = SlidingQuantiles(quantile_window)
+        self.last_open_time = None
+        self._last_vol_counted = False  # попала ли последняя свеча в квантили (vol > 0)
+
+    def update(self, kline):
+        """Новая свеча или обновление текущей (та же open_time). Старые свечи игнорируются"""
+        open_time = int(kline[0])
+        if self.last_open_time is not None and open_time < self.last_open_time:
+            return
+        volume = quote_volume_from_kline(kline)
+        vol = kline_to_volatility(kline)
+        if open_time == self.last_open_time:
+            self.avg_volume.replace_last(volume)
+            if self._last_vol_counted:
+                self.volatility.pop_last()
+        else:
+            self.avg_volume.push(volume)
+            self.last_open_time = open_time
+        # Как в compute_thresholds_from_klines: нулевая волатильность в квантили не идёт
+        self._last_vol_counted = vol > 0
+        if self._last_vol_counted:
+            self.volatility.push(vol)
+
+    def thresholds(self):
+        return {
+            "q25": self.volatility.quantile(0.25),
+            "q50": self.volatility.quantile(0.50),
+            "q75": self.volatility.quantile(0.75),
+        }
+
+class StatsEngine:
+    """Статистика по всем символам, обновляется на каждой свече"""
+
+    def __init__(self, volume_window=72, quantile_window=4032, min_samples=288):
+        self.volume_window = volume_window
+        self.quantile_window = quantile_window
+        self.min_samples = min_samples  # сколько свечей нужно, чтобы доверять своим квантилям
+        self._symbols = {}
+
+    def get(self, symbol):
+        stats = self._symbols.get(symbol)
+        if stats is None:
+            stats = self._symbols[symbol] = SymbolStats(self.volume_window, self.quantile_window)
+        return stats
+
+    def __contains__(self, symbol):
+        return symbol in self._symbols
+
+    def seed(self, symbol, klines):
+        """Заполняет с нуля по истории (например, 4032 свечи из compute_thresholds)"""
+        stats = self._symbols[symbol] = SymbolStats(self.volume_window, self.quantile_window)
+        for kline in klines:
+            stats.update(kline)
+
+    def seed_volatility(self, symbol, vols, last_open_time=None):
+        """Подставляет готовый ряд волатильностей (из compute_thresholds), объём не трогает.
+
+        last_open_time — open_time последней свечи ряда: если это текущая свеча статистики,
+        её повторное обновление заменит значение в ряду, а не добавит второе.
+        """
+        current = len(vols) > 0 and last_open_time is not None and last_open_time == self.get(symbol).last_open_time
+        counted = current and vols[-1] > 0
+        vols = [float(v) for v in vols if v > 0][-self.quantile_window:]
+        stats = self.get(symbol)
+        stats.volatility = SlidingQuantiles(self.quantile_window)
+        stats.volatility._order = deque(vols)
+        stats.volatility._sorted = sorted(vols)
+        stats._last_vol_counted = bool(counted)
+
+    def export_state(self):
+        """Состояние для снапшота: (meta для JSON, {имя: массив}); окна символов лежат подряд"""
+        symbols = list(self._symbols)
+        items = [self._symbols[s] for s in symbols]
+        meta = {"symbols": symbols, "volume_window": self.volume_window, "quantile_window": self.quantile_window}
+        arrays = {
+            "last_open_time": np.array([-1 if s.last_open_time is None else s.last_open_time for s in items],
+                                       dtype=np.int64),
+            "vol_counted": np.array([s._last_vol_counted for s in items], dtype=np.bool_),
+            "volume_offsets": _offsets([len(s.avg_volume) for s in items]),
+            "volume": _concat([s.avg_volume._values for s in items]),
+            "vol_offsets": _offsets([len(s.volatility) for s in items]),
+            "vol_order": _concat([s.volatility._order for s in items]),
+            "vol_sorted": _concat([s.volatility._sorted for s in items]),
+        }
+        return meta, arrays
+
+    def parse_state(self, meta, arrays):
+        """Из export_state в {symbol: SymbolStats}, движок не меняется; окна другой длины — ValueError"""
+        if (meta["volume_window"], meta["quantile_window"]) != (self.volume_window, self.quantile_window):
+            raise ValueError("окна статистики в снапшоте не совпадают с конфигом")
+        volume, vol_order, vol_sorted = (arrays[k].tolist() for k in ("volume", "vol_order", "vol_sorted"))
+        voff, qoff = arrays["volume_offsets"].tolist(), arrays["vol_offsets"].tolist()
+        last_open_time = arrays["last_open_time"].tolist()
+        counted = arrays["vol_counted"].tolist()
+        if not len(voff) == len(qoff) == len(last_open_time) + 1 == len(counted) + 1 == len(meta["symbols"]) + 1:
+            raise ValueError("размеры массивов статистики не совпадают")
+        parsed = {}
+        for i, symbol in enumerate(meta["symbols"]):
+            stats = parsed[symbol] = SymbolStats(self.volume_window, self.quantile_window)
+            stats.avg_volume.load(volume[voff[i]:voff[i + 1]])
+            stats.volatility._order = deque(vol_order[qoff[i]:qoff[i + 1]])
+            stats.volatility._sorted = vol_sorted[qoff[i]:qoff[i + 1]]
+            stats.last_open_time = last_open_time[i] if last_open_time[i] >= 0 else None
+            stats._last_vol_counted = counted[i]
+        return parsed
+
+    def load_state(self, meta, arrays):
+        """Обратно из export_state (ошибки формата — до изменения статистики)"""
+        self.apply_state(self.parse_state(meta, arrays))
+
+    def apply_state(self, parsed):
+        self._symbols.update(parsed)
+
+    def update(self, candles):
+        """candles: {symbol: kline} или {symbol: [kline, ...]}"""
+        for symbol, klines in candles.items():
+            if klines and not isinstance(klines[0], list):
+                klines = [klines]
+            stats = self.get(symbol)
+            for kline in klines:
+                stats.update(kline)
+
+    def avg_volume(self, symbol):
+        stats = self._symbols.get(symbol)
+        return stats.avg_volume.mean if stats else 0.0
+
+    def thresholds(self, symbol):
+        """Актуальные Q25/Q50/Q75 или None, если данных ещё мало"""
+        stats = self._symbols.get(symbol)
+        if stats is None or len(stats.volatility) < self.min_samples:
+            return None
+        return stats.thresholds()
@@ -0,0 +1,280 @@
+# rules.py
+# Правила сигналов пользователя: короткий текст -> скомпилированное правило -> числа в массивах.
+# В цикле все правила считаются одной матрицей (правило x символ), подписчики символа —
+# маской по их массивам; Python-цикл идёт по символам, а не по пользователям.
+#
+#   level>=3 btc>=3 surge>1.5 buy>=0.6 cooldown=30m
+import re
+from collections import defaultdict
+
+import numpy as np
+
+from config import RULE_MODBAG, RULE_MODMARKET
+
+NEVER = -(2 ** 62)  # «сигнала ещё не было» для массива последних сигналов
+NO_BTC = 5  # btc>=5 не выполняется никогда — BTC не запускает сигнал
+
+_TOKEN = re.compile(r"(\w+)\s*(>=|<=|>|=)\s*([0-9]*\.?[0-9]+[smh]?|off)", re.IGNORECASE)
+_UNITS = {"s": 1_000, "m": 60_000, "h": 3_600_000}
+
+class Rule:
+    """Скомпилированное правило: сигнал, если
+
+    (уровень >= min_level или уровень BTC >= btc_or) и уровень BTC <= btc_max
+    и объём > surge × средний и buy_min <= доля покупок тейкеров <= buy_max,
+    и с прошлого сигнала по символу прошло не меньше cooldown_ms.
+    """
+    __slots__ = ("min_level", "btc_or", "btc_max", "surge", "buy_min", "buy_max", "cooldown_ms")
+
+    def __init__(self, min_level=3, btc_or=3, btc_max=4, surge=1.0, buy_min=0.0, buy_max=1.0, cooldown_ms=0):
+        self.min_level = min_level
+        self.btc_or = btc_or
+        self.btc_max = btc_max
+        self.surge = surge
+        self.buy_min = buy_min
+        self.buy_max = buy_max
+        self.cooldown_ms = cooldown_ms
+
+    @property
+    def text(self):
+        """Каноническая запись: одинаковые правила — одна строка (и одна строка в матрице)"""
+        parts = [f"level>={self.min_level}", "btc=off" if self.btc_or >= NO_BTC else f"btc>={self.btc_or}"]
+        if self.btc_max < 4:
+            parts.append(f"btc<={self.btc_max}")
+        parts.append(f"surge>{self.surge:g}")
+        if self.buy_min > 0:
+            parts.append(f"buy>={self.buy_min:g}")
+        if self.buy_max < 1:
+            parts.append(f"buy<={self.buy_max:g}")
+        if self.cooldown_ms:
+            parts.append(f"cooldown={self.cooldown_ms // 60_000}m" if self.cooldown_ms % 60_000 == 0
+                         else f"cooldown={self.cooldown_ms // 1000}s")
+        return " ".join(parts)
+
+def _number(value, key):
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{key}: нужно число, а не «{value}»")
+
+def _level(value, key):
+    level = int(_number(value, key))
+    if not 1 <= level <= 4:
+        raise ValueError(f"{key}: уровень от 1 до 4")
+    return level
+
+def compile_rule(text, base=None):
+    """Текст правила -> Rule; чего нет в тексте — из base (правило режима). Ошибка — ValueError"""
+    rule = Rule()
+    if base is not None:
+        for name in Rule.__slots__:
+            setattr(rule, name, getattr(base, name))
+    text = (text or "").strip()
+    leftover = _TOKEN.sub("", text)
+    if leftover.strip(" ,;"):
+        raise ValueError(f"не понял «{leftover.strip(' ,;')}»")
+    for key, op, value in _TOKEN.findall(text):
+        key, value = key.lower(), value.lower()
+        if key == "level" and op in (">=", "="):
+            rule.min_level = _level(value, key)
+        elif key == "btc" and value == "off":
+            rule.btc_or, rule.btc_max = NO_BTC, 4
+        elif key == "btc" and op == ">=":
+            rule.btc_or = _level(value, key)
+        elif key == "btc" and op == "<=":
+            rule.btc_max = _level(value, key)
+        elif key == "surge" and op in (">", ">="):
+            rule.surge = _number(value, key)
+        elif key == "buy" and op == ">=":
+            rule.buy_min = _number(value, key)
+        elif key == "buy" and op == "<=":
+            rule.buy_max = _number(value, key)
+        elif key == "cooldown" and op == "=":
+            unit = value[-1] if value[-1] in _UNITS else "m"
+            rule.cooldown_ms = int(_number(value.rstrip("smh"), key) * _UNITS[unit])
+        else:
+            raise ValueError(f"неизвестное условие «{key}{op}{value}»")
+    if not 0 <= rule.buy_min <= rule.buy_max <= 1:
+        raise ValueError("buy: доля от 0 до 1, buy>= не больше buy<=")
+    return rule
+
+# Правила режимов по умолчанию (сейчас одинаковые: уровень 3 у монеты или BTC и объём выше среднего)
+MODE_RULES = {
+    "modbag": compile_rule(RULE_MODBAG),
+    "modmarket": compile_rule(RULE_MODMARKET),
+}
+
+def mode_rule(mode):
+    return MODE_RULES.get(mode, MODE_RULES["modbag"])
+
+class _SymbolSubs:
+    """Подписчики одного символа массивами: chat_id, номер правила, номер режима, последний сигнал"""
+    __slots__ = ("chat_ids", "rule_ids", "mode_ids", "last")
+
+    def __init__(self, chat_ids, rule_ids, mode_ids, last):
+        self.chat_ids = chat_ids
+        self.rule_ids = rule_ids
+        self.mode_ids = mode_ids
+        self.last = last
+
+class RuleBook:
+    """Правила всех пользователей. Компиляция — при изменении настроек, в цикле — только маски.
+
+    Одинаковые правила хранятся один раз; массивы подписчиков символа пересобираются
+    лениво, только для символов, чьи подписчики менялись.
+    """
+
+    def __init__(self):
+        self._rule_ids = {}  # канонический текст -> номер
+        self._compiled = {}  # (режим, текст пользователя) -> номер: одинаковый ввод не компилируется снова
+        self._rules = []
+        self._params = None  # поля правил массивами (R,)
+        self._mode_ids = {}
+        self._modes = []
+        self._users = {}  # chat_id -> (rule_id, mode_id)
+        self._members = defaultdict(dict)  # symbol -> {chat_id: None} (упорядоченное множество)
+        self._subs = {}  # symbol -> _SymbolSubs
+        self._dirty = set()
+        self._restored = {}  # (chat_id, symbol) -> open_time из снапшота
+
+    def clear(self):
+        self._users.clear()
+        self._members.clear()
+        self._subs.clear()
+        self._dirty.clear()
+
+    def _intern_rule(self, rule):
+        key = rule.text
+        rule_id = self._rule_ids.get(key)
+        if rule_id is None:
+            rule_id = self._rule_ids[key] = len(self._rules)
+            self._rules.append(rule)
+            self._params = None
+        return rule_id
+
+    def _intern_mode(self, mode):
+        mode_id = self._mode_ids.get(mode)
+        if mode_id is None:
+            mode_id = self._mode_ids[mode] = len(self._modes)
+            self._modes.append(mode)
+        return mode_id
+
+    def update_user(self, chat_id, old_symbols, data):
+        """Новые настройки пользователя: компилирует правило, отмечает затронутые символы"""
+        chat_id = int(chat_id)
+        mode = data.get("mode", "modbag")
+        key = (mode, data.get("rule") or "")
+        rule_id = self._compiled.get(key)
+        if rule_id is None:
+            try:
+                rule = compile_rule(key[1], base=mode_rule(mode))
+            except ValueError as e:
+                print(f"Правило пользователя {chat_id} не разобрано ({e}), беру правило режима")
+                rule = mode_rule(mode)
+            rule_id = self._compiled[key] = self._intern_rule(rule)
+        entry = (rule_id, self._intern_mode(mode))
+        new_symbols = set(data.get("symbols", []))
+        changed = set(old_symbols) ^ new_symbols
+        if self._users.get(chat_id) != entry:
+            changed |= new_symbols  # у всех его символов поменялись номер правила или режима
+        self._users[chat_id] = entry
+        for symbol in set(old_symbols) - new_symbols:
+            self._members[symbol].pop(chat_id, None)
+        for symbol in new_symbols:
+            self._members[symbol][chat_id] = None
+        self._dirty |= changed
+
+    def _params_arrays(self):
+        if self._params is None:
+            self._params = {
+                name: np.array([getattr(r, name) for r in self._rules],
+                               dtype=np.int64 if name == "cooldown_ms" else np.float64)
+                for name in Rule.__slots__
+            }
+        return self._params
+
+    def _flush(self):
+        """Пересобирает массивы подписчиков изменённых символов; last переносится"""
+        for symbol in self._dirty:
+            members = self._members.get(symbol)
+            old = self._subs.pop(symbol, None)
+            if not members:
+                self._members.pop(symbol, None)
+                continue
+            previous = dict(zip(old.chat_ids.tolist(), old.last.tolist())) if old is not None else {}
+            chat_ids = list(members)
+            entries = [self._users[c] for c in chat_ids]
+            last = [previous.get(c, self._restored.pop((c, symbol), NEVER)) for c in chat_ids]
+            self._subs[symbol] = _SymbolSubs(
+                np.array(chat_ids, dtype=np.int64),
+                np.array([e[0] for e in entries], dtype=np.int32),
+                np.array([e[1] for e in entries], dtype=np.int16),
+                np.array(last, dtype=np.int64),
+            )
+        self._dirty.clear()
+
+    def evaluate(self, signals):
+        """signals: {symbol: (open_time, params, buy_ratio)} -> [(symbol, open_time, params, {mode: [chat_id]})].
+
+        Матрица правило x символ считается целиком, дальше по каждому символу,
+        где сработало хоть одно правило, — маска по его подписчикам (правило, повтор, cooldown).
+        """
+        self._flush()
+        symbols = [s for s in signals if s in self._subs]
+        if not symbols or not self._rules:
+            return []
+        rows = [signals[s] for s in symbols]
+        open_time = np.array([r[0] for r in rows], dtype=np.int64)
+        level = np.array([r[1]["level"] for r in rows], dtype=np.float64)
+        volume = np.array([r[1]["volume_5m"] for r in rows], dtype=np.float64)
+        avg = np.array([r[1]["avg_volume"] for r in rows], dtype=np.float64)
+        buy = np.array([r[2] for r in rows], dtype=np.float64)
+        btc = rows[0][1]["btc_level"]
+
+        p = self._params_arrays()
+        fire = (
+            ((level[None, :] >= p["min_level"][:, None]) | (btc >= p["btc_or"])[:, None])
+            & (btc <= p["btc_max"])[:, None]
+            & (volume[None, :] > p["surge"][:, None] * avg[None, :])
+            & (buy[None, :] >= p["buy_min"][:, None])
+            & (buy[None, :] <= p["buy_max"][:, None])
+        )
+        result = []
+        for j in np.flatnonzero(fire.any(axis=0)):
+            subs = self._subs[symbols[j]]
+            t = open_time[j]
+            mask = fire[subs.rule_ids, j] & (subs.last != t) & (t - subs.last >= p["cooldown_ms"][subs.rule_ids])
+            if not mask.any():
+                continue
+            subs.last[mask] = t
+            groups = {}
+            for mode_id in np.unique(subs.mode_ids[mask]):
+                groups[self._modes[mode_id]] = subs.chat_ids[mask & (subs.mode_ids == mode_id)].tolist()
+            result.append((symbols[j], int(t), rows[j][1], groups))
+        return result
+
+    # Последние сигналы для снапшота: повтор той же свечи и cooldown переживают перезапуск
+    def export_alerts(self):
+        self._flush()
+        cooldown = max((r.cooldown_ms for r in self._rules), default=0)
+        newest = max((int(s.last.max()) for s in self._subs.values() if len(s.last)), default=NEVER)
+        entries = []
+        for symbol, subs in self._subs.items():
+            mask = (subs.last >= newest - cooldown) & (subs.last != NEVER)
+            entries.extend((c, symbol, t) for c, t in zip(subs.chat_ids[mask].tolist(), subs.last[mask].tolist()))
+        return entries
+
+    def load_alerts(self, entries):
+        """Последние сигналы из снапшота: сразу в массивы или при ближайшей пересборке символа"""
+        positions = {}  # symbol -> {chat_id: индекс в массивах}
+        for chat_id, symbol, open_time in entries:
+            subs = self._subs.get(symbol)
+            if subs is None or symbol in self._dirty:
+                key = (chat_id, symbol)
+                self._restored[key] = max(open_time, self._restored.get(key, NEVER))
+                continue
+            if symbol not in positions:
+                positions[symbol] = {c: i for i, c in enumerate(subs.chat_ids.tolist())}
+            i = positions[symbol].get(chat_id)
+            if i is not None and open_time > subs.last[i]:
+                subs.last[i] = open_time  # запоздавшие данные не откатывают более свежий сигнал
@@ -4,135 +4,430 @@ import time
 from datetime import datetime
 import pytz
 
-from storage import load_users, save_symbol_cache, load_symbol_cache
-from binance_api import get_klines, get_top_symbols
+from storage import append_candles, merge_candles, candle_store
+from market import market
 from analytics import (
     kline_to_volatility, quote_volume_from_kline,
-    compute_avg_volume, determine_level, calculate_sma
+    determine_level, determine_levels
 )
-from notifier import send_message, format_signal, format_top_3
+from threshold_index import thresholds_index
+from rolling_stats import StatsEngine
+from trend import trend
+from ranking import cross_section
+from metrics import STAGE_SECONDS, CYCLE_SECONDS, ALERTS, log_event
+from notifier import send_many, render_cache
+from subscriptions import index
+from symbols import registry
+from backfill import backfill
 from cache import cache
+from rate_limiter import PRIORITY_SIGNAL, PRIORITY_TOP
+from timer_wheel import TimerWheel
+from ws_stream import KlineStream
+import compute_thresholds
+from config import (
+    INGESTION_MODE, STREAM_INTRA_CANDLE, STREAM_INTRA_INTERVAL,
+    STREAM_SETTLE, STREAM_RESUBSCRIBE_INTERVAL, HISTORY_SIZE, STATS_MIN_SAMPLES,
+    THRESHOLDS_REFRESH, TOP_N, TOP_UNIVERSE, TOP_MIN_QUOTE_VOLUME, TOP_MIN_SURGE
+)
 
 INTERVAL = 300  # 5 минут
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
-# Тренд BTC
-async def get_trend_status():
-    tfs = {"4h": ("4h", 200), "1h": ("1h", 200), "15m": ("15m", 200)}
-    result = []
-    for tf_name, (interval, period) in tfs.items():
-        klines = get_klines("BTCUSDT", interval=interval, limit=period + 10)
-        if klines and len(klines) >= period:
-            sma = calculate_sma(klines, period)
-            price = float(klines[-1][4])
-            emoji = "🟢" if price > sma else "🔴"
-        else:
-            emoji = "⚪"
-        result.append(f"{tf_name}{emoji}")
-    return "".join(result)
-
-# Обновление истории (только для нужных монет)
-async def update_symbol_history(symbol: str):
-    cache_data = load_symbol_cache()
-    klines = get_klines(symbol, limit=73)
-    if not klines:
+# Скользящие средний объём и квантили волатильности, обновляются на каждой свече
+stats = StatsEngine(volume_window=HISTORY_SIZE, quantile_window=4032, min_samples=STATS_MIN_SAMPLES)
+_stats_seeded = False
+
+def _seed_stats():
+    """При первом запуске заполняем статистику из сохранённой истории.
+
+    Символы со статистикой (снапшот, 14-дневный ряд из seed_quantiles) не затираются
+    72 свечами: тем, у кого есть только квантили, добавляется средний объём.
+    """
+    global _stats_seeded
+    if _stats_seeded:
+        return
+    store = candle_store()
+    for symbol in store.symbols():
+        buf = store.get(symbol)
+        if symbol not in stats:
+            stats.seed(symbol, buf.to_klines())
+            continue
+        symbol_stats = stats.get(symbol)
+        if symbol_stats.last_open_time is None and len(buf):
+            symbol_stats.avg_volume.load(buf.window().quote_volume.tolist())
+            symbol_stats.last_open_time = buf.last_open_time
+    _stats_seeded = True
+
+# Тренд: цена против SMA200 на 4h/1h/15m. Бары собираются из 5m свечей цикла,
+# из REST — только первая загрузка символа
+async def get_trend_status(symbol="BTCUSDT"):
+    """Через кеш: одновременные /trend и цикл не загружают бары символа дважды"""
+    async def load():
+        await trend.ensure([symbol], int(time.time() * 1000))
+        return trend.text(symbol)
+    return await cache.get_or_load(("trend", symbol), load, ttl=INTERVAL)
+
+# Время этапов текущего цикла, сек (fetch, history, classify, format) — для bench.py, логов и /metrics
+cycle_timings = {}
+_stage_metrics = {name: STAGE_SECONDS.labels(name) for name in ("fetch", "backfill", "history", "classify", "format")}
+_alert_metrics = {level: ALERTS.labels(level) for level in (1, 2, 3, 4)}
+
+def _stage(name, start):
+    """Прибавляет время этапа с момента start; возвращает текущий момент (начало следующего этапа)"""
+    now = time.perf_counter()
+    cycle_timings[name] = cycle_timings.get(name, 0.0) + now - start
+    _stage_metrics[name].observe(now - start)
+    return now
+
+def _cycle_done(seconds, candles):
+    CYCLE_SECONDS.observe(seconds)
+    log_event("cycle", seconds=round(seconds, 4), candles=candles,
+              **{k: round(v, 4) for k, v in cycle_timings.items()})
+
+# Обновление истории (только для нужных монет): candles — свечи {symbol: kline или [kline, ...]}
+# из снимка рынка или потока, отдельных запросов в REST не делаем
+async def update_symbol_history(candles):
+    if candles:
+        _seed_stats()
+        append_candles(candles)  # одна запись на весь пакет
+        stats.update(candles)
+        trend.update(candles)
+        for symbol in candles:
+            cache.delete(("trend", symbol))  # тренд пересчитан — следующий запрос возьмёт свежий
+
+async def fill_history(symbols, end, since=None):
+    """Догружает дыры в окнах истории (backfill.py) до свечи end включительно.
+
+    Свечи новее последней в истории идут обычным путём (история, статистика, тренд),
+    вставленные внутрь окна — в буфер, средний объём символа пересчитывается по окну.
+    """
+    fetched = await backfill.run(symbols, end, since)
+    if not fetched:
+        return
+    store = candle_store()
+    newer, older = {}, {}
+    for symbol, klines in fetched.items():
+        last = store.get(symbol).last_open_time if symbol in store else None
+        for kline in klines:
+            (newer if last is None or int(kline[0]) > last else older).setdefault(symbol, []).append(kline)
+    if older:
+        merge_candles(older)
+        for symbol in older:
+            if symbol in stats:
+                stats.get(symbol).avg_volume.load(store.get(symbol).window().quote_volume.tolist())
+    await update_symbol_history(newer)
+    backfill.plan(fetched, end, since)  # ставшие полными окна — тёплые
+
+async def warm_up(symbols):
+    """Новая подписка: полная история сразу, а не через HISTORY_SIZE циклов"""
+    now = int(time.time() * 1000)
+    await fill_history(symbols, now - now % (INTERVAL * 1000) - INTERVAL * 1000)
+
+# Фоновый пересчёт порогов: раз в THRESHOLDS_REFRESH по всем подпискам,
+# а для новых монет без порогов — сразу, не дожидаясь суток
+_thresholds_task = None
+_thresholds_updated = 0.0
+_thresholds_tried = {}  # symbol -> когда пытались (чтобы не долбить несуществующие)
+
+def seed_quantiles(symbol, state):
+    stats.seed_volatility(symbol, state[:, 1], int(state[-1, 0]) if len(state) else None)
+
+def _thresholds_done(task, target, updated_before):
+    """Упавший пересчёт — в лог, и он не считается сделанным: следующий цикл попробует снова"""
+    global _thresholds_updated
+    if task.cancelled() or task.exception() is None:
+        return
+    print(f"Ошибка пересчёта порогов: {task.exception()}")
+    if target is None:
+        _thresholds_updated = updated_before
+    else:
+        for s in target:
+            _thresholds_tried.pop(s, None)
+
+def refresh_thresholds(symbols):
+    global _thresholds_task, _thresholds_updated
+    updated_before = _thresholds_updated
+    if _thresholds_task is not None and not _thresholds_task.done():
         return
-    new_kline = klines[-1]
-    if symbol not in cache_data:
-        cache_data[symbol] = []
-    history = cache_data[symbol]
-    if not history or new_kline[0] > history[-1][0]:
-        history.append(new_kline)
-        if len(history) > 72:
-            history = history[-72:]
-        cache_data[symbol] = history
-        save_symbol_cache(cache_data)
-
-async def main_cycle():
+    now = time.time()
+    if now - _thresholds_updated > THRESHOLDS_REFRESH:
+        target = None  # все подписки
+        _thresholds_updated = now
+    else:
+        target = [
+            s for s in symbols
+            if not thresholds_index.has(s) and now - _thresholds_tried.get(s, 0) > THRESHOLDS_REFRESH
+        ]
+        if not target:
+            return
+        for s in target:
+            _thresholds_tried[s] = now
+    _thresholds_task = asyncio.create_task(compute_thresholds.run(target, on_symbol=seed_quantiles))
+    _thresholds_task.add_done_callback(lambda task: _thresholds_done(task, target, updated_before))
+
+def collect_subscriptions():
+    """Все нужные символы (+BTC) и chat_id, которые хотят топ-3 — из индекса подписок.
+
+    Только торгуемые контракты: снятые и несуществующие символы не запрашиваем.
+    """
+    return set(registry.filter_trading(index.symbols())) | {"BTCUSDT"}, index.top_users()
+
+def level_thresholds(symbols):
+    """Пороги уровней матрицей (n, 3): скользящие квантили, пока их мало — из индекса порогов.
+    Один источник для сигналов (classify) и топа (cross_section.rank)"""
+    thresholds = thresholds_index.matrix(symbols)
+    for i, symbol in enumerate(symbols):
+        rolling = stats.thresholds(symbol)
+        if rolling is not None:
+            thresholds[i] = (rolling["q25"], rolling["q50"], rolling["q75"])
+    return thresholds
+
+def classify(current_data, symbols):
+    """Волатильность и уровень для всех символов одним векторным вызовом: {symbol: (vol_pct, level)}"""
+    symbols = [s for s in symbols if s in current_data]
+    vols = [kline_to_volatility(current_data[s]) for s in symbols]
+    levels = determine_levels(vols, symbols, level_thresholds(symbols))
+    return {s: (v, int(l)) for s, v, l in zip(symbols, vols, levels)}
+
+def evaluate_symbol(symbol, kline, vol_pct, level, btc_vol, btc_level):
+    """Признаки символа один раз для всех подписчиков: (параметры шаблона, доля покупок тейкеров).
+
+    Решение «слать или нет» — за правилами пользователей (rules.py).
+    """
+    volume_5m = quote_volume_from_kline(kline)
+    taker_buy_volume = float(kline[9]) if len(kline) > 9 else volume_5m / 2
+    taker_buy_quote = float(kline[10]) if len(kline) > 10 else volume_5m / 2
+    avg_volume = stats.avg_volume(symbol)
+    params = dict(
+        symbol=symbol, vol_pct=vol_pct, level=level,
+        volume_5m=volume_5m, taker_buy_volume=taker_buy_volume,
+        avg_volume=avg_volume, btc_vol_pct=btc_vol, btc_level=btc_level
+    )
+    return params, (taker_buy_quote / volume_5m if volume_5m > 0 else 0.5)
+
+# Шардированный режим (shard.py): результат цикла уходит воркерам, рассылают они
+publisher = None
+
+def fan_out(signals, top, subs=index):
+    """Рассылка результата цикла подписчикам из subs; возвращает число адресатов.
+
+    signals — {symbol: (open_time, params, buy_ratio)}, top — {"open_time", "trend_text", "top_vols"} или None.
+    Кому слать, решают правила subs.rules (повтор по той же свече они тоже отсекают).
+    Текст рендерится один раз на режим.
+    """
+    recipients = 0
+    for symbol, open_time, params, groups in subs.rules.evaluate(signals):
+        count = sum(len(group) for group in groups.values())
+        _alert_metrics[params["level"]].inc(count)
+        recipients += count
+        for mode, group in groups.items():
+            send_many(group, render_cache.render("signal", symbol, open_time, mode, params))
+    if top:
+        top_users = subs.top_users()
+        params = {"trend_text": top["trend_text"], "top_vols": top["top_vols"]}
+        for mode, group in subs.group_by_mode(top_users).items():
+            send_many(group, render_cache.render("top", None, top["open_time"], mode, params))
+        recipients += len(top_users)
+    return recipients
+
+async def process_candles(current_data, top_users, top100, send_top=True, update_history=True):
+    """Обновляет историю, считает уровни и рассылает сигналы по готовым свечам.
+
+    Каждый символ считается один раз, текст рендерится один раз на режим
+    и уходит всем его подписчикам с этим режимом. История пополняется теми же свечами.
+    update_history=False — незакрытые свечи: только уровни и сигналы, история,
+    статистика и тренд не трогаются и не сохраняются.
+    С publisher (шардированный режим) рассылку делают воркеры.
+    """
+    # История только для монет подписчиков + BTC (чтобы были сигналы!)
+    started = time.perf_counter()
+    need_history = [s for s in index.symbols() | {"BTCUSDT"} if s in current_data]  # уже есть свеча
+    if update_history:
+        await update_symbol_history({s: current_data[s] for s in need_history})
+        started = _stage("history", started)
+    render_cache.clear()
+
+    # Уровни всех символов за один проход, BTC отдельно (нет свечи — уровень по нулевой волатильности)
+    levels = classify(current_data, need_history)
+    btc_vol, btc_level = levels.get("BTCUSDT", (0, determine_level(0, "BTCUSDT")))
+    trend_text = await get_trend_status() if send_top and top_users else ""
+    started = _stage("classify", started)
+
+    # Признаки каждого символа с подписчиками — один раз; правила пользователей применятся в fan_out.
+    # Символы с неполным окном истории пропускаются: средний объём по ним ещё неверный
+    signals = {}
+    for symbol in index.symbols():
+        kline = current_data.get(symbol)
+        if not kline or not backfill.is_warm(symbol):
+            continue
+        params, buy_ratio = evaluate_symbol(symbol, kline, *levels[symbol], btc_vol, btc_level)
+        signals[symbol] = (kline[0], params, buy_ratio)
+
+    # Топ-N + тренд (один текст на всех, кто включил топ): весь срез рынка одним векторным проходом
+    top = None
+    if send_top and top_users and top100:
+        cross_section.update(current_data)
+        top_list = cross_section.rank(
+            TOP_N, universe=top100, volume_24h=market.quote_volumes(),
+            min_quote_volume=TOP_MIN_QUOTE_VOLUME, min_surge=TOP_MIN_SURGE, thresholds=level_thresholds
+        )
+        if top_list:
+            top = {"open_time": current_data[top_list[0][0]][0], "trend_text": trend_text, "top_vols": top_list}
+
+    if publisher is not None:
+        await publisher.publish(signals, top)  # рассылают воркеры шардов
+    else:
+        fan_out(signals, top)
+    _stage("format", started)
+
+# Последняя обработанная закрытая свеча (восстанавливается из снапшота после перезапуска)
+last_open_time = None
+
+def _with_gap(open_time, missed=()):
+    """missed + свечи между последней обработанной и open_time (простой бота, перезапуск)"""
+    missed = set(missed)
+    if open_time is not None and last_open_time is not None:
+        missed.update(range(last_open_time + INTERVAL * 1000, open_time, INTERVAL * 1000))
+    return sorted(missed)
+
+def _processed(open_time):
+    global last_open_time
+    if open_time is not None and (last_open_time is None or open_time > last_open_time):
+        last_open_time = open_time
+
+async def main_cycle(open_time=None, missed=()):
+    """Цикл по закрытой свече open_time (по умолчанию — по текущей).
+
+    missed — open_time тиков, которые планировщик пропустил: их свечи догружаются в историю
+    вместе с дырами в окнах (fill_history) до расчёта сигналов.
+    """
     print(f"[{datetime.now(MOSCOW_TZ).strftime('%H:%M:%S')}] Запуск цикла...")
+    cycle_timings.clear()
+    started = time.perf_counter()
+
+    all_symbols, top_users = collect_subscriptions()
+    refresh_thresholds(all_symbols)
+    missed = _with_gap(open_time, missed)
+
+    # Рынок для топа (если хоть один хочет топ) — из ticker/24hr снимка, один запрос на свечу
+    top100 = registry.filter_trading(await market.top_symbols(TOP_UNIVERSE or None)) if top_users else []
+    top_only = set(top100) - all_symbols
+
+    # Свечи: монеты подписчиков первыми, скан топа — следом.
+    # Всё, что уже есть в снимке на эту свечу, повторно не запрашивается
+    fetched, fetched_top = await asyncio.gather(
+        market.get_klines(all_symbols, priority=PRIORITY_SIGNAL, open_time=open_time),
+        market.get_klines(top_only, priority=PRIORITY_TOP, open_time=open_time)
+    )
+    current_data = {**fetched, **fetched_top}
+    started = _stage("fetch", started)
+
+    # Дыры в окнах истории (новые монеты, простой) — до сигналов, чтобы средние были полными
+    if open_time is None:
+        open_time = max((k[0] for k in current_data.values()), default=None)
+    if open_time is not None:
+        await fill_history(all_symbols, open_time - INTERVAL * 1000, missed[0] if missed else None)
+    _stage("backfill", started)
 
-    users = load_users()
-    all_symbols = {"BTCUSDT"}
-    top_users = []
-
-    # Сбор символов и кто хочет топ-3
-    for chat_id_str, data in users.items():
-        chat_id = int(chat_id_str)
-        all_symbols.update(data.get("symbols", []))
-
-    top_volatile = data.get("top_volatile", False)
-    if isinstance(top_volatile, str):
-        top_volatile = top_volatile.lower() == "true"
-    if top_volatile:
-        top_users.append(chat_id)
-
-
-    # Топ-30 (если хоть один хочет топ)
-    top100 = get_top_symbols(30) if top_users else []
-    all_symbols.update(top100)
-
-    # Текущие свечи для всех
-    current_data = {}
-    for symbol in all_symbols:
-        kline = get_klines(symbol, limit=1)
-        if kline:
-            current_data[symbol] = kline[-1]
-
-    # История только для твоих монет + BTC (чтобы были сигналы!)
-    need_history = {"BTCUSDT"}
-    for data in users.values():
-        need_history.update(data.get("symbols", []))
-    for symbol in need_history:
-        if symbol in current_data:  # уже есть свеча
-            await update_symbol_history(symbol)
-
-    # BTC
-    btc_kline = current_data.get("BTCUSDT")
-    btc_vol = kline_to_volatility(btc_kline) if btc_kline else 0
-    btc_level = determine_level(btc_vol, "BTCUSDT")
-    symbol_cache = load_symbol_cache()
-    trend_text = await get_trend_status()
-
-    # По каждому пользователю
-    for chat_id_str, user_data in users.items():
-        chat_id = int(chat_id_str)
-        symbols = user_data.get("symbols", [])
-
-        # Сигналы
-        for symbol in symbols:
-            kline = current_data.get(symbol)
-            if not kline:
-                continue
-            vol_pct = kline_to_volatility(kline)
-            volume_5m = quote_volume_from_kline(kline)
-            taker_buy_volume = float(kline[9]) if len(kline) > 9 else volume_5m / 2
-            history = symbol_cache.get(symbol, [])
-            avg_volume = compute_avg_volume(history)
-            level = determine_level(vol_pct, symbol)
-
-            send = (btc_level >= 3) or (level >= 3)
-            if send and volume_5m > avg_volume:
-                text = format_signal(
-                    symbol=symbol, vol_pct=vol_pct, level=level,
-                    volume_5m=volume_5m, taker_buy_volume=taker_buy_volume,
-                    avg_volume=avg_volume, btc_vol_pct=btc_vol, btc_level=btc_level
-                )
-                await send_message(chat_id, text)
-
-        # Топ-3 + тренд
-        if chat_id in top_users and top100:
-            top_list = [(sym, kline_to_volatility(current_data[sym])) 
-                       for sym in top100 if sym in current_data]
-            top_list = sorted(top_list, key=lambda x: x[1], reverse=True)[:3]
-            if top_list:
-                text = f"<b>Тренд BTC:</b> {trend_text}\n\n"
-                text += format_top_3(top_list)
-                await send_message(chat_id, text)
+    await process_candles(current_data, top_users, top100)
+    _processed(open_time)
+
+class StreamPipeline:
+    """Принимает свечи из WebSocket и запускает обработку, как только свеча закрылась.
+
+    Закрытые свечи копятся по open_time STREAM_SETTLE секунд (Binance закрывает
+    все символы почти одновременно), затем обрабатываются одной пачкой.
+    """
+
+    def __init__(self, intra_candle=STREAM_INTRA_CANDLE):
+        self.intra_candle = intra_candle
+        self.top100 = []
+        self.pending = {}     # open_time -> {symbol: kline}
+        self.latest = {}      # symbol -> последняя (возможно незакрытая) свеча
+        self.backfilled = []  # (symbol, kline) догруженные после разрыва, только в историю
+        self._last_intra = 0.0
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def symbols(self):
+        """Набор символов для подписки: монеты пользователей, BTC и рынок для топа при необходимости"""
+        all_symbols, top_users = collect_subscriptions()
+        if top_users:
+            self.top100 = registry.filter_trading(await market.top_symbols(TOP_UNIVERSE or None)) or self.top100
+        if not top_users:
+            self.top100 = []
+        return all_symbols | set(self.top100)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def on_candle(self, symbol, kline, closed, backfill):
+        if backfill:
+            self.backfilled.append((symbol, kline))
+            return
+        self.latest[symbol] = kline
+        market.update_kline(symbol, kline)
+        if closed:
+            batch = self.pending.setdefault(kline[0], {})
+            if not batch:
+                self._spawn(self._flush(kline[0]))
+            batch[symbol] = kline
+        elif self.intra_candle and time.time() - self._last_intra >= STREAM_INTRA_INTERVAL:
+            self._last_intra = time.time()
+            self._spawn(self._flush_intra())
+
+    async def _apply_backfill(self):
+        backfilled, self.backfilled = self.backfilled, []
+        candles = {}
+        for symbol, kline in sorted(backfilled, key=lambda x: x[1][0]):
+            candles.setdefault(symbol, []).append(kline)
+        await update_symbol_history(candles)
+
+    async def _flush(self, open_time):
+        await asyncio.sleep(STREAM_SETTLE)
+        async with self._lock:
+            start = time.time()
+            cycle_timings.clear()
+            current_data = self.pending.pop(open_time, {})
+            await self._apply_backfill()
+            missed = _with_gap(open_time)
+            all_symbols, top_users = collect_subscriptions()
+            refresh_thresholds(all_symbols)
+            started = time.perf_counter()
+            await fill_history(all_symbols, open_time - INTERVAL * 1000, missed[0] if missed else None)
+            _stage("backfill", started)
+            await process_candles(current_data, top_users, self.top100)
+            _processed(open_time)
+            _cycle_done(time.time() - start, len(current_data))
+            print(f"Свеча {open_time} ({len(current_data)} символов) обработана за {time.time() - start:.2f} сек")
+
+    async def _flush_intra(self):
+        """Внутрисвечная проверка: только сигналы (по одному на свечу), без истории и топа"""
+        if self._lock.locked():
+            return
+        async with self._lock:
+            await process_candles(dict(self.latest), set(), [], send_top=False, update_history=False)
+
+async def run_stream():
+    pipeline = StreamPipeline()
+    stream = KlineStream(pipeline.on_candle, interval="5m", intra_candle=pipeline.intra_candle)
+    await stream.run(pipeline.symbols, refresh=STREAM_RESUBSCRIBE_INTERVAL)
 
 async def run_scheduler():
-    while True:
-        start = time.time()
-        await main_cycle()
-        elapsed = time.time() - start
+    """REST-режим: 5m-цикл на таймере по границам свечей; ws-режим: по закрытию свечей в потоке"""
+    if INGESTION_MODE == "ws":
+        await run_stream()
+        return
+
+    async def cycle(open_time, missed):
+        start = time.perf_counter()
+        await main_cycle(open_time, missed)
+        elapsed = time.perf_counter() - start
+        _cycle_done(elapsed, len(market.klines))
         print(f"Цикл завершён за {elapsed:.2f} сек")
-        await asyncio.sleep(max(0, INTERVAL - elapsed))
\ No newline at end of file
+
+    wheel = TimerWheel()
+    wheel.add("5m", cycle)
+    await wheel.run()
@@ -0,0 +1,468 @@
+# shard.py
+# Шардированная рассылка: лидер раз на свечу считает рынок (снимок, уровни, сигналы, топ) и
+# публикует результат по локальному сокету; воркеры-процессы держат свою долю chat_id
+# (rendezvous-хеш) и делают рассылку подписчикам.
+#
+#   SHARD_WORKERS=4 python bot.py                        # бот-лидер сам запускает 4 воркера
+#   python shard.py worker --socket data/shard.sock      # ещё один воркер к работающему лидеру
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+import zlib
+
+from config import SHARD_SOCKET, SHARD_REPORT_TIMEOUT
+from metrics import SHARD_SECONDS, CallbackMetric, log_event
+
+MESSAGE_LIMIT = 256 * 1024 * 1024  # назначение шарда со всеми его пользователями — одной строкой
+HANDOFF_TIMEOUT = 5.0  # сек ожидания последних сигналов переезжающих пользователей перед циклом
+
+def encode(message):
+    return (json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n").encode()
+
+def shard_of(chat_id, workers):
+    """Воркер для chat_id: rendezvous-хеш, при смене состава переезжает только ~1/N пользователей"""
+    key = str(chat_id)
+    return max(workers, key=lambda w: zlib.crc32(f"{w}:{key}".encode()))
+
+class WorkerConn:
+    """Подключённый воркер на стороне лидера"""
+
+    def __init__(self, name, reader, writer):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.pid = None
+        self.users = 0
+
+    def send_nowait(self, message):
+        self.writer.write(message if isinstance(message, bytes) else encode(message))
+
+    async def send(self, message):
+        self.send_nowait(message)
+        await self.writer.drain()
+
+class Leader:
+    """Принимает воркеров, делит между ними пользователей и раздаёт результат каждого цикла.
+
+    Состав меняется (подключение, уход, обрыв) — пользователи перераспределяются
+    между циклами: публикация и перебалансировка идут под одним замком.
+    """
+
+    def __init__(self, path=SHARD_SOCKET):
+        self.path = path
+        self.workers = {}  # name -> WorkerConn
+        self.last_report = None
+        self._lock = asyncio.Lock()
+        self._server = None
+        self._procs = []
+        self._next_id = 0
+        self._seq = 0
+        self._cycles = {}  # seq -> {"started", "waiting", "reports", "done"}
+        self._changed = {}  # chat_id -> data, изменённые во время перебалансировки
+        self._handoffs = {}  # воркер -> сколько handoff ещё ждём (последние сигналы переезжающих пользователей)
+        self._handoff_done = asyncio.Event()
+        self._handoff_done.set()
+        self._exports = {}  # воркер -> future с его последними сигналами (для снапшота)
+        self.restored_alerts = []  # последние сигналы из снапшота: уходят воркерам с первым assign
+        self._listening = False
+        self._stopping = False
+
+    # Запуск и остановка
+    async def start(self):
+        if self._server is not None:
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # сокет от прошлого запуска
+        self._server = await asyncio.start_unix_server(self._handle, self.path, limit=MESSAGE_LIMIT)
+        if not self._listening:
+            import storage
+            storage.add_user_listener(self._on_user)
+            self._listening = True
+        print(f"Лидер шардов: {self.path}")
+
+    async def spawn(self, count, *args):
+        """Запускает count воркеров локальными процессами (args — доп. аргументы воркера)"""
+        for _ in range(count):
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), "worker", "--socket", self.path, *args
+            )
+            self._procs.append(proc)
+
+    async def wait_workers(self, count, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while len(self.workers) < count:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"подключилось {len(self.workers)} воркеров из {count}")
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout=10.0):
+        if self._server is None:
+            return
+        self._server.close()
+        self._stopping = True
+        for worker in list(self.workers.values()):
+            try:
+                await worker.send({"type": "stop"})
+            except Exception:
+                pass
+        for proc in self._procs:
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+        self._procs = []
+        self._server = None
+        self._stopping = False
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    # Соединения воркеров
+    async def _handle(self, reader, writer):
+        self._next_id += 1
+        worker = WorkerConn(f"w{self._next_id}", reader, writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                kind = message.get("type")
+                if kind == "hello":
+                    worker.pid = message.get("pid")
+                    async with self._lock:
+                        self.workers[worker.name] = worker
+                        await self._rebalance()
+                    print(f"Шард {worker.name} (pid {worker.pid}) подключился, шардов: {len(self.workers)}")
+                elif kind == "report":
+                    self._on_report(worker, message)
+                elif kind == "handoff":
+                    self._on_handoff(worker, message)
+                elif kind == "export":
+                    future = self._exports.pop(worker.name, None)
+                    if future is not None and not future.done():
+                        future.set_result(message["alerts"])
+                elif kind == "leave":
+                    # Плавный уход: сначала пользователи переезжают к остальным, потом воркер дорассылает и выходит
+                    async with self._lock:
+                        self._drop(worker)
+                        await self._rebalance(leaving=worker)
+                    await worker.send({"type": "release"})
+                    print(f"Шард {worker.name} отключается, шардов: {len(self.workers)}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"Ошибка соединения шарда {worker.name}: {e}")
+        finally:
+            if worker.name in self.workers:
+                async with self._lock:
+                    self._drop(worker)
+                    if not self._stopping:
+                        await self._rebalance()
+                if not self._stopping:
+                    print(f"Шард {worker.name} отвалился, шардов: {len(self.workers)}")
+            self._handoff_from(worker.name, all_pending=True)  # сигналы его пользователей потеряны — цикл не ждёт
+            writer.close()
+
+    def _drop(self, worker):
+        self.workers.pop(worker.name, None)
+        future = self._exports.pop(worker.name, None)
+        if future is not None and not future.done():
+            future.set_result([])
+        self._handoff_from(worker.name, all_pending=True)
+        for seq, cycle in list(self._cycles.items()):
+            cycle["waiting"].discard(worker.name)
+            if not cycle["waiting"]:
+                self._finish(seq)
+
+    async def _rebalance(self, leaving=None):
+        """Раздаёт каждому воркеру его пользователей (вызывать под self._lock).
+
+        Каждый воркер отвечает handoff — последними сигналами тех, кто от него уехал
+        (повтор и cooldown переезжают вместе с пользователем); leaving — уходящий воркер, его ждём тоже.
+        """
+        import storage
+        if leaving is not None:
+            self._expect_handoff(leaving.name)
+        if not self.workers:
+            return
+        names = sorted(self.workers)
+        for name in names:
+            self._expect_handoff(name)
+        shards = {name: {} for name in names}
+        for chat_id, data in storage.load_users().items():
+            shards[shard_of(chat_id, names)][chat_id] = data
+        restored = {name: [] for name in names}
+        for entry in self.restored_alerts:  # дальше сигналы переезжают с пользователями через handoff
+            restored[shard_of(entry[0], names)].append(entry)
+        self.restored_alerts = []
+        for name in names:
+            worker = self.workers[name]
+            moved = len(shards[name]) - worker.users
+            worker.users = len(shards[name])
+            worker.send_nowait({
+                "type": "assign", "worker": name, "shards": len(names), "users": shards[name],
+                "alerts": restored[name],
+            })
+            if moved:
+                print(f"Шард {name}: {worker.users} пользователей ({moved:+d})")
+        await asyncio.gather(*(w.writer.drain() for w in self.workers.values()), return_exceptions=True)
+        changed, self._changed = self._changed, {}
+        for chat_id, data in changed.items():
+            self._send_user(chat_id, data)
+
+    def _expect_handoff(self, name):
+        self._handoffs[name] = self._handoffs.get(name, 0) + 1
+        self._handoff_done.clear()
+
+    def _handoff_from(self, name, all_pending=False):
+        left = 0 if all_pending else self._handoffs.get(name, 0) - 1
+        if left > 0:
+            self._handoffs[name] = left
+        else:
+            self._handoffs.pop(name, None)
+        if not self._handoffs:
+            self._handoff_done.set()
+
+    def _on_handoff(self, worker, message):
+        """Последние сигналы уехавших пользователей -> их новым воркерам"""
+        if self.workers:
+            names = sorted(self.workers)
+            alerts = {}
+            for entry in message["alerts"]:
+                alerts.setdefault(shard_of(entry[0], names), []).append(entry)
+            for name, entries in alerts.items():
+                try:
+                    self.workers[name].send_nowait({"type": "alerts", "alerts": entries})
+                except Exception as e:
+                    print(f"Ошибка передачи сигналов шарду {name}: {e}")
+        self._handoff_from(worker.name)
+
+    async def collect_alerts(self, timeout=HANDOFF_TIMEOUT):
+        """Последние сигналы всех воркеров (повтор и cooldown живут у них) — для снапшота лидера"""
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for name, worker in list(self.workers.items()):
+            futures[name] = self._exports[name] = loop.create_future()
+            try:
+                await worker.send({"type": "export"})
+            except Exception as e:
+                print(f"Ошибка запроса сигналов у шарда {name}: {e}")
+                self._exports.pop(name, None)
+                futures.pop(name)
+        alerts = list(self.restored_alerts)  # ещё не разосланные воркерам
+        if futures:
+            done, pending = await asyncio.wait(futures.values(), timeout=timeout)
+            for name, future in futures.items():
+                if future in done:
+                    alerts.extend(future.result())
+                else:
+                    self._exports.pop(name, None)
+                    print(f"Шард {name} не прислал последние сигналы, в снапшоте их не будет")
+        return [tuple(a) for a in alerts]
+
+    def _on_user(self, chat_id, data):
+        """Изменение пользователя в боте -> его воркеру"""
+        if self._lock.locked():
+            self._changed[chat_id] = data  # перебалансировка могла прочитать старые данные — дошлём после
+        self._send_user(chat_id, data)
+
+    def _send_user(self, chat_id, data):
+        if not self.workers:
+            return
+        name = shard_of(chat_id, sorted(self.workers))
+        try:
+            self.workers[name].send_nowait({"type": "user", "chat_id": chat_id, "data": data})
+        except Exception as e:
+            print(f"Ошибка отправки пользователя шарду {name}: {e}")
+
+    # Циклы
+    async def publish(self, signals, top):
+        """Результат цикла всем воркерам (без воркеров — рассылка здесь же); возвращает номер цикла"""
+        from scheduler import fan_out
+        try:
+            # Сигналы переехавших пользователей должны дойти до новых воркеров раньше цикла
+            await asyncio.wait_for(self._handoff_done.wait(), HANDOFF_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Шарды: нет handoff от {', '.join(sorted(self._handoffs))}, публикую цикл без него")
+            self._handoffs.clear()
+            self._handoff_done.set()
+        async with self._lock:
+            now = time.perf_counter()
+            for seq, cycle in list(self._cycles.items()):
+                if now - cycle["started"] > SHARD_REPORT_TIMEOUT:
+                    self._finish(seq)  # не ответившие попадут в отчёт как пропавшие
+            if not self.workers:
+                fan_out(signals, top)
+                return None
+            self._seq += 1
+            line = encode({"type": "cycle", "seq": self._seq, "signals": signals, "top": top})
+            self._cycles[self._seq] = {
+                "started": now, "waiting": set(self.workers), "reports": {}, "done": asyncio.Event()
+            }
+            for worker in self.workers.values():
+                worker.send_nowait(line)
+            await asyncio.gather(*(w.writer.drain() for w in self.workers.values()), return_exceptions=True)
+            return self._seq
+
+    def _on_report(self, worker, message):
+        cycle = self._cycles.get(message.get("seq"))
+        if cycle is None:
+            return  # цикл уже закрыт по таймауту
+        message["received"] = time.perf_counter() - cycle["started"]
+        cycle["reports"][worker.name] = message
+        cycle["waiting"].discard(worker.name)
+        if not cycle["waiting"]:
+            self._finish(message["seq"])
+
+    def _finish(self, seq):
+        cycle = self._cycles.pop(seq)
+        reports = cycle["reports"]
+        report = {
+            "seq": seq,
+            "seconds": max((r["received"] for r in reports.values()), default=0.0),
+            "shards": {
+                name: {k: r.get(k) for k in ("users", "seconds", "recipients", "queue_depth", "delivered", "sent")}
+                for name, r in sorted(reports.items())
+            },
+            "missing": sorted(cycle["waiting"]),
+        }
+        for name, r in reports.items():
+            SHARD_SECONDS.labels(name).observe(r["seconds"])
+        self.last_report = report
+        cycle["done"].set()
+        log_event("shard_cycle", **report)
+        parts = [f"{name} {r['seconds']:.3f} сек/{r['recipients']}" for name, r in report["shards"].items()]
+        line = f"Шарды, цикл {seq}: " + ", ".join(parts) + f" | всего {report['seconds']:.3f} сек"
+        if report["missing"]:
+            line += f" | нет отчёта: {', '.join(report['missing'])}"
+        print(line)
+
+    async def wait_report(self, seq, timeout=SHARD_REPORT_TIMEOUT):
+        """Ждёт отчёты всех шардов о цикле seq (для bench.py)"""
+        cycle = self._cycles.get(seq)
+        if cycle is not None:
+            await asyncio.wait_for(cycle["done"].wait(), timeout)
+        return self.last_report
+
+# Глобальный лидер (запускается ботом при SHARD_WORKERS > 0)
+leader = Leader()
+CallbackMetric("itrader_shards", "Подключённых воркеров рассылки", lambda: len(leader.workers))
+
+async def run_leader(workers):
+    """Лидер для bot.py: воркеры, затем обычный планировщик, который публикует им результат"""
+    import scheduler
+    import snapshot
+    leader.restored_alerts = list(snapshot.restored_alerts)  # из снапшота: уедут воркерам с первым assign
+    await leader.start()
+    await leader.spawn(workers)
+    try:
+        await leader.wait_workers(workers)
+    except TimeoutError as e:
+        print(f"Шарды: {e}, работаем с теми, что есть")
+    scheduler.publisher = leader
+    await scheduler.run_scheduler()
+
+class Worker:
+    """Доля пользователей и рассылка им результатов циклов лидера"""
+
+    def __init__(self, path=SHARD_SOCKET, wait_delivery=False):
+        from subscriptions import SubscriptionIndex
+        self.path = path
+        self.wait_delivery = wait_delivery  # отчёт после опустошения очереди (bench.py)
+        self.name = "?"
+        self.index = SubscriptionIndex()
+        self.index.rebuild({})
+        self.global_rate = None  # общий лимит бота; шард шлёт свою долю
+        self._writer = None
+
+    def _send(self, message):
+        self._writer.write(encode(message))
+
+    def leave(self):
+        """SIGTERM: просим лидера забрать пользователей, выходим после release"""
+        print(f"Шард {self.name}: отключаюсь")
+        self._send({"type": "leave"})
+
+    def _assign(self, message):
+        """Новая доля пользователей: своё состояние сигналов сохраняем, уехавших — лидеру"""
+        import notifier
+        self.name = message["worker"]
+        if self.global_rate is None:
+            self.global_rate = notifier.delivery.global_bucket.rate
+        notifier.delivery.global_bucket.set_rate(self.global_rate / max(1, message["shards"]))
+        alerts = self.index.rules.export_alerts()
+        users = message["users"]
+        self.index.rebuild(users)
+        self.index.rules.load_alerts(a for a in alerts if str(a[0]) in users)
+        self.index.rules.load_alerts(message.get("alerts", []))  # из снапшота лидера
+        self._send({"type": "handoff", "alerts": [a for a in alerts if str(a[0]) not in users]})
+
+    async def run(self):
+        import notifier
+        from scheduler import fan_out
+        reader, self._writer = await asyncio.open_unix_connection(self.path, limit=MESSAGE_LIMIT)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.leave)
+        self._send({"type": "hello", "pid": os.getpid()})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break  # лидер завершился
+                message = json.loads(line)
+                kind = message["type"]
+                if kind == "assign":
+                    self._assign(message)
+                elif kind == "alerts":
+                    self.index.rules.load_alerts(message["alerts"])
+                elif kind == "export":
+                    self._send({"type": "export", "alerts": self.index.rules.export_alerts()})
+                    await self._writer.drain()
+                elif kind == "user":
+                    self.index.update_user(message["chat_id"], message["data"])
+                elif kind == "cycle":
+                    start = time.perf_counter()
+                    notifier.render_cache.clear()
+                    recipients = fan_out(message["signals"], message["top"], self.index)
+                    report = {
+                        "type": "report", "seq": message["seq"], "users": len(self.index),
+                        "recipients": recipients, "seconds": time.perf_counter() - start,
+                    }
+                    if self.wait_delivery:
+                        await notifier.delivery.join()
+                        report["delivered"] = time.perf_counter() - start
+                    report["queue_depth"] = notifier.delivery.depth
+                    report["sent"] = notifier.delivery.metrics["sent"]
+                    self._send(report)
+                    await self._writer.drain()
+                elif kind == "release":
+                    self._send({"type": "handoff", "alerts": self.index.rules.export_alerts()})
+                    await self._writer.drain()
+                    break
+                elif kind == "stop":
+                    break
+        finally:
+            await notifier.delivery.stop()
+            self._writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер рассылки для шардированного режима")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="подключиться к лидеру и рассылать свою долю пользователей")
+    worker.add_argument("--socket", default=SHARD_SOCKET)
+    worker.add_argument("--fake-telegram", action="store_true", help="без сети: сообщения в фейковый бот")
+    worker.add_argument("--wait-delivery", action="store_true", help="отчёт о цикле после отправки всех сообщений")
+    args = parser.parse_args()
+
+    if args.fake_telegram:
+        import notifier
+        from fake_telegram import FakeBot
+        notifier.delivery = notifier.DeliveryQueue(bot=FakeBot(), global_rate=1000.0, chat_rate=1000.0)
+    asyncio.run(Worker(args.socket, args.wait_delivery).run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# snapshot.py
+# Снапшот живого состояния для тёплого перезапуска: окна свечей, скользящая статистика, тренд,
+# последняя обработанная свеча и последние сигналы. Один бинарный файл с версией:
+#
+#   MAGIC (8 байт) | версия uint32 | длина заголовка uint32 | заголовок JSON | массивы NumPy
+#
+# Массивы выровнены по 64 байта и читаются через mmap без копирования; у каждого — crc32.
+import asyncio
+import json
+import os
+import struct
+import time
+import zlib
+import numpy as np
+
+from config import SNAPSHOT_FILE, SNAPSHOT_INTERVAL, SNAPSHOT_MAX_AGE, HISTORY_SIZE
+
+MAGIC = b"ITRSNAP\0"
+VERSION = 1
+ALIGN = 64
+_HEAD = struct.Struct("<8sII")
+
+# Последние сигналы из восстановленного снапшота: в шардированном режиме лидер раздаёт их воркерам
+restored_alerts = []
+
+def _pad(n):
+    return -n % ALIGN
+
+def write(path, meta, arrays):
+    """Пишет снапшот атомарно (tmp + rename); arrays — {имя: np.ndarray}"""
+    index, offset = {}, 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        index[name] = {
+            "dtype": array.dtype.str, "shape": list(array.shape),
+            "offset": offset, "crc": zlib.crc32(array.data),
+        }
+        offset += array.nbytes + _pad(array.nbytes)
+    header = json.dumps({**meta, "arrays": index}, ensure_ascii=False).encode()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEAD.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.write(b"\0" * _pad(_HEAD.size + len(header)))
+        for name, array in arrays.items():
+            f.write(array.data)
+            f.write(b"\0" * _pad(array.nbytes))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return _HEAD.size + len(header) + offset
+
+def read(path):
+    """(meta, {имя: массив из mmap}); битый файл или чужая версия — ValueError"""
+    with open(path, "rb") as f:
+        magic, version, header_len = _HEAD.unpack(f.read(_HEAD.size))
+        if magic != MAGIC:
+            raise ValueError("не снапшот")
+        if version != VERSION:
+            raise ValueError(f"версия {version}, нужна {VERSION}")
+        meta = json.loads(f.read(header_len))
+    start = _HEAD.size + header_len
+    start += _pad(start)
+    mm = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, info in meta.pop("arrays").items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        offset = start + info["offset"]
+        if offset + count * dtype.itemsize > len(mm):
+            raise ValueError(f"файл обрезан ({name})")
+        array = np.ndarray(info["shape"], dtype=dtype, buffer=mm, offset=offset)
+        if zlib.crc32(array.data) != info["crc"]:
+            raise ValueError(f"контрольная сумма не сходится ({name})")
+        arrays[name] = array
+    return meta, arrays
+
+def _prefixed(prefix, arrays):
+    return {f"{prefix}.{name}": array for name, array in arrays.items()}
+
+def _section(prefix, arrays):
+    prefix += "."
+    return {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+
+async def collect_alerts():
+    """Последние сигналы из воркеров шардов (None — не шардированный режим, они в scheduler.index)"""
+    import scheduler
+    if scheduler.publisher is None:
+        return None
+    return await scheduler.publisher.collect_alerts()
+
+def capture(alerts=None):
+    """Состояние бота -> (meta, arrays). Быстро и в потоке event loop — запись на диск отдельно.
+
+    alerts — последние сигналы из collect_alerts() (шардированный режим), иначе — из scheduler.index.
+    """
+    import scheduler
+    import storage
+    from trend import trend
+
+    stats_meta, stats_arrays = scheduler.stats.export_state()
+    trend_meta, trend_arrays = trend.export_state()
+    candles_meta, candles_arrays = storage.candle_store().export_state()
+
+    # Сигналы: только те, что ещё блокируют повтор (последняя свеча и окна cooldown)
+    if alerts is None:
+        alerts = scheduler.index.rules.export_alerts()
+    alert_symbols = sorted({s for _, s, _ in alerts})
+    symbol_idx = {s: i for i, s in enumerate(alert_symbols)}
+    alert_arrays = {
+        "chat_id": np.array([c for c, _, _ in alerts], dtype=np.int64),
+        "symbol": np.array([symbol_idx[s] for _, s, _ in alerts], dtype=np.int32),
+        "open_time": np.array([t for _, _, t in alerts], dtype=np.int64),
+    }
+
+    meta = {
+        "created": time.time(),
+        "last_open_time": scheduler.last_open_time,
+        "thresholds_updated": scheduler._thresholds_updated,
+        "thresholds_tried": scheduler._thresholds_tried,
+        "stats": stats_meta,
+        "trend": trend_meta,
+        "candles": candles_meta,
+        "alert_symbols": alert_symbols,
+    }
+    arrays = {
+        **_prefixed("stats", stats_arrays), **_prefixed("trend", trend_arrays),
+        **_prefixed("candles", candles_arrays), **_prefixed("alerts", alert_arrays),
+    }
+    return meta, arrays
+
+def restore(meta, arrays):
+    """Раскладывает снапшот по модулям. Сначала все разделы разбираются в отдельные объекты,
+    потом применяются вместе: ошибка формата (ValueError/KeyError) не оставляет состояние наполовину"""
+    import scheduler
+    import storage
+    from candle_store import CandleStore
+    from trend import trend
+
+    if (meta["stats"]["volume_window"], meta["stats"]["quantile_window"], meta["trend"]["period"]) != (
+            scheduler.stats.volume_window, scheduler.stats.quantile_window, trend.period):
+        raise ValueError("окна статистики или период SMA не совпадают с конфигом")
+    candles = CandleStore.from_state(meta["candles"], _section("candles", arrays), HISTORY_SIZE)
+    stats = scheduler.stats.parse_state(meta["stats"], _section("stats", arrays))
+    trend_state = trend.parse_state(meta["trend"], _section("trend", arrays))
+    alerts = _section("alerts", arrays)
+    symbols = meta["alert_symbols"]
+    chat_ids, symbol_ids, open_times = (alerts[k].tolist() for k in ("chat_id", "symbol", "open_time"))
+    if not len(chat_ids) == len(symbol_ids) == len(open_times):
+        raise ValueError("размеры массивов сигналов не совпадают")
+    alert_entries = [(c, symbols[s], t) for c, s, t in zip(chat_ids, symbol_ids, open_times)]
+    last_open_time = meta["last_open_time"]
+    thresholds_updated = meta["thresholds_updated"]
+    thresholds_tried = dict(meta["thresholds_tried"])
+
+    scheduler.stats.apply_state(stats)
+    scheduler._stats_seeded = True  # статистика уже полная, из 72 свечей истории не пересобираем
+    trend.apply_state(*trend_state)
+    storage.restore_candles(candles)
+    scheduler.index.rules.load_alerts(alert_entries)
+    restored_alerts[:] = alert_entries
+    scheduler.last_open_time = last_open_time
+    scheduler._thresholds_updated = thresholds_updated
+    scheduler._thresholds_tried.update(thresholds_tried)
+
+def save(path=SNAPSHOT_FILE, alerts=None):
+    try:
+        start = time.perf_counter()
+        size = write(path, *capture(alerts))
+        print(f"Снапшот сохранён: {size / 1e6:.1f} МБ за {time.perf_counter() - start:.2f} сек")
+    except Exception as e:
+        print(f"Ошибка сохранения снапшота: {e}")
+
+async def save_async(path=SNAPSHOT_FILE):
+    """Снимок состояния — в event loop (согласованный), запись на диск — в потоке"""
+    try:
+        meta, arrays = capture(await collect_alerts())
+        await asyncio.to_thread(write, path, meta, arrays)
+    except Exception as e:
+        print(f"Ошибка сохранения снапшота: {e}")
+
+def load(path=SNAPSHOT_FILE, max_age=SNAPSHOT_MAX_AGE):
+    """При старте: проверяет и восстанавливает снапшот. True — тёплый старт"""
+    if not os.path.exists(path):
+        return False
+    start = time.perf_counter()
+    try:
+        meta, arrays = read(path)
+        age = time.time() - meta["created"]
+        if age > max_age:
+            print(f"Снапшот устарел ({age / 3600:.1f} ч), холодный старт")
+            return False
+        restore(meta, arrays)
+    except Exception as e:
+        print(f"Снапшот не подошёл ({e}), холодный старт")
+        return False
+    print(f"Снапшот восстановлен за {time.perf_counter() - start:.3f} сек: "
+          f"{len(meta['stats']['symbols'])} символов, возраст {age:.0f} сек")
+    return True
+
+async def run_periodic(interval=SNAPSHOT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await save_async()
@@ -1,11 +1,42 @@
 # storage.py
+import asyncio
+import copy
 import json
 import os
-from config import USERS_FILE, THRESHOLDS_FILE, SYMBOL_CACHE_FILE
+import tempfile
+import time
+from config import (
+    USERS_FILE, THRESHOLDS_FILE, SYMBOL_CACHE_FILE, SYMBOL_CACHE_NPY, USERS_FLUSH_DELAY, CANDLES_FLUSH_DELAY,
+    STORAGE_BACKEND, SQLITE_FILE, HISTORY_SIZE, SYMBOLS_FILE
+)
+from candle_store import CandleStore
+from metrics import STORAGE_SECONDS
 from threading import Lock
 
+# Время операций с диском/базой по видам
+_timing = {op: STORAGE_SECONDS.labels(op) for op in (
+    "users_write", "thresholds_read", "thresholds_write", "candles_load", "candles_write"
+)}
+
 # Защита от одновременной записи в JSON
 _lock = Lock()
+_thresholds_lock = Lock()  # чтение-изменение-запись файла порогов по одному символу
+
+# Подписчики на изменения пользователя: fn(chat_id, user_data)
+_user_listeners = []
+
+def add_user_listener(fn):
+    _user_listeners.append(fn)
+
+def _notify_user(chat_id, user_data):
+    for fn in _user_listeners:
+        fn(chat_id, user_data)
+
+# Подписчики на пересчёт порогов: fn(changed) — {symbol: пороги} или None (переписаны все)
+_thresholds_listeners = []
+
+def add_thresholds_listener(fn):
+    _thresholds_listeners.append(fn)
 
 def _load_json(filepath, default):
     if not os.path.exists(filepath):
@@ -17,48 +48,318 @@ def _load_json(filepath, default):
         return default
 
 def _save_json(filepath, data):
+    """Атомарная запись: во временный файл рядом, затем rename (файл никогда не бывает недописанным)"""
     with _lock:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, filepath)
+        except:
+            os.remove(tmp_path)
+            raise
+
+def _default_user():
+    return {"mode": "modbag", "symbols": [], "top_volatile": False}
+
+class JsonBackend:
+    """Пользователи и пороги в JSON, история свечей — бинарный .npy (по умолчанию)"""
+    full_rewrite = True
+
+    def __init__(self, candles_delay=CANDLES_FLUSH_DELAY):
+        self.candles_delay = candles_delay
+        self._candles = None  # CandleStore с изменениями, ещё не записанными на диск
+        self._candles_task = None
+
+    def load_users(self):
+        return _load_json(USERS_FILE, {})
+
+    def save_users(self, users, changed=None):
+        _save_json(USERS_FILE, users)
+
+    def load_thresholds(self):
+        return _load_json(THRESHOLDS_FILE, {})
+
+    def save_thresholds(self, thresholds):
+        _save_json(THRESHOLDS_FILE, thresholds)
+
+    def save_threshold(self, symbol, q):
+        """Один символ: файл перечитывается, чтобы не затереть пороги, записанные другим процессом"""
+        with _thresholds_lock:
+            thresholds = _load_json(THRESHOLDS_FILE, {})
+            thresholds[symbol] = q
+            _save_json(THRESHOLDS_FILE, thresholds)
+
+    def thresholds_version(self):
+        """mtime файла порогов — меняется, когда их переписал любой процесс"""
+        try:
+            return os.stat(THRESHOLDS_FILE).st_mtime_ns
+        except OSError:
+            return 0
+
+    def load_candle_store(self):
+        if os.path.exists(SYMBOL_CACHE_NPY + ".json"):
+            try:
+                return CandleStore.load(SYMBOL_CACHE_NPY, HISTORY_SIZE)
+            except Exception as e:
+                print(f"Не удалось прочитать {SYMBOL_CACHE_NPY}: {e}")
+        # Старый формат: список списков в symbol_cache.json
+        return CandleStore.from_klines(_load_json(SYMBOL_CACHE_FILE, {}), HISTORY_SIZE)
+
+    def append_candles(self, candles, store):
+        """Файл свечей переписывается целиком, поэтому отложенно: не чаще раза в candles_delay сек и в потоке"""
+        self._candles = store
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_candles()  # вне event loop (скрипты) — пишем сразу
+            return
+        if self._candles_task is None or self._candles_task.done():
+            self._candles_task = loop.create_task(self._delayed_candles())
+
+    async def _delayed_candles(self):
+        await asyncio.sleep(self.candles_delay)
+        store, self._candles = self._candles, None
+        if store is None:
+            return
+        try:
+            meta, arrays = store.export_state()  # копия в event loop, запись — в потоке
+            await asyncio.to_thread(self._write_candles, meta, arrays)
+        except Exception as e:
+            print(f"Ошибка записи истории свечей: {e}")
+
+    def _write_candles(self, meta, arrays):
+        start = time.perf_counter()
+        with _lock:
+            CandleStore.write(SYMBOL_CACHE_NPY, meta, arrays)
+        _timing["candles_write"].observe(time.perf_counter() - start)
+
+    def flush_candles(self):
+        """Незаписанные свечи — на диск сейчас (при остановке)"""
+        store, self._candles = self._candles, None
+        if store is not None:
+            self._write_candles(*store.export_state())
+
+def _open_backend():
+    if STORAGE_BACKEND != "sqlite":
+        return JsonBackend()
+    from storage_sqlite import SqliteBackend
+    backend = SqliteBackend(SQLITE_FILE)
+    if backend.get_meta("json_migrated") is None:
+        # Первый старт на SQLite: переносим то, что было в JSON
+        legacy = JsonBackend()
+        users = legacy.load_users()
+        if users:
+            backend.save_users(users)
+        thresholds = legacy.load_thresholds()
+        if thresholds:
+            backend.save_thresholds(thresholds)
+        symbol_cache = legacy.load_candle_store().to_klines()
+        if symbol_cache:
+            backend.append_candles({s: k for s, k in symbol_cache.items() if k})
+        backend.set_meta("json_migrated", 1)
+        print(f"Перенесено в SQLite: {len(users)} пользователей, {len(thresholds)} порогов, "
+              f"{len(symbol_cache)} историй свечей")
+    return backend
+
+backend = _open_backend()
+
+class UserStore:
+    """Пользователи в памяти: чтения без диска, запись на диск отложенно и пачкой.
+
+    Все изменения проходят под одним замком, поэтому параллельные хендлеры
+    не затирают друг друга. На диск уходит снимок не чаще раза в flush_delay сек.
+    """
+
+    def __init__(self, backend, flush_delay=USERS_FLUSH_DELAY):
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self._users = None
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._dirty = set()  # chat_id_str, изменённые с прошлой записи
+        self._flush_task = None
+
+    def _ensure_loaded(self):
+        if self._users is None:
+            self._users = self.backend.load_users()
+
+    def all(self):
+        """Копия всех пользователей {chat_id_str: data}"""
+        with self._lock:
+            self._ensure_loaded()
+            return copy.deepcopy(self._users)
+
+    def get(self, chat_id):
+        chat_id_str = str(chat_id)
+        with self._lock:
+            self._ensure_loaded()
+            created = chat_id_str not in self._users
+            if created:
+                self._users[chat_id_str] = _default_user()
+                self._dirty.add(chat_id_str)
+            data = copy.deepcopy(self._users[chat_id_str])
+        if created:
+            self._schedule_flush()
+            _notify_user(chat_id, data)
+        return data
+
+    def update(self, chat_id, updates):
+        chat_id_str = str(chat_id)
+        with self._lock:
+            self._ensure_loaded()
+            user = self._users.setdefault(chat_id_str, _default_user())
+            user.update(copy.deepcopy(updates))
+            self._dirty.add(chat_id_str)
+            data = copy.deepcopy(user)
+        self._schedule_flush()
+        _notify_user(chat_id, data)
+        return data
+
+    def replace_all(self, users):
+        """Заменяет всех пользователей; подписчики узнают о каждом добавленном, изменённом и удалённом"""
+        with self._lock:
+            old = self._users if self._users is not None else self.backend.load_users()
+            self._users = copy.deepcopy(users)
+            self._dirty.clear()
+            snapshot = copy.deepcopy(self._users)
+        with self._write_lock:
+            self.backend.save_users(snapshot)
+        for chat_id_str, data in snapshot.items():
+            if old.get(chat_id_str) != data:
+                _notify_user(int(chat_id_str), copy.deepcopy(data))
+        for chat_id_str in old.keys() - snapshot.keys():
+            _notify_user(int(chat_id_str), _default_user())  # удалён: без подписок и топа
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()  # вне event loop (скрипты) — пишем сразу
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await asyncio.to_thread(self.flush)
+
+    def flush(self):
+        """Сбрасывает изменения на диск (вызывать при остановке)"""
+        with self._write_lock:  # снимки пишутся строго по порядку
+            with self._lock:
+                if not self._dirty:
+                    return
+                changed, self._dirty = self._dirty, set()
+                if self.backend.full_rewrite:
+                    snapshot = copy.deepcopy(self._users)
+                else:
+                    snapshot = {c: copy.deepcopy(self._users[c]) for c in changed}
+            start = time.perf_counter()
+            self.backend.save_users(snapshot, changed)
+            _timing["users_write"].observe(time.perf_counter() - start)
 
 # Пользователи
+users_store = UserStore(backend)
+
 def load_users():
-    return _load_json(USERS_FILE, {})
+    return users_store.all()
 
 def save_users(users):
-    _save_json(USERS_FILE, users)
+    users_store.replace_all(users)
+
+def flush_users():
+    users_store.flush()
 
 # Пороги волатильности (Q25/Q50/Q75)
 def load_thresholds():
-    return _load_json(THRESHOLDS_FILE, {})
+    start = time.perf_counter()
+    thresholds = backend.load_thresholds()
+    _timing["thresholds_read"].observe(time.perf_counter() - start)
+    return thresholds
 
 def save_thresholds(thresholds):
-    _save_json(THRESHOLDS_FILE, thresholds)
+    start = time.perf_counter()
+    backend.save_thresholds(thresholds)
+    _timing["thresholds_write"].observe(time.perf_counter() - start)
+    for fn in _thresholds_listeners:
+        fn(None)
+
+async def save_threshold(symbol, q):
+    """Порог одного символа (upsert); запись — в потоке, чтобы не держать цикл событий"""
+    start = time.perf_counter()
+    await asyncio.to_thread(backend.save_threshold, symbol, q)
+    _timing["thresholds_write"].observe(time.perf_counter() - start)
+    for fn in _thresholds_listeners:
+        fn({symbol: q})
+
+def thresholds_version():
+    return backend.thresholds_version()
+
+# История свечей (72 последние 5-мин свечи на каждый символ) — в памяти, в кольцевых буферах
+_candle_store = None
+
+def candle_store():
+    global _candle_store
+    if _candle_store is None:
+        start = time.perf_counter()
+        _candle_store = backend.load_candle_store()
+        _timing["candles_load"].observe(time.perf_counter() - start)
+    return _candle_store
 
-# История свечей (72 последние 5-мин свечи на каждый символ)
 def load_symbol_cache():
-    return _load_json(SYMBOL_CACHE_FILE, {})
+    """История в старом формате {symbol: [kline, ...]}"""
+    return candle_store().to_klines()
 
 def save_symbol_cache(cache):
-    _save_json(SYMBOL_CACHE_FILE, cache)
+    global _candle_store
+    _candle_store = CandleStore.from_klines(cache, HISTORY_SIZE)
+    backend.append_candles(cache, _candle_store)
+
+def load_exchange_info():
+    """Сохранённая копия exchangeInfo (справочник контрактов) или None"""
+    return _load_json(SYMBOLS_FILE, None)
+
+def save_exchange_info(data):
+    _save_json(SYMBOLS_FILE, data)
+
+def _write_candles(candles, store):
+    start = time.perf_counter()
+    backend.append_candles(candles, store)
+    if not isinstance(backend, JsonBackend):  # JSON пишет отложенно и время записи считает сам
+        _timing["candles_write"].observe(time.perf_counter() - start)
+
+def append_candles(candles):
+    """Добавляет свечи {symbol: kline} в историю одной записью"""
+    store = candle_store()
+    store.append_many(candles)
+    _write_candles(candles, store)
+
+def merge_candles(candles):
+    """Свечи {symbol: [kline, ...]} в любое место окна (догрузка дыр), одной записью"""
+    store = candle_store()
+    for symbol, klines in candles.items():
+        store.get(symbol).merge(klines)
+    _write_candles(candles, store)
+
+def flush_candles():
+    backend.flush_candles()
+
+def restore_candles(store):
+    """Окна из снапшота: только символы, которых в истории нет или там они старее"""
+    current = candle_store()
+    for symbol in store.symbols():
+        buf = store.get(symbol)
+        if symbol not in current or (current.get(symbol).last_open_time or 0) < (buf.last_open_time or 0):
+            current.replace(symbol, buf)
+
+def get_history(symbol, limit=HISTORY_SIZE):
+    """Окно последних limit свечей символа (колонки NumPy, без копирования)"""
+    return candle_store().get(symbol).window(limit)
 
 # Удобные функции для работы с пользователем
 def get_user_data(chat_id):
-    users = load_users()
-    chat_id_str = str(chat_id)
-    if chat_id_str not in users:
-        users[chat_id_str] = {
-            "mode": "modbag",
-            "symbols": [],
-            "top_volatile": False
-        }
-        save_users(users)
-    return users[chat_id_str]
+    return users_store.get(chat_id)
 
 def update_user_data(chat_id, updates):
-    users = load_users()
-    chat_id_str = str(chat_id)
-    if chat_id_str not in users:
-        users[chat_id_str] = {"mode": "modbag", "symbols": [], "top_volatile": False}
-    users[chat_id_str].update(updates)
-    save_users(users)
\ No newline at end of file
+    users_store.update(chat_id, updates)
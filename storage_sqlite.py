@@ -0,0 +1,214 @@
+# storage_sqlite.py
+# SQLite (WAL) бэкенд хранилища: пользователи, подписки, пороги, свечи
+import json
+import sqlite3
+from threading import Lock
+
+from candle_store import CandleStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    chat_id INTEGER PRIMARY KEY,
+    mode TEXT NOT NULL DEFAULT 'modbag',
+    top_volatile INTEGER NOT NULL DEFAULT 0,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id INTEGER NOT NULL,
+    symbol TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, symbol)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_subscriptions_symbol ON subscriptions (symbol, chat_id);
+CREATE TABLE IF NOT EXISTS thresholds (
+    symbol TEXT PRIMARY KEY,
+    q25 REAL NOT NULL,
+    q50 REAL NOT NULL,
+    q75 REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS candles (
+    symbol TEXT NOT NULL,
+    open_time INTEGER NOT NULL,
+    kline TEXT NOT NULL,
+    PRIMARY KEY (symbol, open_time)
+) WITHOUT ROWID;
+"""
+
+_USER_COLUMNS = ("mode", "symbols", "top_volatile")
+
+class SqliteBackend:
+    # Пишем только изменённых пользователей, а не весь список
+    full_rewrite = False
+
+    def __init__(self, path, retention=4032):
+        self.retention = retention  # сколько свечей на символ держать в базе
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # Миграция
+    def get_meta(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    # Пользователи
+    def load_users(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id, mode, top_volatile, extra FROM users").fetchall()
+            subs = self._conn.execute(
+                "SELECT chat_id, symbol FROM subscriptions ORDER BY chat_id, position"
+            ).fetchall()
+        users = {}
+        for chat_id, mode, top_volatile, extra in rows:
+            data = json.loads(extra)
+            data.update({"mode": mode, "symbols": [], "top_volatile": bool(top_volatile)})
+            users[str(chat_id)] = data
+        for chat_id, symbol in subs:
+            if str(chat_id) in users:
+                users[str(chat_id)]["symbols"].append(symbol)
+        return users
+
+    def save_users(self, users, changed=None):
+        """Upsert пользователей; changed — chat_id, которые реально менялись (None — все)"""
+        ids = list(users) if changed is None else list(changed)
+
+        def write(conn):
+            if changed is None:
+                conn.execute("DELETE FROM subscriptions")
+                conn.execute("DELETE FROM users")
+            for chat_id_str in ids:
+                data = users[chat_id_str]
+                chat_id = int(chat_id_str)
+                top_volatile = data.get("top_volatile", False)
+                if isinstance(top_volatile, str):
+                    top_volatile = top_volatile.lower() == "true"
+                extra = {k: v for k, v in data.items() if k not in _USER_COLUMNS}
+                conn.execute(
+                    "INSERT OR REPLACE INTO users (chat_id, mode, top_volatile, extra) VALUES (?, ?, ?, ?)",
+                    (chat_id, data.get("mode", "modbag"), int(bool(top_volatile)), json.dumps(extra, ensure_ascii=False))
+                )
+                conn.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO subscriptions (chat_id, symbol, position) VALUES (?, ?, ?)",
+                    [(chat_id, symbol, i) for i, symbol in enumerate(data.get("symbols", []))]
+                )
+
+        self._transaction(write)
+
+    def subscribers(self, symbol):
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id FROM subscriptions WHERE symbol = ?", (symbol,)).fetchall()
+        return {row[0] for row in rows}
+
+    # Пороги
+    def load_thresholds(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT symbol, q25, q50, q75 FROM thresholds").fetchall()
+        return {symbol: {"q25": q25, "q50": q50, "q75": q75} for symbol, q25, q50, q75 in rows}
+
+    def save_thresholds(self, thresholds):
+        def write(conn):
+            conn.execute("DELETE FROM thresholds")
+            conn.executemany(
+                "INSERT INTO thresholds (symbol, q25, q50, q75) VALUES (?, ?, ?, ?)",
+                [(s, t["q25"], t["q50"], t["q75"]) for s, t in thresholds.items()]
+            )
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('thresholds_version', '1') "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+            )
+        self._transaction(write)
+
+    def save_threshold(self, symbol, q):
+        """Upsert порога одного символа; остальные строки не трогаются"""
+        def write(conn):
+            conn.execute(
+                "INSERT INTO thresholds (symbol, q25, q50, q75) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(symbol) DO UPDATE SET q25 = excluded.q25, q50 = excluded.q50, q75 = excluded.q75",
+                (symbol, q["q25"], q["q50"], q["q75"])
+            )
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('thresholds_version', '1') "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+            )
+        self._transaction(write)
+
+    def thresholds_version(self):
+        """Счётчик пересчётов порогов (растёт при каждом save_thresholds и save_threshold)"""
+        return self.get_meta("thresholds_version") or "0"
+
+    # Свечи
+    def append_candles(self, candles, store=None):
+        """candles: {symbol: kline} или {symbol: [kline, ...]} — вставка/обновление по (symbol, open_time)"""
+        rows = []
+        for symbol, klines in candles.items():
+            if klines and not isinstance(klines[0], list):
+                klines = [klines]
+            rows.extend((symbol, int(k[0]), json.dumps(k)) for k in klines)
+
+        def write(conn):
+            conn.executemany("INSERT OR REPLACE INTO candles (symbol, open_time, kline) VALUES (?, ?, ?)", rows)
+            # Храним только последние retention свечей по каждому затронутому символу
+            for symbol in candles:
+                conn.execute(
+                    "DELETE FROM candles WHERE symbol = ? AND open_time < ("
+                    " SELECT open_time FROM candles WHERE symbol = ?"
+                    " ORDER BY open_time DESC LIMIT 1 OFFSET ?)",
+                    (symbol, symbol, self.retention - 1)
+                )
+
+        self._transaction(write)
+
+    def flush_candles(self):
+        """Свечи пишутся сразу построчно — отложенного нет"""
+
+    def get_candles(self, symbol, limit=72, start=None, end=None):
+        """Свечи символа по возрастанию open_time: последние limit, опционально в диапазоне [start, end]"""
+        query = "SELECT kline FROM candles WHERE symbol = ?"
+        params = [symbol]
+        if start is not None:
+            query += " AND open_time >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND open_time <= ?"
+            params.append(end)
+        query += " ORDER BY open_time DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def load_symbol_cache(self, limit=72):
+        with self._lock:
+            symbols = [row[0] for row in self._conn.execute("SELECT DISTINCT symbol FROM candles")]
+        return {symbol: self.get_candles(symbol, limit) for symbol in symbols}
+
+    def load_candle_store(self, capacity=72):
+        return CandleStore.from_klines(self.load_symbol_cache(capacity), capacity)
@@ -0,0 +1,93 @@
+# subscriptions.py
+# Обратный индекс symbol -> chat_id, чтобы считать сигнал один раз на символ
+from collections import defaultdict
+
+import storage
+from rules import RuleBook
+
+DEFAULT_MODE = "modbag"
+
+def _is_top(data):
+    top_volatile = data.get("top_volatile", False)
+    if isinstance(top_volatile, str):
+        top_volatile = top_volatile.lower() == "true"
+    return bool(top_volatile)
+
+class SubscriptionIndex:
+    def __init__(self):
+        self._subscribers = defaultdict(set)  # symbol -> {chat_id}
+        self._user_symbols = {}  # chat_id -> tuple(symbols)
+        self._top_users = set()
+        self._modes = {}  # chat_id -> режим (modbag/modmarket)
+        self.rules = RuleBook()  # скомпилированные правила сигналов
+        self._loaded = False
+
+    def __len__(self):
+        return len(self._modes)
+
+    def rebuild(self, users):
+        """Полная пересборка из словаря пользователей (как в users.json)"""
+        self._subscribers.clear()
+        self._user_symbols.clear()
+        self._top_users.clear()
+        self._modes.clear()
+        self.rules.clear()
+        for chat_id_str, data in users.items():
+            self.update_user(chat_id_str, data)
+        self._loaded = True
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.rebuild(storage.load_users())
+
+    def update_user(self, chat_id, data):
+        """Инкрементально применяет новые настройки пользователя"""
+        chat_id = int(chat_id)
+        old = set(self._user_symbols.get(chat_id, ()))
+        new = set(data.get("symbols", []))
+        for symbol in old - new:
+            subs = self._subscribers[symbol]
+            subs.discard(chat_id)
+            if not subs:
+                del self._subscribers[symbol]
+        for symbol in new - old:
+            self._subscribers[symbol].add(chat_id)
+        self._user_symbols[chat_id] = tuple(data.get("symbols", []))
+        self.rules.update_user(chat_id, old, data)
+        self._modes[chat_id] = data.get("mode", DEFAULT_MODE)
+        if _is_top(data):
+            self._top_users.add(chat_id)
+        else:
+            self._top_users.discard(chat_id)
+
+    def subscribers(self, symbol):
+        self.ensure_loaded()
+        return self._subscribers.get(symbol, set())
+
+    def symbols(self):
+        self.ensure_loaded()
+        return set(self._subscribers)
+
+    def top_users(self):
+        self.ensure_loaded()
+        return set(self._top_users)
+
+    def mode(self, chat_id):
+        self.ensure_loaded()
+        return self._modes.get(int(chat_id), DEFAULT_MODE)
+
+    def group_by_mode(self, chat_ids):
+        """Разбивает chat_ids по режимам: {mode: [chat_id, ...]}"""
+        self.ensure_loaded()
+        groups = defaultdict(list)
+        for chat_id in chat_ids:
+            groups[self._modes.get(chat_id, DEFAULT_MODE)].append(chat_id)
+        return groups
+
+    def user_symbols(self, chat_id):
+        self.ensure_loaded()
+        return self._user_symbols.get(int(chat_id), ())
+
+# Глобальный индекс, синхронизируется с update_user_data/get_user_data
+index = SubscriptionIndex()
+storage.add_user_listener(index.update_user)
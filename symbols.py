@@ -0,0 +1,198 @@
+# symbols.py
+# Справочник контрактов USDT-фьючерсов из exchangeInfo: проверка символа за O(1), подсказки
+# по префиксу и опечаткам, статус контракта, шаг цены/объёма. Копия лежит на диске,
+# обновляется раз в SYMBOLS_REFRESH; снятые с торгов монеты убираются из подписок
+import asyncio
+import difflib
+import time
+from bisect import bisect_left
+
+import storage
+from binance_api import get_exchange_info
+from config import SYMBOLS_REFRESH
+from metrics import CallbackMetric
+
+QUOTE = "USDT"
+
+# Статусы Binance -> наши: торгуется, в расчёте/поставке, ещё не торгуется, снят
+STATUSES = {
+    "TRADING": "trading",
+    "PENDING_TRADING": "pending",
+    "PRE_SETTLE": "settling", "SETTLING": "settling",
+    "PRE_DELIVERING": "settling", "DELIVERING": "settling",
+    "DELIVERED": "delisted", "CLOSE": "delisted",
+}
+
+class SymbolInfo:
+    __slots__ = ("symbol", "base", "status", "contract_type", "tick_size", "step_size",
+                 "min_notional", "price_precision", "quantity_precision")
+
+    def __init__(self, item):
+        filters = {f.get("filterType"): f for f in item.get("filters", [])}
+        self.symbol = item["symbol"]
+        self.base = item.get("baseAsset") or self.symbol[:-len(QUOTE)]
+        self.status = STATUSES.get(item.get("status"), "delisted")
+        self.contract_type = item.get("contractType", "")
+        self.tick_size = float(filters.get("PRICE_FILTER", {}).get("tickSize", 0))
+        self.step_size = float(filters.get("LOT_SIZE", {}).get("stepSize", 0))
+        self.min_notional = float(filters.get("MIN_NOTIONAL", {}).get("notional", 0))
+        self.price_precision = int(item.get("pricePrecision", 8))
+        self.quantity_precision = int(item.get("quantityPrecision", 8))
+
+    @property
+    def trading(self):
+        return self.status == "trading"
+
+def _compact(item):
+    """Только нужные поля контракта — копия на диске в разы меньше ответа Binance"""
+    keys = ("symbol", "baseAsset", "quoteAsset", "contractType", "status", "pricePrecision", "quantityPrecision")
+    data = {k: item[k] for k in keys if k in item}
+    data["filters"] = [f for f in item.get("filters", [])
+                       if f.get("filterType") in ("PRICE_FILTER", "LOT_SIZE", "MIN_NOTIONAL")]
+    return data
+
+class SymbolRegistry:
+    """Контракты в памяти: dict для проверки и статуса, отсортированные базовые активы для подсказок.
+
+    Пока справочник не загружен (нет копии и не было ответа Binance), проверки
+    пропускают всё — бот работает как раньше, а не отказывает всем подряд.
+    """
+
+    def __init__(self):
+        self._info = {}  # symbol -> SymbolInfo
+        self._bases = []  # отсортированные базовые активы торгуемых контрактов
+        self._by_base = {}  # base -> symbol
+        self.updated = 0.0  # когда получен от Binance (time.time)
+        self._loaded = False
+
+    def __len__(self):
+        self.ensure_loaded()
+        return len(self._info)
+
+    def __contains__(self, symbol):
+        return self.is_valid(symbol)
+
+    @property
+    def loaded(self):
+        self.ensure_loaded()
+        return bool(self._info)
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self._loaded = True
+            data = storage.load_exchange_info()
+            if data:
+                self._build(data["symbols"], data.get("updated", 0.0))
+
+    def _build(self, items, updated):
+        info = {}
+        for item in items:
+            if item.get("quoteAsset", QUOTE) != QUOTE or not item.get("symbol", "").endswith(QUOTE):
+                continue
+            if item.get("contractType", "PERPETUAL") != "PERPETUAL":
+                continue  # квартальные контракты (BTCUSDT_240628) не наши
+            info[item["symbol"]] = SymbolInfo(item)
+        self._info = info
+        self._by_base = {i.base: s for s, i in info.items() if i.trading}
+        self._bases = sorted(self._by_base)
+        self.updated = updated
+
+    def info(self, symbol):
+        self.ensure_loaded()
+        return self._info.get(symbol)
+
+    def status(self, symbol):
+        """trading / pending / settling / delisted; нет в справочнике — delisted (или unknown без справочника)"""
+        self.ensure_loaded()
+        if not self._info:
+            return "unknown"
+        info = self._info.get(symbol)
+        return info.status if info else "delisted"
+
+    def is_valid(self, symbol):
+        """Торгуется ли контракт сейчас (без справочника — считаем, что да)"""
+        self.ensure_loaded()
+        if not self._info:
+            return True
+        info = self._info.get(symbol)
+        return info is not None and info.trading
+
+    def filter_trading(self, symbols):
+        """Только торгуемые символы, порядок сохраняется"""
+        return [s for s in symbols if self.is_valid(s)]
+
+    def suggest(self, text, limit=5):
+        """Подсказки для ввода пользователя: сначала по префиксу, затем похожие (опечатки)"""
+        self.ensure_loaded()
+        base = normalize_base(text)
+        if not base or not self._bases:
+            return []
+        found = []
+        i = bisect_left(self._bases, base)
+        while i < len(self._bases) and self._bases[i].startswith(base) and len(found) < limit:
+            found.append(self._by_base[self._bases[i]])
+            i += 1
+        if len(found) < limit:
+            for match in difflib.get_close_matches(base, self._bases, n=limit, cutoff=0.6):
+                symbol = self._by_base[match]
+                if symbol not in found:
+                    found.append(symbol)
+        return found[:limit]
+
+    def resolve(self, text):
+        """Ввод пользователя ('sol', 'SOLUSDT', '1000pepe') -> (symbol или None, подсказки)"""
+        symbol = normalize_base(text) + QUOTE
+        if self.is_valid(symbol):
+            return symbol, []
+        return None, self.suggest(text)
+
+    async def refresh(self):
+        """Свежий exchangeInfo с Binance -> память и диск; потом чистка подписок"""
+        data = await get_exchange_info()
+        items = (data or {}).get("symbols") or []
+        if not any(item.get("symbol") == "BTCUSDT" for item in items):
+            print("exchangeInfo пустой или неполный — справочник не обновлён")
+            return False
+        self._loaded = True
+        self._build(items, time.time())
+        storage.save_exchange_info({"updated": self.updated, "symbols": [_compact(i) for i in items]})
+        prune_subscriptions(self)
+        return True
+
+    async def run_periodic(self, interval=SYMBOLS_REFRESH):
+        """Обновление справочника в фоне; при старте — сразу, если копия устарела"""
+        self.ensure_loaded()
+        while True:
+            wait = self.updated + interval - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not await self.refresh():
+                await asyncio.sleep(min(interval, 300))  # Binance недоступен — повторим позже
+
+def normalize_base(text):
+    """'sol', 'SOLUSDT', 'sol/usdt' -> 'SOL'"""
+    base = "".join(ch for ch in str(text).upper() if ch.isalnum())
+    if base.endswith(QUOTE) and len(base) > len(QUOTE):
+        base = base[:-len(QUOTE)]
+    return base
+
+def prune_subscriptions(registry):
+    """Убирает из подписок снятые с торгов и несуществующие символы и сообщает пользователям"""
+    from notifier import delivery
+    removed = 0
+    for chat_id, data in storage.load_users().items():
+        symbols = data.get("symbols", [])
+        gone = [s for s in symbols if registry.status(s) == "delisted"]
+        if not gone:
+            continue
+        storage.update_user_data(chat_id, {"symbols": [s for s in symbols if s not in gone]})
+        delivery.enqueue(int(chat_id), f"{', '.join(gone)}: нет среди фьючерсов Binance (сняты с торгов), удалены из подписок")
+        removed += len(gone)
+    if removed:
+        print(f"Из подписок удалено снятых с торгов символов: {removed}")
+    return removed
+
+# Глобальный справочник
+registry = SymbolRegistry()
+CallbackMetric("itrader_symbols_trading", "Торгуемых USDT-контрактов в справочнике",
+               lambda: len(registry._by_base))
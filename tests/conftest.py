@@ -0,0 +1,27 @@
+# conftest.py
+# Окружение для офлайн-тестов: временный DATA_DIR и фиктивный токен до импорта config
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("TELEGRAM_TOKEN", "1:test")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="itrader-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import binance_api
+from cache import cache
+from fake_binance import FakeBinance
+from rate_limiter import WeightLimiter
+
+@pytest.fixture
+def fake(monkeypatch):
+    """Мок Binance вместо сети; лимитер и кеш — чистые в каждом тесте"""
+    monkeypatch.setattr(binance_api, "limiter", WeightLimiter())
+    monkeypatch.setattr(binance_api, "_semaphore", None)
+    cache.clear()
+    fake = FakeBinance(["BTCUSDT", "ETHUSDT", "SOLUSDT"]).install()
+    yield fake
+    binance_api.set_transport(None)
+    cache.clear()
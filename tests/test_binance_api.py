@@ -0,0 +1,54 @@
+# test_binance_api.py
+import asyncio
+import time
+
+import binance_api
+from binance_api import get_klines, _klines_ttl, CACHE_MAX_LIMIT
+from config import CACHE_FORMING_TTL
+
+def klines_requests(fake):
+    return [params for path, params in fake.requests if path == "/fapi/v1/klines"]
+
+def test_429_is_retried_after_pause(fake):
+    fake.fail_with = [429]
+    start = time.monotonic()
+    klines = asyncio.run(get_klines("ETHUSDT", limit=3, end_time=fake.now_ms - 600_000))
+    assert len(klines) == 3
+    assert len(klines_requests(fake)) == 2
+    # Retry-After: 1 — повтор не раньше чем через секунду
+    assert time.monotonic() - start >= 0.9
+
+def test_418_is_not_retried(fake):
+    fake.fail_with = [418]
+    klines = asyncio.run(get_klines("ETHUSDT", limit=3))
+    assert klines == []
+    assert len(klines_requests(fake)) == 1
+    assert binance_api.limiter._banned_until > time.monotonic()
+
+def test_klines_cache_shares_one_request(fake):
+    end_time = fake.now_ms - 600_000
+
+    async def run():
+        first = await asyncio.gather(*(get_klines("ETHUSDT", limit=5, end_time=end_time) for _ in range(10)))
+        again = await get_klines("ETHUSDT", limit=5, end_time=end_time)
+        return first, again
+
+    first, again = asyncio.run(run())
+    assert all(result == again for result in first)
+    assert len(klines_requests(fake)) == 1
+
+def test_klines_cache_skips_large_and_paged_requests(fake):
+    async def run():
+        for _ in range(2):
+            await get_klines("ETHUSDT", limit=CACHE_MAX_LIMIT + 1)
+            await get_klines("ETHUSDT", limit=5, start_time=fake.now_ms - 3_000_000)
+
+    asyncio.run(run())
+    assert len(klines_requests(fake)) == 4
+
+def test_klines_ttl():
+    now_ms = time.time() * 1000
+    # закрытые свечи живут интервал, запрос с текущей — несколько секунд
+    assert _klines_ttl("5m", now_ms - 600_000) == 300
+    assert _klines_ttl("5m") == CACHE_FORMING_TTL
+    assert _klines_ttl("5m", now_ms) == CACHE_FORMING_TTL
@@ -0,0 +1,36 @@
+# test_levels.py
+import numpy as np
+
+import storage
+import scheduler
+from analytics import determine_level, determine_levels, kline_to_volatility
+from fake_binance import FakeBinance
+
+THRESHOLDS = {"q25": 0.5, "q50": 1.0, "q75": 2.0}
+
+def test_determine_levels_matches_scalar():
+    vols = [0.0, 0.5, 0.7, 1.0, 1.5, 2.0, 3.0]
+    matrix = np.tile([THRESHOLDS["q25"], THRESHOLDS["q50"], THRESHOLDS["q75"]], (len(vols), 1))
+    levels = determine_levels(vols, ["ETHUSDT"] * len(vols), matrix)
+    # на границе порога — нижний уровень
+    assert list(levels) == [1, 1, 2, 2, 3, 3, 4]
+    assert list(levels) == [determine_level(v, "ETHUSDT", THRESHOLDS) for v in vols]
+
+def test_determine_levels_without_thresholds():
+    levels = determine_levels([0.0, 0.1], ["NOPEUSDT", "NOPEUSDT"], np.zeros((2, 3)))
+    assert list(levels) == [1, 4]
+
+def test_classify_uses_stored_thresholds():
+    fake = FakeBinance(["ETHUSDT", "SOLUSDT"])
+    open_time = fake.now_ms - fake.now_ms % 300_000 - 300_000
+    current = {s: fake.make_kline(s, "5m", open_time) for s in fake.symbols}
+    eth_vol = kline_to_volatility(current["ETHUSDT"])
+    storage.save_thresholds({
+        "ETHUSDT": {"q25": eth_vol / 4, "q50": eth_vol / 2, "q75": eth_vol * 2},
+        "SOLUSDT": {"q25": 100.0, "q50": 200.0, "q75": 300.0},
+    })
+    result = scheduler.classify(current, ["ETHUSDT", "SOLUSDT", "BTCUSDT"])
+    # BTCUSDT нет в свечах — его нет и в ответе
+    assert set(result) == {"ETHUSDT", "SOLUSDT"}
+    assert result["ETHUSDT"] == (eth_vol, 3)
+    assert result["SOLUSDT"][1] == 1
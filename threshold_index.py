@@ -0,0 +1,75 @@
+# threshold_index.py
+# Пороги Q25/Q50/Q75 в памяти: перечитываются только когда изменились в хранилище
+import time
+import numpy as np
+
+import storage
+
+ZERO = {"q25": 0.0, "q50": 0.0, "q75": 0.0}
+
+class ThresholdIndex:
+    """Словарь порогов + те же пороги матрицей (n, 3) для векторной классификации"""
+
+    def __init__(self, check_interval=5.0):
+        self.check_interval = check_interval  # как часто (сек) сверять версию в хранилище
+        self._thresholds = {}
+        self._row = {}  # symbol -> строка в матрице
+        self._matrix = np.zeros((0, 3))
+        self._version = None
+        self._checked = 0.0
+
+    def reload(self, changed=None):
+        """Перечитывает пороги из хранилища (после /recalc или compute_thresholds).
+
+        changed — {symbol: пороги}, записанные этим процессом: они правятся на месте, без чтения всех.
+        """
+        loaded = self._version is not None
+        self._version = storage.thresholds_version()
+        self._checked = time.monotonic()
+        if changed is not None and loaded:
+            for symbol, q in changed.items():
+                self._thresholds[symbol] = q
+                row = self._row.get(symbol)
+                if row is None:
+                    row = self._row[symbol] = len(self._matrix)
+                    self._matrix = np.vstack([self._matrix, np.zeros((1, 3))])
+                self._matrix[row] = (q["q25"], q["q50"], q["q75"])
+            return
+        self._thresholds = storage.load_thresholds()
+        symbols = list(self._thresholds)
+        self._row = {s: i for i, s in enumerate(symbols)}
+        self._matrix = np.array(
+            [[self._thresholds[s]["q25"], self._thresholds[s]["q50"], self._thresholds[s]["q75"]] for s in symbols],
+            dtype=np.float64
+        ).reshape(len(symbols), 3)
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        if self._version is None or storage.thresholds_version() != self._version:
+            self.reload()
+
+    def has(self, symbol):
+        self._maybe_reload()
+        return symbol in self._thresholds
+
+    def get(self, symbol):
+        self._maybe_reload()
+        return self._thresholds.get(symbol, ZERO)
+
+    def matrix(self, symbols):
+        """Пороги для списка символов матрицей (n, 3); нет порогов — нули"""
+        self._maybe_reload()
+        result = np.zeros((len(symbols), 3))
+        rows = [self._row.get(s, -1) for s in symbols]
+        idx = np.array(rows, dtype=np.int64)
+        found = idx >= 0
+        if found.any():
+            result[found] = self._matrix[idx[found]]
+        return result
+
+# Глобальный индекс порогов; save_thresholds в этом процессе сбрасывает его сразу
+thresholds_index = ThresholdIndex()
+storage.add_thresholds_listener(thresholds_index.reload)
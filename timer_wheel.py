@@ -0,0 +1,131 @@
+# timer_wheel.py
+# Планировщик по границам свечей Binance: часы сервера, без наложения циклов, учёт пропусков
+import asyncio
+import time
+
+from binance_api import get_server_time
+from config import SCHEDULER_OFFSET, CLOCK_SYNC_INTERVAL
+
+TIMEFRAMES_MS = {"5m": 300_000, "15m": 900_000, "1h": 3_600_000, "4h": 14_400_000}
+
+class ServerClock:
+    """Локальные часы с поправкой на время сервера Binance"""
+
+    def __init__(self, sync_interval=CLOCK_SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self.offset_ms = 0  # server - local
+        self._synced = None
+        self._failures = 0      # неудачных синхронизаций подряд
+        self._retry_at = 0.0    # раньше этого момента (monotonic) не повторяем
+
+    async def sync(self):
+        start = time.time()
+        server_ms = await get_server_time()
+        end = time.time()
+        if server_ms is None:
+            # Не долбим API на каждой итерации: 5, 10, 20... сек, но не реже sync_interval
+            self._failures += 1
+            delay = min(5 * 2 ** (self._failures - 1), self.sync_interval)
+            self._retry_at = time.monotonic() + delay
+            print(f"Не удалось получить время Binance, повтор через {delay:.0f} сек")
+            return
+        self._failures = 0
+        # Сервер ответил где-то посередине запроса
+        self.offset_ms = int(server_ms - (start + end) / 2 * 1000)
+        self._synced = time.monotonic()
+        if abs(self.offset_ms) > 1000:
+            print(f"Часы расходятся с Binance на {self.offset_ms / 1000:.1f} сек, учитываем поправку")
+
+    @property
+    def stale(self):
+        now = time.monotonic()
+        if now < self._retry_at:
+            return False
+        return self._synced is None or now - self._synced > self.sync_interval
+
+    def now_ms(self):
+        return int(time.time() * 1000) + self.offset_ms
+
+class Job:
+    def __init__(self, name, interval_ms, callback):
+        self.name = name
+        self.interval_ms = interval_ms
+        self.callback = callback  # async callback(open_time, missed): open_time закрытой свечи
+        self.next_close = None    # граница (мс), после которой запуск
+        self.task = None
+        self.backlog = []         # open_time тиков, пропущенных пока шёл прошлый запуск
+        self.runs = 0
+        self.missed = 0
+        self.last_duration = 0.0
+
+class TimerWheel:
+    """Один таймер на все таймфреймы: задача срабатывает через offset сек после закрытия свечи.
+
+    При старте сразу запускается тик по последней закрытой свече, чтобы после
+    перезапуска не ждать следующей границы. Запуски одной задачи не накладываются: если прошлый ещё идёт, тик
+    откладывается и передаётся следующему запуску в missed вместе с тиками,
+    проспанными по другим причинам (долгий цикл, сон машины).
+    """
+
+    def __init__(self, clock=None, offset=SCHEDULER_OFFSET):
+        self.clock = clock or ServerClock()
+        self.offset_ms = int(offset * 1000)
+        self.jobs = []
+
+    def add(self, name, callback, interval_ms=None):
+        job = Job(name, interval_ms or TIMEFRAMES_MS[name], callback)
+        self.jobs.append(job)
+        return job
+
+    def _schedule(self, job, now_ms):
+        """Тик задачи: open_time закрытой свечи и пропущенные open_time"""
+        latest_close = (now_ms - self.offset_ms) // job.interval_ms * job.interval_ms
+        missed = list(range(job.next_close, latest_close, job.interval_ms))
+        job.next_close = latest_close + job.interval_ms
+        open_time = latest_close - job.interval_ms
+        missed = [close - job.interval_ms for close in missed]
+
+        if job.task is not None and not job.task.done():
+            print(f"[{job.name}] прошлый цикл ещё идёт, тик {open_time} отложен")
+            job.backlog.extend(missed + [open_time])
+            return
+        missed = job.backlog + missed
+        job.backlog = []
+        if missed:
+            job.missed += len(missed)
+            print(f"[{job.name}] пропущено тиков: {len(missed)}, догоняем")
+        job.task = asyncio.create_task(self._run_job(job, open_time, missed))
+
+    async def _run_job(self, job, open_time, missed):
+        start = time.monotonic()
+        try:
+            await job.callback(open_time, missed)
+        except Exception as e:
+            print(f"[{job.name}] ошибка цикла: {e}")
+        job.runs += 1
+        job.last_duration = time.monotonic() - start
+        if job.last_duration * 1000 > job.interval_ms:
+            print(f"[{job.name}] цикл длился {job.last_duration:.1f} сек — дольше интервала")
+
+    async def run(self):
+        await self.clock.sync()
+        now = self.clock.now_ms()
+        for job in self.jobs:
+            # Граница уже пройдена — первый проход цикла сразу даст тик по последней закрытой свече
+            job.next_close = (now - self.offset_ms) // job.interval_ms * job.interval_ms
+        while True:
+            if self.clock.stale:
+                await self.clock.sync()
+            now = self.clock.now_ms()
+            for job in self.jobs:
+                if now >= job.next_close + self.offset_ms:
+                    self._schedule(job, now)
+            due = min(job.next_close for job in self.jobs) + self.offset_ms
+            # Спим частями, чтобы поправка часов и сон машины учитывались вовремя
+            await asyncio.sleep(min(max(0, due - self.clock.now_ms()) / 1000, 60))
+
+    async def stop(self):
+        tasks = [job.task for job in self.jobs if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,170 @@
+# trend.py
+# Тренд (цена против SMA200) на 15m/1h/4h: старшие бары собираются из 5m свечей локально
+import asyncio
+import time
+import numpy as np
+
+from binance_api import get_klines
+from rate_limiter import PRIORITY_BACKFILL
+from rolling_stats import RollingMean, _offsets, _concat
+
+TIMEFRAMES_MS = {"4h": 14_400_000, "1h": 3_600_000, "15m": 900_000}
+BASE_MS = 300_000  # 5m
+SMA_PERIOD = 200
+
+class TrendSeries:
+    """Бары одного таймфрейма из 5m свечей + SMA по close, O(1) на свечу"""
+
+    def __init__(self, tf_ms, period=SMA_PERIOD):
+        self.tf_ms = tf_ms
+        self.sma = RollingMean(period)
+        self.bar = None  # текущий бар: [open_time, open, high, low, close]
+        self.last_open_time = None  # последняя учтённая 5m свеча
+        self.broken = False  # пропущен целый бар — нужна повторная загрузка
+
+    def seed(self, klines):
+        """Заполняет по готовым барам этого таймфрейма (последний может формироваться)"""
+        self.sma = RollingMean(self.sma.window)
+        for k in klines:
+            self.sma.push(float(k[4]))
+        last = klines[-1]
+        self.bar = [int(last[0]), float(last[1]), float(last[2]), float(last[3]), float(last[4])]
+        self.last_open_time = int(last[0])
+        self.broken = False
+
+    def update(self, kline):
+        open_time = int(kline[0])
+        if self.bar is None or (self.last_open_time is not None and open_time < self.last_open_time):
+            return
+        bar_open = open_time - open_time % self.tf_ms
+        high, low, close = float(kline[2]), float(kline[3]), float(kline[4])
+        if bar_open == self.bar[0]:
+            self.bar[2] = max(self.bar[2], high)
+            self.bar[3] = min(self.bar[3], low)
+            self.bar[4] = close
+            self.sma.replace_last(close)
+        elif bar_open > self.bar[0]:
+            if bar_open > self.bar[0] + self.tf_ms:
+                self.broken = True  # между барами дыра — SMA уже неточна
+            self.bar = [bar_open, float(kline[1]), high, low, close]
+            self.sma.push(close)
+        self.last_open_time = open_time
+
+    @property
+    def ready(self):
+        return self.bar is not None and self.sma.full and not self.broken
+
+    def emoji(self):
+        if not self.ready:
+            return "⚪"
+        return "🟢" if self.bar[4] > self.sma.mean else "🔴"
+
+class TrendEngine:
+    """Тренд по любому символу: один раз загрузить бары, дальше — только 5m свечи из цикла"""
+
+    def __init__(self, timeframes=TIMEFRAMES_MS, period=SMA_PERIOD):
+        self.timeframes = dict(timeframes)
+        self.period = period
+        self._series = {}  # symbol -> {tf: TrendSeries}
+        self._fresh = {}   # symbol -> мс последних данных (загрузка или 5m свеча)
+
+    def __contains__(self, symbol):
+        return symbol in self._series
+
+    def seed(self, symbol, tf, klines):
+        series = self._series.setdefault(symbol, {})
+        if tf not in series:
+            series[tf] = TrendSeries(self.timeframes[tf], self.period)
+        if klines:
+            series[tf].seed(klines)
+            self._fresh[symbol] = int(time.time() * 1000)
+
+    def needs_seed(self, symbol, now_ms=None):
+        """Таймфреймы без данных, с дырой или давно без свежих 5m свечей"""
+        series = self._series.get(symbol, {})
+        if now_ms is not None and now_ms - self._fresh.get(symbol, 0) > 3 * BASE_MS:
+            return list(self.timeframes)  # символ не обновлялся из цикла (нет подписчиков)
+        return [tf for tf in self.timeframes
+                if tf not in series or series[tf].bar is None or series[tf].broken]
+
+    async def ensure(self, symbols, now_ms=None):
+        """Догружает бары таймфреймов, которых не хватает (фон, приоритет догрузки)"""
+        jobs = [(s, tf) for s in symbols for tf in self.needs_seed(s, now_ms)]
+        if not jobs:
+            return
+        fetched = await asyncio.gather(*(
+            get_klines(s, interval=tf, limit=self.period + 10, priority=PRIORITY_BACKFILL) for s, tf in jobs
+        ))
+        for (symbol, tf), klines in zip(jobs, fetched):
+            self.seed(symbol, tf, klines)
+
+    def update(self, candles):
+        """candles: {symbol: kline} или {symbol: [kline, ...]} — 5m свечи; чужие символы пропускаются"""
+        for symbol, klines in candles.items():
+            series = self._series.get(symbol)
+            if series is None:
+                continue
+            if klines and not isinstance(klines[0], list):
+                klines = [klines]
+            for kline in klines:
+                for s in series.values():
+                    s.update(kline)
+                self._fresh[symbol] = max(self._fresh.get(symbol, 0), int(kline[0]))
+
+    def export_state(self):
+        """Состояние для снапшота: (meta для JSON, {имя: массив}); строка — пара (символ, таймфрейм)"""
+        keys = [(symbol, tf) for symbol, series in self._series.items() for tf in series]
+        items = [self._series[symbol][tf] for symbol, tf in keys]
+        meta = {"keys": keys, "period": self.period, "fresh": self._fresh}
+        arrays = {
+            "bar": np.array([s.bar if s.bar is not None else [np.nan] * 5 for s in items],
+                            dtype=np.float64).reshape(len(items), 5),
+            "last_open_time": np.array([-1 if s.last_open_time is None else s.last_open_time for s in items],
+                                       dtype=np.int64),
+            "broken": np.array([s.broken for s in items], dtype=np.bool_),
+            "sma_offsets": _offsets([len(s.sma) for s in items]),
+            "sma": _concat([s.sma._values for s in items]),
+        }
+        return meta, arrays
+
+    def parse_state(self, meta, arrays):
+        """Из export_state в ({symbol: {tf: TrendSeries}}, fresh), движок не меняется"""
+        if meta["period"] != self.period:
+            raise ValueError("период SMA в снапшоте не совпадает с конфигом")
+        bars = arrays["bar"].tolist()
+        last_open_time = arrays["last_open_time"].tolist()
+        broken = arrays["broken"].tolist()
+        sma, off = arrays["sma"].tolist(), arrays["sma_offsets"].tolist()
+        if not len(bars) == len(last_open_time) == len(broken) == len(off) - 1 == len(meta["keys"]):
+            raise ValueError("размеры массивов тренда не совпадают")
+        parsed = {}
+        for i, (symbol, tf) in enumerate(meta["keys"]):
+            if tf not in self.timeframes:
+                continue
+            series = TrendSeries(self.timeframes[tf], self.period)
+            if bars[i][0] == bars[i][0]:  # не NaN
+                series.bar = [int(bars[i][0])] + bars[i][1:]
+            series.last_open_time = last_open_time[i] if last_open_time[i] >= 0 else None
+            series.broken = broken[i]
+            series.sma.load(sma[off[i]:off[i + 1]])
+            parsed.setdefault(symbol, {})[tf] = series
+        return parsed, {s: int(t) for s, t in meta["fresh"].items()}
+
+    def load_state(self, meta, arrays):
+        self.apply_state(*self.parse_state(meta, arrays))
+
+    def apply_state(self, series, fresh):
+        for symbol, by_tf in series.items():
+            self._series.setdefault(symbol, {}).update(by_tf)
+        self._fresh.update(fresh)
+
+    def status(self, symbol):
+        """{tf: эмодзи} — ⚪, если данных для SMA200 мало"""
+        series = self._series.get(symbol, {})
+        return {tf: series[tf].emoji() if tf in series else "⚪" for tf in self.timeframes}
+
+    def text(self, symbol):
+        return "".join(f"{tf}{emoji}" for tf, emoji in self.status(symbol).items())
+
+# Глобальный движок тренда
+trend = TrendEngine()
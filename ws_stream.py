@@ -0,0 +1,192 @@
+# ws_stream.py
+# Потоковые 5-мин свечи через WebSocket Binance Futures (combined streams)
+import asyncio
+import inspect
+import itertools
+import json
+import time
+import websockets
+
+from config import BINANCE_WS, STREAMS_PER_CONNECTION
+from binance_api import get_klines
+from rate_limiter import PRIORITY_BACKFILL
+
+INTERVAL_MS = {"1m": 60_000, "5m": 300_000, "15m": 900_000, "1h": 3_600_000, "4h": 14_400_000}
+SUBSCRIBE_CHUNK = 50  # стримов в одном SUBSCRIBE (у Binance лимит на входящие сообщения)
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 60.0
+
+def stream_name(symbol, interval="5m"):
+    return f"{symbol.lower()}@kline_{interval}"
+
+def ws_kline_to_rest(k):
+    """Переводит kline из WebSocket в формат ответа REST /fapi/v1/klines"""
+    return [k["t"], k["o"], k["h"], k["l"], k["c"], k["v"], k["T"], k["q"], k["n"], k["V"], k["Q"], k.get("B", "0")]
+
+class _Connection:
+    """Одно WS-соединение со своей пачкой стримов"""
+
+    def __init__(self, owner, url):
+        self.owner = owner
+        self.url = url
+        self.streams = set()
+        self.task = None
+        self.backfills = set()  # задачи догрузки после (пере)подключения: держим ссылки, пока идут
+        self._ws = None
+        self._ids = itertools.count(1)
+
+    async def _send(self, method, streams):
+        if self._ws is None or not streams:
+            return
+        streams = sorted(streams)
+        for i in range(0, len(streams), SUBSCRIBE_CHUNK):
+            payload = {"method": method, "params": streams[i:i + SUBSCRIBE_CHUNK], "id": next(self._ids)}
+            await self._ws.send(json.dumps(payload))
+
+    async def subscribe(self, streams):
+        self.streams |= set(streams)
+        try:
+            await self._send("SUBSCRIBE", streams)
+        except websockets.ConnectionClosed:
+            pass  # подпишемся заново при переподключении
+
+    async def unsubscribe(self, streams):
+        self.streams -= set(streams)
+        try:
+            await self._send("UNSUBSCRIBE", streams)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def run(self):
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                async with websockets.connect(self.url, max_size=None) as ws:
+                    self._ws = ws
+                    delay = RECONNECT_MIN
+                    await self._send("SUBSCRIBE", self.streams)
+                    # Пока были офлайн, могли пропустить закрытые свечи — догружаем из REST
+                    task = asyncio.create_task(self.owner.backfill(self.streams))
+                    self.backfills.add(task)
+                    task.add_done_callback(self.backfills.discard)
+                    async for raw in ws:
+                        self.owner.handle_message(raw)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WebSocket {self.url}: {e}")
+            finally:
+                self._ws = None
+            print(f"WebSocket переподключение через {delay:.0f} сек")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+class KlineStream:
+    """Подписки <symbol>@kline_<interval>, разложенные по нескольким соединениям.
+
+    on_candle(symbol, kline, closed, backfill) вызывается на каждую свечу:
+    closed — свеча закрыта, backfill — свеча догружена из REST после разрыва.
+    """
+
+    def __init__(self, on_candle, interval="5m", intra_candle=False,
+                 url=BINANCE_WS, per_connection=STREAMS_PER_CONNECTION):
+        self.on_candle = on_candle
+        self.interval = interval
+        self.intra_candle = intra_candle
+        self.url = url.rstrip("/") + "/stream"
+        self.per_connection = per_connection
+        self.last_closed = {}  # symbol -> open_time последней закрытой свечи
+        self._connections = []
+        self._owner = {}  # stream -> _Connection
+
+    @property
+    def symbols(self):
+        return {name.split("@")[0].upper() for name in self._owner}
+
+    async def set_symbols(self, symbols):
+        """Приводит подписки к нужному набору символов (SUBSCRIBE/UNSUBSCRIBE только разницы)"""
+        wanted = {stream_name(s, self.interval) for s in symbols}
+        removed = set(self._owner) - wanted
+        added = wanted - set(self._owner)
+
+        by_conn = {}
+        for name in removed:
+            by_conn.setdefault(self._owner.pop(name), []).append(name)
+        for conn, names in by_conn.items():
+            await conn.unsubscribe(names)
+
+        added = sorted(added)
+        for conn in self._connections:
+            room = self.per_connection - len(conn.streams)
+            if room > 0 and added:
+                chunk, added = added[:room], added[room:]
+                await self._assign(conn, chunk)
+        while added:
+            conn = _Connection(self, self.url)
+            self._connections.append(conn)
+            chunk, added = added[:self.per_connection], added[self.per_connection:]
+            await self._assign(conn, chunk)
+            conn.task = asyncio.create_task(conn.run())
+
+    async def _assign(self, conn, names):
+        for name in names:
+            self._owner[name] = conn
+        await conn.subscribe(names)
+
+    def handle_message(self, raw):
+        msg = json.loads(raw)
+        data = msg.get("data")
+        if not data or data.get("e") != "kline":
+            return  # ответы на SUBSCRIBE и прочее
+        k = data["k"]
+        symbol = k["s"]
+        closed = bool(k["x"])
+        if closed:
+            self.last_closed[symbol] = max(self.last_closed.get(symbol, 0), k["t"])
+        elif not self.intra_candle:
+            return
+        self.on_candle(symbol, ws_kline_to_rest(k), closed, False)
+
+    async def backfill(self, streams):
+        """Догружает из REST закрытые свечи, пропущенные за время разрыва"""
+        step = INTERVAL_MS[self.interval]
+        now_ms = int(time.time() * 1000)
+
+        async def fill(symbol):
+            last = self.last_closed.get(symbol)
+            if last is None:
+                return
+            missing = (now_ms - last) // step - 1  # без текущей формирующейся свечи
+            if missing < 1:
+                return
+            klines = await get_klines(
+                symbol, self.interval, limit=min(missing + 1, 1000),
+                start_time=last + step, priority=PRIORITY_BACKFILL
+            )
+            for kline in klines:
+                if kline[6] < now_ms and kline[0] > self.last_closed.get(symbol, 0):
+                    self.last_closed[symbol] = kline[0]
+                    self.on_candle(symbol, kline, True, True)
+
+        symbols = {name.split("@")[0].upper() for name in streams}
+        await asyncio.gather(*(fill(s) for s in symbols))
+
+    async def run(self, symbols_provider, refresh=30):
+        """Держит подписки в актуальном состоянии: раз в refresh сек сверяет набор символов"""
+        try:
+            while True:
+                symbols = symbols_provider()
+                if inspect.isawaitable(symbols):
+                    symbols = await symbols
+                await self.set_symbols(symbols)
+                await asyncio.sleep(refresh)
+        finally:
+            await self.close()
+
+    async def close(self):
+        tasks = [t for c in self._connections for t in ([c.task] if c.task else []) + list(c.backfills)]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._connections = []
+        self._owner = {}